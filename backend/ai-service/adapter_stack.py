@@ -0,0 +1,107 @@
+"""
+Стек LoRA-адаптеров всех агентов в одном safetensors-файле
+
+adapters.safetensors хранит тензоры адаптеров с префиксом "<агент>/", adapters.json —
+их конфигурации и отпечатки (agent_registry.adapter_fingerprint), tokenizer/<агент>/ —
+токенизаторы агентов. Файл открывается memory-mapped, и при подключении агента читаются
+только его тензоры, поэтому старт не зависит от числа агентов. Агент, чей адаптер в
+каталоге агента изменился после сборки стека (переобучение), загружается из каталога.
+"""
+
+import os
+import json
+import logging
+from dataclasses import fields
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+STACK_WEIGHTS_NAME = "adapters.safetensors"
+STACK_CONFIG_NAME = "adapters.json"
+STACK_TOKENIZER_DIR = "tokenizer"
+
+
+def _read_adapter_weights(adapter_path: str) -> Dict:
+    safetensors_path = os.path.join(adapter_path, "adapter_model.safetensors")
+    if os.path.exists(safetensors_path):
+        from safetensors.torch import load_file
+
+        return load_file(safetensors_path)
+    import torch
+
+    return torch.load(os.path.join(adapter_path, "adapter_model.bin"), map_location="cpu")
+
+
+def write_adapter_stack(specs: List, out_dir: str) -> str:
+    """Собирает адаптеры агентов в один файл (выполняется офлайн, см. export_models.py)"""
+    from safetensors.torch import save_file
+    from transformers import AutoTokenizer
+
+    os.makedirs(out_dir, exist_ok=True)
+    tensors, entries = {}, {}
+    for spec in specs:
+        with open(os.path.join(spec.adapter_path, "adapter_config.json"), "r", encoding="utf-8") as f:
+            entries[spec.name] = {"config": json.load(f), "fingerprint": spec.adapter_fingerprint}
+        for key, tensor in _read_adapter_weights(spec.adapter_path).items():
+            tensors[f"{spec.name}/{key}"] = tensor.contiguous()
+        AutoTokenizer.from_pretrained(spec.adapter_path).save_pretrained(os.path.join(out_dir, STACK_TOKENIZER_DIR, spec.name))
+        logger.info(f"Адаптер агента {spec.name} добавлен в стек")
+
+    save_file(tensors, os.path.join(out_dir, STACK_WEIGHTS_NAME))
+    with open(os.path.join(out_dir, STACK_CONFIG_NAME), "w", encoding="utf-8") as f:
+        json.dump(entries, f, ensure_ascii=False, indent=2)
+    return out_dir
+
+
+class AdapterStack:
+    """Чтение адаптеров из стека по требованию"""
+
+    def __init__(self, stack_dir: str):
+        self.stack_dir = stack_dir
+        with open(os.path.join(stack_dir, STACK_CONFIG_NAME), "r", encoding="utf-8") as f:
+            entries = json.load(f)
+        # Стек прежнего формата (только конфигурации, без отпечатков) не совпадает ни с одним адаптером
+        self.configs: Dict[str, Dict] = {agent: entry.get("config", entry) for agent, entry in entries.items()}
+        self.fingerprints: Dict[str, str] = {agent: entry.get("fingerprint", "") for agent, entry in entries.items()}
+
+    @classmethod
+    def open(cls, stack_dir: str):
+        if not stack_dir or not os.path.exists(os.path.join(stack_dir, STACK_CONFIG_NAME)):
+            return None
+        return cls(stack_dir)
+
+    def tokenizer_path(self, agent: str) -> str:
+        return os.path.join(self.stack_dir, STACK_TOKENIZER_DIR, agent)
+
+    def __contains__(self, agent: str) -> bool:
+        return agent in self.configs
+
+    def matches(self, agent: str, fingerprint: str) -> bool:
+        """Есть ли в стеке адаптер агента, совпадающий с текущим адаптером в каталоге агента"""
+        if agent not in self.configs:
+            return False
+        if self.fingerprints.get(agent) != fingerprint or not os.path.isdir(self.tokenizer_path(agent)):
+            logger.warning(f"Адаптер агента {agent} в стеке {self.stack_dir} устарел, загружается из каталога агента "
+                           f"(пересоберите стек: python export_models.py build --targets adapters)")
+            return False
+        return True
+
+    def lora_config(self, agent: str):
+        from peft import LoraConfig
+
+        known = {field.name for field in fields(LoraConfig) if field.init}
+        config = LoraConfig(**{k: v for k, v in self.configs[agent].items() if k in known})
+        config.inference_mode = True
+        return config
+
+    def discard(self, agent: str):
+        """Исключает агента из стека (адаптер изменился — загружается из каталога агента)"""
+        self.configs.pop(agent, None)
+
+    def state_dict(self, agent: str) -> Dict:
+        """Тензоры адаптера агента (читаются из memory-mapped файла)"""
+        from safetensors import safe_open
+
+        prefix = f"{agent}/"
+        with safe_open(os.path.join(self.stack_dir, STACK_WEIGHTS_NAME), framework="pt") as f:
+            return {key[len(prefix):]: f.get_tensor(key) for key in f.keys() if key.startswith(prefix)}
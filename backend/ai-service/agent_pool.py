@@ -0,0 +1,212 @@
+"""
+Ленивая загрузка LoRA-адаптеров агентов с LRU-вытеснением по бюджету памяти и простою
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple, Any
+
+from peft import PeftModel
+from transformers import AutoTokenizer, PreTrainedTokenizerBase
+
+from adapter_stack import AdapterStack
+from agent_registry import adapter_fingerprint
+from cpu_backend import load_cpu_model, merged_model_path, model_size_bytes
+from metrics import (
+    ai_agents_loaded, ai_agent_memory_bytes, ai_agent_load_duration_seconds,
+    ai_agent_evictions_total
+)
+
+logger = logging.getLogger(__name__)
+
+ADAPTER_WEIGHT_FILES = ("adapter_model.safetensors", "adapter_model.bin")
+
+
+def adapter_size_bytes(adapter_path: str) -> int:
+    """Оценивает объём адаптера в памяти по размеру файла весов"""
+    for name in ADAPTER_WEIGHT_FILES:
+        weights_path = os.path.join(adapter_path, name)
+        if os.path.exists(weights_path):
+            return os.path.getsize(weights_path)
+    return 0
+
+
+class AgentEntry:
+    def __init__(self, name: str, tokenizer: PreTrainedTokenizerBase, adapter_bytes: int, model: Any = None):
+        self.name = name
+        self.tokenizer = tokenizer
+        self.model = model  # Отдельная модель с влитым адаптером (CPU-бэкенд) или None
+        self.footprint: Dict[str, int] = {"model" if model is not None else "adapter": adapter_bytes}
+        self.last_used = time.monotonic()
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(self.footprint.values())
+
+
+class AgentPool:
+    """
+    Держит в памяти только используемые адаптеры агентов.
+
+    Все адаптеры подключаются к одной PeftModel поверх общей базовой модели
+    (load_adapter/set_adapter), поэтому загрузка агента стоит только весов LoRA.
+    Агенты упорядочены по последнему обращению; при превышении бюджета памяти
+    или по истечении времени простоя выгружаются самые старые.
+
+    С merged_dir (CPU-бэкенд) агенты, для которых есть экспорт с влитым адаптером,
+    загружаются отдельными моделями в представлении cpu_dtype; остальные — адаптерами.
+    С adapter_stack адаптеры читаются из общего memory-mapped файла (см. export_models.py).
+    """
+
+    def __init__(self, base_model, memory_budget_mb: int = 2048, idle_ttl_seconds: int = 1800,
+                 merged_dir: Optional[str] = None, cpu_dtype: str = "bf16", static_cache: bool = True,
+                 adapter_stack: Optional[AdapterStack] = None):
+        self.base_model = base_model
+        self.adapter_stack = adapter_stack
+        self.merged_dir = merged_dir
+        self.cpu_dtype = cpu_dtype
+        self.static_cache = static_cache
+        self.peft_model: Optional[PeftModel] = None
+        self.memory_budget_bytes = memory_budget_mb * 1024 * 1024
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self._entries: "OrderedDict[str, AgentEntry]" = OrderedDict()
+        self._evict_callbacks: List[Callable[[str], None]] = []
+        self._lock = threading.RLock()
+
+    def on_evict(self, callback: Callable[[str], None]):
+        """Регистрирует обработчик выгрузки агента (например, очистку кэша эмбеддингов)"""
+        self._evict_callbacks.append(callback)
+
+    def acquire(self, agent: str, adapter_path: str) -> Tuple[PreTrainedTokenizerBase, Any]:
+        """Возвращает токенизатор и модель агента, загружая адаптер при первом обращении"""
+        with self._lock:
+            self.evict_idle()
+
+            entry = self._entries.get(agent)
+            if entry is None:
+                entry = self._load(agent, adapter_path)
+                self._entries[agent] = entry
+                self._enforce_budget(keep=agent)
+            else:
+                self._entries.move_to_end(agent)
+
+            entry.last_used = time.monotonic()
+            self._update_gauges()
+            if entry.model is not None:
+                return entry.tokenizer, entry.model
+            self.peft_model.set_adapter(agent)
+            return entry.tokenizer, self.peft_model
+
+    def add_footprint(self, agent: str, component: str, size_bytes: int):
+        """Учитывает в бюджете дополнительные данные агента (эмбеддинги параграфов и т.п.)"""
+        with self._lock:
+            entry = self._entries.get(agent)
+            if entry is None:
+                return
+            entry.footprint[component] = size_bytes
+            self._enforce_budget(keep=agent)
+            self._update_gauges()
+
+    def evict(self, agent: str, reason: str = "manual"):
+        with self._lock:
+            if agent not in self._entries:
+                return
+            entry = self._entries.pop(agent)
+            if entry.model is None and self.peft_model is not None:
+                self.peft_model.delete_adapter(agent)
+                adapters = [name for name, other in reversed(self._entries.items()) if other.model is None]
+                if adapters:
+                    self.peft_model.set_adapter(adapters[0])
+            ai_agent_evictions_total.labels(reason=reason).inc()
+            for callback in self._evict_callbacks:
+                try:
+                    callback(agent)
+                except Exception as e:
+                    logger.error(f"Ошибка обработчика выгрузки агента {agent}: {e}")
+            logger.info(f"Агент {agent} выгружен из памяти", extra={"agent": agent, "reason": reason})
+            self._update_gauges()
+
+    def evict_idle(self):
+        """Выгружает агентов, к которым не обращались дольше idle_ttl_seconds"""
+        if self.idle_ttl_seconds <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            for agent, entry in list(self._entries.items()):
+                if now - entry.last_used > self.idle_ttl_seconds:
+                    self.evict(agent, reason="idle")
+
+    @contextmanager
+    def base_model_only(self):
+        """Контекст для генерации базовой моделью без активных адаптеров"""
+        if self.peft_model is None:
+            yield self.base_model
+            return
+        with self._lock, self.peft_model.disable_adapter():
+            yield self.peft_model
+
+    def _load(self, agent: str, adapter_path: str) -> AgentEntry:
+        start = time.time()
+        # Экспорт и стек используются, только если собраны из текущего адаптера агента
+        fingerprint = adapter_fingerprint(adapter_path)
+        merged_path = merged_model_path(self.merged_dir, agent, fingerprint)
+        stacked = merged_path is None and self.adapter_stack is not None and self.adapter_stack.matches(agent, fingerprint)
+        tokenizer = AutoTokenizer.from_pretrained(
+            merged_path or (self.adapter_stack.tokenizer_path(agent) if stacked else adapter_path)
+        )
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+
+        if merged_path is not None:
+            agent_model = load_cpu_model(merged_path, self.cpu_dtype, static_cache=self.static_cache)
+            duration = time.time() - start
+            ai_agent_load_duration_seconds.labels(agent=agent).observe(duration)
+            logger.info(f"Агент {agent} загружен из экспорта {merged_path} за {duration:.2f} с",
+                        extra={"agent": agent, "duration": duration})
+            return AgentEntry(agent, tokenizer, model_size_bytes(agent_model), model=agent_model)
+
+        if stacked:
+            adapter_bytes = self._load_stacked(agent)
+        elif self.peft_model is None:
+            self.peft_model = PeftModel.from_pretrained(self.base_model, adapter_path, adapter_name=agent)
+            adapter_bytes = adapter_size_bytes(adapter_path)
+        else:
+            self.peft_model.load_adapter(adapter_path, adapter_name=agent)
+            adapter_bytes = adapter_size_bytes(adapter_path)
+
+        duration = time.time() - start
+        ai_agent_load_duration_seconds.labels(agent=agent).observe(duration)
+        logger.info(f"Агент {agent} загружен за {duration:.2f} с", extra={"agent": agent, "duration": duration})
+        return AgentEntry(agent, tokenizer, adapter_bytes)
+
+    def _load_stacked(self, agent: str) -> int:
+        """Подключает адаптер из стека: читаются только тензоры этого агента"""
+        from peft import get_peft_model, set_peft_model_state_dict
+
+        config = self.adapter_stack.lora_config(agent)
+        state_dict = self.adapter_stack.state_dict(agent)
+        if self.peft_model is None:
+            self.peft_model = get_peft_model(self.base_model, config, adapter_name=agent)
+            self.peft_model.eval()
+        else:
+            self.peft_model.add_adapter(agent, config)
+        set_peft_model_state_dict(self.peft_model, state_dict, adapter_name=agent)
+        return sum(t.numel() * t.element_size() for t in state_dict.values())
+
+    def _enforce_budget(self, keep: str):
+        total = sum(entry.size_bytes for entry in self._entries.values())
+        for agent in list(self._entries.keys()):
+            if total <= self.memory_budget_bytes:
+                break
+            if agent == keep:
+                continue
+            total -= self._entries[agent].size_bytes
+            self.evict(agent, reason="budget")
+
+    def _update_gauges(self):
+        ai_agents_loaded.set(len(self._entries))
+        ai_agent_memory_bytes.set(sum(entry.size_bytes for entry in self._entries.values()))
@@ -0,0 +1,268 @@
+"""
+Реестр агентов: обнаружение баз знаний и адаптеров на диске вместо жёстко заданного agent_map
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from numpy.typing import NDArray
+
+from metrics import ai_registry_agents, ai_registry_changes_total, ai_registry_last_refresh_timestamp
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "agents.json"
+ADAPTER_SUBDIR = "best_model"
+ADAPTER_CONFIG_NAME = "adapter_config.json"
+
+
+# --- Разделение на абзацы ---
+def split_into_paragraphs(text: str) -> List[str]:
+    paragraphs = [p.strip() for p in re.split(r'\n\s*\n|\n', text) if p.strip()]
+    return paragraphs
+
+
+def _path_signature(path: str) -> str:
+    """Сигнатура файла или каталога по размерам и времени изменения"""
+    if not os.path.exists(path):
+        return "missing"
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+    parts = []
+    for name in sorted(os.listdir(path)):
+        full_path = os.path.join(path, name)
+        if os.path.isfile(full_path):
+            stat = os.stat(full_path)
+            parts.append(f"{name}:{stat.st_size}:{stat.st_mtime_ns}")
+    return "|".join(parts)
+
+
+_adapter_hashes: Dict[str, tuple] = {}
+
+
+def adapter_fingerprint(adapter_path: str) -> str:
+    """
+    Хэш содержимого файлов адаптера (веса, конфигурация, токенизатор). Не зависит от времени
+    изменения, поэтому переживает копирование; пересчитывается, только если файлы изменились.
+    """
+    signature = _path_signature(adapter_path)
+    cached = _adapter_hashes.get(adapter_path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    digest = hashlib.sha256()
+    if os.path.isdir(adapter_path):
+        for name in sorted(os.listdir(adapter_path)):
+            full_path = os.path.join(adapter_path, name)
+            if name == "README.md" or not os.path.isfile(full_path):
+                continue
+            digest.update(name.encode("utf-8"))
+            with open(full_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+    fingerprint = digest.hexdigest()
+    _adapter_hashes[adapter_path] = (signature, fingerprint)
+    return fingerprint
+
+
+class AgentSpec:
+    """Описание агента: база знаний, адаптер и тексты для маршрутизации"""
+
+    def __init__(self, name: str, file_path: str, adapter_path: str,
+                 description: str = "", sample_questions: Optional[List[str]] = None,
+                 decoding: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.file_path = file_path
+        self.adapter_path = adapter_path
+        self.description = description
+        self.sample_questions = sample_questions or []
+        self.decoding = decoding or {}  # Режим генерации ответа, см. decoding.py
+        self.fingerprint = self._fingerprint()
+
+    def _fingerprint(self) -> str:
+        payload = json.dumps({
+            "knowledge_base": _path_signature(self.file_path),
+            "adapter": _path_signature(self.adapter_path),
+            "description": self.description,
+            "sample_questions": self.sample_questions,
+            "decoding": self.decoding,
+        }, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @property
+    def adapter_fingerprint(self) -> str:
+        return adapter_fingerprint(self.adapter_path)
+
+    @property
+    def knowledge_base_signature(self) -> str:
+        return _path_signature(self.file_path)
+
+    def corpus_hash(self) -> str:
+        """Хэш содержимого базы знаний (не зависит от времени изменения файла)"""
+        with open(self.file_path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def routing_texts(self) -> List[str]:
+        """Тексты, по которым строится эмбеддинг агента для маршрутизации"""
+        texts = [self.name]
+        if self.description:
+            texts.append(f"{self.name}: {self.description}")
+        texts.extend(self.sample_questions)
+        return texts
+
+    def load_paragraphs(self) -> List[str]:
+        with open(self.file_path, "r", encoding="utf-8") as f:
+            return split_into_paragraphs(f.read())
+
+
+class AgentRegistry:
+    """
+    Обнаруживает агентов в каталоге и следит за их изменениями.
+
+    Агент — это пара `<имя>.txt` + `<имя>/best_model`. Необязательный манифест
+    `agents.json` задаёт описания, примеры вопросов и нестандартные пути:
+    {"agents": [{"name": ..., "description": ..., "sample_questions": [...],
+                 "knowledge_base": "...", "adapter": "...", "decoding": {"mode": ...}}]}
+    Эмбеддинги для маршрутизации вычисляются один раз при регистрации агента
+    и хранятся нормализованной матрицей (агенты × размерность).
+    """
+
+    def __init__(self, agents_dir: str, embeddings_model: Any = None):
+        self.agents_dir = agents_dir
+        self.embeddings_model = embeddings_model
+        self.agents: Dict[str, AgentSpec] = {}
+        self.agent_names: List[str] = []
+        self.routing_matrix: NDArray = np.zeros((0, 0), dtype=np.float32)
+        self._routing_embeddings: Dict[str, NDArray] = {}
+        self._change_callbacks: List[Callable[[str, str, Optional[AgentSpec]], None]] = []
+
+    def __contains__(self, agent: str) -> bool:
+        return agent in self.agents
+
+    def __getitem__(self, agent: str) -> AgentSpec:
+        return self.agents[agent]
+
+    def __iter__(self):
+        return iter(self.agent_names)
+
+    def on_change(self, callback: Callable[[str, str, Optional[AgentSpec]], None]):
+        """Регистрирует обработчик изменений: callback(agent, change, old_spec)"""
+        self._change_callbacks.append(callback)
+
+    def discover(self, require_adapter: bool = True) -> Dict[str, AgentSpec]:
+        """
+        Читает манифест и раскладку каталога, возвращает найденных агентов.
+
+        База знаний — <имя>.txt, для которого есть запись в манифесте или каталог агента
+        <имя>/. По умолчанию агент регистрируется, только если его адаптер обучен; с
+        require_adapter=False адаптера может ещё не быть (для train_agents.py).
+        """
+        specs: Dict[str, AgentSpec] = {}
+        manifest_path = os.path.join(self.agents_dir, MANIFEST_NAME)
+        manifest_entries = []
+        if os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, "r", encoding="utf-8") as f:
+                    manifest_entries = json.load(f).get("agents", [])
+            except (OSError, ValueError) as e:
+                logger.error(f"Не удалось прочитать манифест агентов {manifest_path}: {e}")
+
+        for entry in manifest_entries:
+            name = entry.get("name")
+            if not name:
+                continue
+            adapter_path = os.path.join(self.agents_dir, entry.get("adapter", os.path.join(name, ADAPTER_SUBDIR)))
+            if require_adapter and not os.path.exists(os.path.join(adapter_path, ADAPTER_CONFIG_NAME)):
+                logger.warning(f"Агент {name} из манифеста пропущен: нет адаптера {adapter_path}")
+                continue
+            specs[name] = AgentSpec(
+                name=name,
+                file_path=os.path.join(self.agents_dir, entry.get("knowledge_base", f"{name}.txt")),
+                adapter_path=adapter_path,
+                description=entry.get("description", ""),
+                sample_questions=entry.get("sample_questions", []),
+                decoding=entry.get("decoding"),
+            )
+
+        # Агенты без записи в манифесте: <имя>.txt рядом с каталогом агента <имя>/
+        listed = {entry.get("name") for entry in manifest_entries}
+        for file_name in sorted(os.listdir(self.agents_dir)):
+            name, ext = os.path.splitext(file_name)
+            if ext != ".txt" or name in listed or not os.path.isdir(os.path.join(self.agents_dir, name)):
+                continue
+            adapter_path = os.path.join(self.agents_dir, name, ADAPTER_SUBDIR)
+            if require_adapter and not os.path.exists(os.path.join(adapter_path, ADAPTER_CONFIG_NAME)):
+                continue
+            specs[name] = AgentSpec(
+                name=name,
+                file_path=os.path.join(self.agents_dir, file_name),
+                adapter_path=adapter_path,
+            )
+
+        for name, spec in specs.items():
+            if not os.path.exists(spec.file_path):
+                logger.warning(f"База знаний агента {name} не найдена: {spec.file_path}")
+        return specs
+
+    def refresh(self) -> Dict[str, str]:
+        """Синхронизирует реестр с диском, возвращает {агент: added/changed/removed}"""
+        discovered = self.discover()
+        changes: Dict[str, str] = {}
+        old_specs = dict(self.agents)
+
+        for name in list(self.agents):
+            if name not in discovered:
+                del self.agents[name]
+                self._routing_embeddings.pop(name, None)
+                changes[name] = "removed"
+
+        for name, spec in discovered.items():
+            current = self.agents.get(name)
+            if current is not None and current.fingerprint == spec.fingerprint:
+                continue
+            self.agents[name] = spec
+            if current is None or current.routing_texts() != spec.routing_texts():
+                self._routing_embeddings.pop(name, None)
+            changes[name] = "added" if current is None else "changed"
+
+        if changes or not self.agent_names:
+            self._rebuild_routing()
+
+        for name, change in changes.items():
+            ai_registry_changes_total.labels(change=change).inc()
+            logger.info(f"Реестр агентов: {name} — {change}", extra={"agent": name, "change": change})
+            for callback in self._change_callbacks:
+                try:
+                    callback(name, change, old_specs.get(name))
+                except Exception as e:
+                    logger.error(f"Ошибка обработчика изменения агента {name}: {e}")
+
+        ai_registry_agents.set(len(self.agents))
+        ai_registry_last_refresh_timestamp.set(time.time())
+        return changes
+
+    def _rebuild_routing(self):
+        self.agent_names = sorted(self.agents)
+        if self.embeddings_model is None or not self.agent_names:
+            self.routing_matrix = np.zeros((0, 0), dtype=np.float32)
+            return
+
+        for name in self.agent_names:
+            if name in self._routing_embeddings:
+                continue
+            embs = self.embeddings_model.encode(
+                self.agents[name].routing_texts(),
+                prompt_name="paraphrase",
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            )
+            centroid = np.asarray(embs, dtype=np.float32).mean(axis=0)
+            self._routing_embeddings[name] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+        self.routing_matrix = np.stack([self._routing_embeddings[name] for name in self.agent_names])
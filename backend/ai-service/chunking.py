@@ -0,0 +1,95 @@
+"""
+Двухуровневое разбиение баз знаний: параграфы и предложения
+
+split_into_paragraphs режет базу знаний по строкам, поэтому длинная строка (например,
+инструкция "1) … 5) …") целиком попадает в контекст, даже если вопрос касается одного
+шага. Здесь каждый параграф дополнительно делится на предложения (razdel.sentenize),
+а нумерованные шаги внутри предложения — на отдельные фрагменты. Связь уровней
+хранится массивами: offsets[p]:offsets[p + 1] — предложения параграфа p,
+paragraph_ids[s] — параграф предложения s.
+
+Поиск сначала находит параграф, затем в контекст попадают только самые близкие
+к вопросу предложения этого параграфа (в исходном порядке, с заголовком параграфа),
+что сокращает промпт и время prefill.
+"""
+
+import re
+import logging
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+from razdel import sentenize
+
+from quantization import QuantizedEmbeddings
+
+logger = logging.getLogger(__name__)
+
+# Граница перед нумерованным шагом: "… кабели 2) Перезагрузите …"
+STEP_BOUNDARY_RE = re.compile(r"\s+(?=\d{1,2}\)\s)")
+MAX_TITLE_WORDS = 8
+
+
+def paragraph_title(paragraph: str) -> Optional[str]:
+    """Заголовок параграфа до двоеточия ("Ускорение интернета: …"), если он короткий"""
+    head, sep, _ = paragraph.partition(":")
+    if sep and 1 <= len(head.split()) <= MAX_TITLE_WORDS:
+        return head.strip()
+    return None
+
+
+def split_sentences(paragraph: str) -> List[str]:
+    """Предложения параграфа; нумерованные шаги внутри предложения разделяются"""
+    sentences = []
+    for sentence in sentenize(paragraph):
+        parts = [part.strip() for part in STEP_BOUNDARY_RE.split(sentence.text) if part.strip()]
+        # Вводная часть "Восстановление интернета:" остаётся с первым шагом
+        while len(parts) > 1 and parts[0].endswith(":"):
+            parts[:2] = [f"{parts[0]} {parts[1]}"]
+        sentences.extend(parts)
+    return sentences or [paragraph]
+
+
+def split_paragraphs(paragraphs: Sequence[str]) -> Tuple[List[str], NDArray]:
+    """Предложения всех параграфов подряд и смещения начала каждого параграфа"""
+    sentences: List[str] = []
+    offsets = np.zeros(len(paragraphs) + 1, dtype=np.int32)
+    for i, paragraph in enumerate(paragraphs):
+        sentences.extend(split_sentences(paragraph))
+        offsets[i + 1] = len(sentences)
+    return sentences, offsets
+
+
+class SentenceIndex:
+    """Предложения параграфов агента, их эмбеддинги и связь с параграфами"""
+
+    def __init__(self, sentences: List[str], offsets: NDArray, embeddings: QuantizedEmbeddings):
+        self.sentences = sentences
+        self.offsets = offsets
+        self.paragraph_ids = np.repeat(np.arange(len(offsets) - 1, dtype=np.int32), np.diff(offsets))
+        self.embeddings = embeddings
+
+    @property
+    def nbytes(self) -> int:
+        return self.embeddings.nbytes + self.offsets.nbytes + self.paragraph_ids.nbytes
+
+    def sentence_ids(self, paragraph_index: int) -> NDArray:
+        return np.arange(self.offsets[paragraph_index], self.offsets[paragraph_index + 1])
+
+    def select(self, paragraph_index: int, query_emb: NDArray, max_sentences: int) -> List[int]:
+        """Номера max_sentences предложений параграфа, ближайших к запросу, в исходном порядке"""
+        ids = self.sentence_ids(paragraph_index)
+        if len(ids) <= max_sentences:
+            return ids.tolist()
+        sims = self.embeddings[ids].scores(query_emb)
+        best = np.argpartition(-sims, max_sentences - 1)[:max_sentences]
+        return sorted(ids[best].tolist())
+
+    def context(self, paragraph: str, paragraph_index: int, query_emb: NDArray, max_sentences: int) -> str:
+        """Контекст из выбранных предложений параграфа; заголовок параграфа сохраняется"""
+        selected = self.select(paragraph_index, query_emb, max_sentences)
+        text = " ".join(self.sentences[i] for i in selected)
+        title = paragraph_title(paragraph)
+        if title and selected and selected[0] != self.offsets[paragraph_index]:
+            text = f"{title}: {text}"
+        return text
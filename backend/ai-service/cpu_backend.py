@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+CPU-бэкенд инференса для реплик без GPU
+
+На CPU адаптеры не подключаются к общей базовой модели на лету: для каждого агента
+заранее экспортируется модель с влитым адаптером (exported_models/<агент>), которую
+пул агентов загружает целиком. Веса хранятся в float32 или bf16 либо динамически
+квантуются в int8 (torch.ao). Число потоков и привязка к ядрам задаются явно, а
+статический KV-кэш избавляет генерацию от перевыделения памяти на каждом токене.
+
+Модель в quantized_model квантована bitsandbytes и на CPU не загружается, поэтому
+и сервису в режиме CPU, и экспорту нужна базовая модель в полной точности
+(CPU_BASE_MODEL / --base-model); без неё запуск завершается ошибкой.
+
+Использование:
+    python cpu_backend.py export [--agent Сеть] [--dtype bf16]
+    python cpu_backend.py bench --agent Сеть [--dtype int8] [--threads 8] [--affinity 0-7]
+"""
+
+import os
+import json
+import time
+import argparse
+import logging
+from typing import List, Optional
+
+from model_manifest import artifact_path
+
+logger = logging.getLogger(__name__)
+
+CPU_DTYPES = ("float32", "bf16", "int8")
+EXPORT_INFO_NAME = "export_info.json"
+
+
+def cpu_base_model_path() -> str:
+    """Базовая модель в полной точности для CPU (CPU_BASE_MODEL); quantized_model на CPU не загружается"""
+    path = os.getenv("CPU_BASE_MODEL", "")
+    if not path:
+        raise RuntimeError(
+            "Для CPU-бэкенда задайте CPU_BASE_MODEL — каталог базовой модели в полной точности "
+            "(quantized_model квантована bitsandbytes и на CPU не загружается) "
+            "или используйте INFERENCE_BACKEND=cuda на машине с GPU"
+        )
+    if not os.path.isdir(path):
+        raise RuntimeError(f"CPU_BASE_MODEL={path}: каталог не найден")
+    return path
+
+
+def parse_cpu_list(spec: str) -> List[int]:
+    """Разбирает список ядер вида "0-7,16,18-19" """
+    cpus = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def configure_threads(num_threads: int = 0, affinity: str = "") -> int:
+    """Привязывает процесс к ядрам и задаёт число потоков torch; возвращает число потоков"""
+    import torch
+
+    cpus = parse_cpu_list(affinity) if affinity else []
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    if num_threads <= 0:
+        available = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else range(os.cpu_count() or 1)
+        num_threads = len(cpus) or len(available)
+    torch.set_num_threads(num_threads)
+    try:
+        # Межоператорный параллелизм при генерации по одному запросу только мешает
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # Уже задано: вызов допустим только до первой параллельной операции
+    logger.info(f"CPU-бэкенд: {num_threads} потоков" + (f", ядра {affinity}" if cpus else ""))
+    return num_threads
+
+
+def load_cpu_model(model_path: str, dtype: str = "bf16", static_cache: bool = True):
+    """Загружает модель для инференса на CPU в заданном представлении весов"""
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    if dtype not in CPU_DTYPES:
+        raise ValueError(f"Неизвестный тип весов для CPU: {dtype}")
+    model = AutoModelForCausalLM.from_pretrained(
+        model_path,
+        torch_dtype=torch.bfloat16 if dtype == "bf16" else torch.float32,
+        low_cpu_mem_usage=True
+    )
+    if dtype == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.eval()
+    if static_cache:
+        model.generation_config.cache_implementation = "static"
+    return model
+
+
+def model_size_bytes(model) -> int:
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+def export_agent(base_model_path: str, spec, export_root: str, dtype: str = "bf16",
+                 max_shard_size: str = "2GB") -> str:
+    """Вливает адаптер агента в базовую модель и сохраняет результат в export_root/<агент>"""
+    import torch
+    from peft import PeftModel
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    start = time.time()
+    base_model = AutoModelForCausalLM.from_pretrained(
+        base_model_path,
+        torch_dtype=torch.bfloat16 if dtype == "bf16" else torch.float32,
+        low_cpu_mem_usage=True
+    )
+    merged = PeftModel.from_pretrained(base_model, spec.adapter_path).merge_and_unload()
+
+    out_dir = os.path.join(export_root, spec.name)
+    merged.save_pretrained(out_dir, safe_serialization=True, max_shard_size=max_shard_size)
+    AutoTokenizer.from_pretrained(spec.adapter_path).save_pretrained(out_dir)
+    with open(os.path.join(out_dir, EXPORT_INFO_NAME), "w", encoding="utf-8") as f:
+        json.dump({
+            "agent": spec.name,
+            "adapter_fingerprint": spec.adapter_fingerprint,
+            "base_model": os.path.basename(os.path.normpath(base_model_path)),
+            "dtype": "bf16" if dtype == "bf16" else "float32",
+            "exported_at": time.time(),
+        }, f, ensure_ascii=False, indent=2)
+    logger.info(f"Агент {spec.name} экспортирован в {out_dir} за {time.time() - start:.1f} с")
+    return out_dir
+
+
+def merged_model_path(export_root: Optional[str], agent: str, adapter_fingerprint: Optional[str] = None) -> Optional[str]:
+    """
+    Каталог экспортированной модели агента, если экспорт есть и (при переданном отпечатке)
+    сделан из текущего адаптера агента
+    """
+    if not export_root:
+        return None
+    path = os.path.join(export_root, agent)
+    info_path = os.path.join(path, EXPORT_INFO_NAME)
+    if not os.path.exists(info_path):
+        return None
+    if adapter_fingerprint is not None:
+        with open(info_path, "r", encoding="utf-8") as f:
+            exported = json.load(f).get("adapter_fingerprint")
+        if exported != adapter_fingerprint:
+            logger.warning(f"Экспорт агента {agent} в {path} сделан из другого адаптера, используется адаптер "
+                           f"из каталога агента (повторите python cpu_backend.py export --agent {agent})")
+            return None
+    return path
+
+
+def main():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Экспорт и бенчмарк CPU-бэкенда")
+    parser.add_argument("command", choices=["export", "bench"])
+    parser.add_argument("--agent", help="Агент (для export по умолчанию — все)")
+    parser.add_argument("--agents-dir", default=os.getenv("AGENTS_DIR", base_dir))
+    parser.add_argument("--base-model", default=os.getenv("CPU_BASE_MODEL"),
+                        help="Базовая модель в полной точности (по умолчанию CPU_BASE_MODEL)")
+    parser.add_argument("--export-dir", default=os.getenv("EXPORT_DIR", artifact_path("merged", os.path.join(base_dir, "exported_models"))))
+    parser.add_argument("--dtype", choices=CPU_DTYPES, default=os.getenv("CPU_DTYPE", "bf16"))
+    parser.add_argument("--threads", type=int, default=int(os.getenv("CPU_THREADS", 0)))
+    parser.add_argument("--affinity", default=os.getenv("CPU_AFFINITY", ""))
+    parser.add_argument("--questions", help="JSONL с вопросами {message, agent} для bench")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--max-new-tokens", type=int, default=150)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from agent_registry import AgentRegistry
+
+    registry = AgentRegistry(args.agents_dir)
+    registry.refresh()
+
+    if args.command == "export":
+        if not args.base_model:
+            parser.error("укажите --base-model или CPU_BASE_MODEL: quantized_model на CPU не загружается")
+        agents = [args.agent] if args.agent else registry.agent_names
+        # int8 получается при загрузке; на диск пишутся bf16-веса
+        dtype = "bf16" if args.dtype == "int8" else args.dtype
+        for agent in agents:
+            export_agent(args.base_model, registry[agent], args.export_dir, dtype=dtype)
+        return
+
+    import numpy as np
+    from transformers import AutoTokenizer
+    from decoding import SpeculativeDecoder, load_bench_questions, build_bench_prompts
+
+    if not args.agent:
+        parser.error("для bench укажите --agent")
+    spec = registry[args.agent]
+    model_path = merged_model_path(args.export_dir, spec.name, spec.adapter_fingerprint)
+    if model_path is None:
+        parser.error(f"нет экспорта агента {spec.name}, сначала выполните export")
+
+    threads = configure_threads(args.threads, args.affinity)
+    prompts = build_bench_prompts(spec, load_bench_questions(spec, args.questions, args.limit))
+    start = time.time()
+    model = load_cpu_model(model_path, args.dtype, static_cache=os.getenv("CPU_STATIC_CACHE", "1") == "1")
+    load_seconds = time.time() - start
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    decoder = SpeculativeDecoder()
+    decoder.generate(model, tokenizer, prompts[0], args.max_new_tokens)  # прогрев
+    stats = [decoder.generate(model, tokenizer, prompt, args.max_new_tokens)[1] for prompt in prompts]
+    latencies_ms = np.array([s.duration for s in stats]) * 1000
+    report = {
+        "agent": spec.name,
+        "dtype": args.dtype,
+        "threads": threads,
+        "model_bytes": model_size_bytes(model),
+        "load_seconds": round(load_seconds, 2),
+        "questions": len(prompts),
+        "latency_ms_p50": round(float(np.percentile(latencies_ms, 50)), 1),
+        "latency_ms_p99": round(float(np.percentile(latencies_ms, 99)), 1),
+        "tokens_per_second": round(sum(s.new_tokens for s in stats) / max(sum(s.duration for s in stats), 1e-9), 2),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Спекулятивное декодирование ответов агентов
+
+Режим задаётся для агента полем "decoding" в agents.json ({"mode": "prompt_lookup", "num_tokens": 10})
+или для всех агентов переменной DECODING_MODE:
+- plain — обычная генерация с теми же параметрами, что и pipeline text-generation;
+- prompt_lookup — черновые токены подбираются n-граммами из промпта: ответ часто
+  дословно повторяет фразы из параграфа контекста;
+- draft — черновые токены предлагает малая модель DRAFT_MODEL_PATH с тем же токенизатором.
+Черновик проверяется одним проходом модели агента (база + LoRA), поэтому при жадном
+декодировании ответ совпадает с обычной генерацией.
+
+Доля принятых токенов считается по числу проходов модели агента: каждый проход даёт
+один собственный токен, остальные токены ответа — принятые токены черновика.
+
+Бенчмарк режимов на вопросах агента:
+    python decoding.py bench --agent Сеть [--questions labelled.jsonl] [--modes plain,prompt_lookup,draft]
+"""
+
+import os
+import json
+import time
+import argparse
+import logging
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from metrics import ai_decoding_duration_seconds, ai_decoding_tokens_per_step, ai_decoding_tokens_total
+from model_manifest import artifact_path
+
+logger = logging.getLogger(__name__)
+
+DECODING_MODES = ("plain", "prompt_lookup", "draft")
+
+# Параметры генерации ответа агента (совпадают с прежним вызовом pipeline)
+GENERATION_KWARGS = {"temperature": 0.1, "top_p": 0.95, "repetition_penalty": 1.1}
+
+
+class GenerationStats:
+    def __init__(self, mode: str, new_tokens: int, steps: int, duration: float):
+        self.mode = mode
+        self.new_tokens = new_tokens
+        self.steps = steps  # Проходы модели агента, включая обработку промпта
+        self.duration = duration
+
+    @property
+    def accepted_tokens(self) -> int:
+        return max(self.new_tokens - self.steps, 0)
+
+    @property
+    def acceptance_rate(self) -> float:
+        """Доля токенов ответа, предложенных черновиком и принятых моделью"""
+        return self.accepted_tokens / self.new_tokens if self.new_tokens else 0.0
+
+    @property
+    def tokens_per_step(self) -> float:
+        return self.new_tokens / self.steps if self.steps else 0.0
+
+
+@contextmanager
+def count_forward_calls(model):
+    """Считает проходы модели агента (черновая модель — отдельный модуль и не учитывается)"""
+    target = model.get_base_model() if hasattr(model, "get_base_model") else model
+    calls = [0]
+
+    def hook(module, inputs, outputs):
+        calls[0] += 1
+
+    handle = target.register_forward_hook(hook)
+    try:
+        yield calls
+    finally:
+        handle.remove()
+
+
+class SpeculativeDecoder:
+    """Генерация ответа агента в выбранном режиме с метриками принятия черновика"""
+
+    def __init__(self, default_mode: str = "plain", prompt_lookup_tokens: int = 10,
+                 draft_model_path: Optional[str] = None, draft_tokens: int = 5):
+        if default_mode not in DECODING_MODES:
+            raise ValueError(f"Неизвестный режим декодирования: {default_mode}")
+        self.default_mode = default_mode
+        self.prompt_lookup_tokens = prompt_lookup_tokens
+        self.draft_model_path = draft_model_path
+        self.draft_tokens = draft_tokens
+        self._draft_model = None
+        self._draft_failed = False
+
+    def resolve(self, decoding: Optional[Dict[str, Any]] = None) -> Tuple[str, Dict[str, Any]]:
+        """Режим и параметры агента; неизвестный режим заменяется режимом по умолчанию"""
+        options = dict(decoding or {})
+        mode = options.pop("mode", self.default_mode)
+        if mode not in DECODING_MODES:
+            logger.warning(f"Неизвестный режим декодирования {mode}, используется {self.default_mode}")
+            mode = self.default_mode
+        return mode, options
+
+    def draft_model(self):
+        """Загружает черновую модель при первом обращении; None, если её нет"""
+        if self._draft_model is None and not self._draft_failed:
+            if not self.draft_model_path or not os.path.exists(self.draft_model_path):
+                logger.warning(f"Черновая модель {self.draft_model_path} не найдена, режим draft заменяется на plain")
+                self._draft_failed = True
+                return None
+            from transformers import AutoModelForCausalLM
+
+            start = time.time()
+            self._draft_model = AutoModelForCausalLM.from_pretrained(self.draft_model_path)
+            self._draft_model.eval()
+            logger.info(f"Черновая модель загружена за {time.time() - start:.2f} с")
+        return self._draft_model
+
+    def generate(self, model, tokenizer, prompt: str, max_new_tokens: int,
+                 decoding: Optional[Dict[str, Any]] = None) -> Tuple[str, GenerationStats]:
+        import torch
+
+        mode, options = self.resolve(decoding)
+        kwargs = dict(GENERATION_KWARGS, max_new_tokens=max_new_tokens, pad_token_id=tokenizer.pad_token_id)
+        if mode != "plain":
+            # Статический KV-кэш (CPU-бэкенд) несовместим с проверкой черновика
+            kwargs["cache_implementation"] = None
+        if mode == "prompt_lookup":
+            kwargs["prompt_lookup_num_tokens"] = int(options.get("num_tokens", self.prompt_lookup_tokens))
+        elif mode == "draft":
+            draft = self.draft_model()
+            if draft is None:
+                mode = "plain"
+            else:
+                if draft.device != model.device:
+                    draft.to(model.device)
+                draft.generation_config.num_assistant_tokens = int(options.get("num_tokens", self.draft_tokens))
+                kwargs["assistant_model"] = draft
+
+        inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+        start = time.time()
+        with torch.no_grad(), count_forward_calls(model) as calls:
+            output = model.generate(**inputs, **kwargs)
+        duration = time.time() - start
+
+        new_tokens = output[0, inputs["input_ids"].shape[1]:]
+        stats = GenerationStats(mode, int(new_tokens.shape[0]), calls[0], duration)
+        ai_decoding_duration_seconds.labels(mode=mode).observe(duration)
+        if stats.steps:
+            ai_decoding_tokens_per_step.labels(mode=mode).observe(stats.tokens_per_step)
+        ai_decoding_tokens_total.labels(mode=mode, source="target").inc(stats.new_tokens - stats.accepted_tokens)
+        ai_decoding_tokens_total.labels(mode=mode, source="draft").inc(stats.accepted_tokens)
+        logger.info(f"Декодирование {mode}: {stats.new_tokens} токенов за {stats.steps} проходов, "
+                    f"принято черновика {stats.acceptance_rate:.0%}, {duration:.2f} с")
+        return tokenizer.decode(new_tokens, skip_special_tokens=True), stats
+
+
+def decoder_from_env(base_dir: str) -> SpeculativeDecoder:
+    return SpeculativeDecoder(
+        default_mode=os.getenv("DECODING_MODE", "plain"),
+        prompt_lookup_tokens=int(os.getenv("PROMPT_LOOKUP_TOKENS", 10)),
+        draft_model_path=os.getenv("DRAFT_MODEL_PATH", os.path.join(base_dir, "draft_model")),
+        draft_tokens=int(os.getenv("DRAFT_TOKENS", 5)),
+    )
+
+
+# --- Бенчмарк ---
+def load_bench_questions(spec, questions_path: Optional[str], limit: int) -> List[str]:
+    if questions_path:
+        from router import read_labelled_jsonl
+
+        questions = [r["message"] for r in read_labelled_jsonl(questions_path) if r.get("agent") in (None, spec.name)]
+    else:
+        questions = list(spec.sample_questions)
+    return questions[:limit]
+
+
+def build_bench_prompts(spec, questions: List[str]) -> List[str]:
+    """Промпты с лучшим параграфом базы знаний в качестве контекста, как в сервисе"""
+    from router import load_embeddings_model, encode
+    from prompts import render_chat_with_context
+
+    emb_model = load_embeddings_model()
+    paragraphs = spec.load_paragraphs()
+    sims = encode(emb_model, questions, "search_query") @ encode(emb_model, paragraphs, "search_document").T
+    return [
+        render_chat_with_context([], question, paragraphs[int(best)], "Пользователь")
+        for question, best in zip(questions, sims.argmax(axis=1))
+    ]
+
+
+def _summarize(mode: str, stats: List[GenerationStats], outputs: List[str], reference: Optional[List[str]]) -> Dict:
+    latencies_ms = np.array([s.duration for s in stats]) * 1000
+    new_tokens = sum(s.new_tokens for s in stats)
+    report = {
+        "mode": mode,
+        "latency_ms_p50": round(float(np.percentile(latencies_ms, 50)), 1),
+        "latency_ms_p99": round(float(np.percentile(latencies_ms, 99)), 1),
+        "tokens_per_second": round(new_tokens / max(sum(s.duration for s in stats), 1e-9), 1),
+        "tokens_per_step": round(new_tokens / max(sum(s.steps for s in stats), 1), 3),
+        "acceptance_rate": round(sum(s.accepted_tokens for s in stats) / max(new_tokens, 1), 3),
+    }
+    if reference is not None:
+        report["same_as_plain"] = round(float(np.mean([a == b for a, b in zip(outputs, reference)])), 3)
+    return report
+
+
+def main():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Бенчмарк спекулятивного декодирования")
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--agent", required=True)
+    parser.add_argument("--agents-dir", default=os.getenv("AGENTS_DIR", base_dir))
+    parser.add_argument("--questions", help="JSONL с вопросами {message, agent}; по умолчанию примеры из agents.json")
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--modes", default="plain,prompt_lookup,draft")
+    parser.add_argument("--max-new-tokens", type=int, default=150)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from peft import PeftModel
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+    from agent_registry import AgentRegistry
+
+    registry = AgentRegistry(args.agents_dir)
+    registry.refresh()
+    spec = registry[args.agent]
+    questions = load_bench_questions(spec, args.questions, args.limit)
+    prompts = build_bench_prompts(spec, questions)
+
+    base_model = AutoModelForCausalLM.from_pretrained(artifact_path("quantized_model", os.path.join(base_dir, "quantized_model")))
+    model = PeftModel.from_pretrained(base_model, spec.adapter_path, adapter_name=spec.name)
+    model.eval()
+    tokenizer = AutoTokenizer.from_pretrained(spec.adapter_path)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    decoder = decoder_from_env(base_dir)
+    modes = [mode for mode in args.modes.split(",") if mode]
+    report = {"agent": spec.name, "questions": len(prompts), "results": []}
+    reference = None
+    for mode in modes:
+        decoder.generate(model, tokenizer, prompts[0], args.max_new_tokens, {"mode": mode})  # прогрев
+        stats, outputs = [], []
+        for prompt in prompts:
+            text, generation_stats = decoder.generate(model, tokenizer, prompt, args.max_new_tokens, {"mode": mode})
+            outputs.append(text.strip())
+            stats.append(generation_stats)
+        if stats[0].mode != mode:
+            logger.warning(f"Режим {mode} недоступен, пропущен")
+            continue
+        report["results"].append(_summarize(mode, stats, outputs, reference))
+        if mode == "plain":
+            reference = outputs
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
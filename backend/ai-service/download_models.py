@@ -2,13 +2,32 @@
 """
 Скрипт для загрузки моделей с HuggingFace Hub
 Запускается автоматически при старте контейнера, если модели не найдены локально
+
+Модели загружаются параллельно (и репозитории, и файлы внутри них). Каждый файл
+сверяется с манифестом (model_manifest.json репозитория, а без него — размеры и
+sha256 LFS-файлов из дерева репозитория). Недокачанные файлы лежат рядом с расширением
+.part и при следующем запуске докачиваются с места обрыва. Если задан MODEL_MIRROR_DIR
+(каталог с подкаталогами quantized_model, frida_embedding_model), файлы сначала
+берутся оттуда — так модели прогреваются из локального кэша без сети.
+
+Итог загрузки (источник, объём, время, скорость) пишется в download_report.json.
 """
 
 import os
+import sys
+import json
+import time
+import shutil
 import logging
-from huggingface_hub import snapshot_download
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from huggingface_hub import HfApi, hf_hub_url, hf_hub_download
+from huggingface_hub.utils import build_hf_headers
 from pathlib import Path
 
+from model_manifest import MANIFEST_NAME, read_manifest, missing_or_corrupt, verify_file
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -24,38 +43,182 @@ MODELS_CONFIG = {
     },
 }
 
+# Проверять sha256 каждого файла (VERIFY_HASHES=0 — только размеры, быстрее на больших моделях)
+VERIFY_HASHES = os.getenv("VERIFY_HASHES", "1") == "1"
+MODEL_MIRROR_DIR = os.getenv("MODEL_MIRROR_DIR", "")
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", 4))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", 3))
+DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", 60))
+CHUNK_BYTES = 1024 * 1024
+REPORT_NAME = "download_report.json"
+
+def files_to_download(local_path):
+    """Файлы из манифеста, которых нет локально или которые повреждены; None — манифеста нет"""
+    manifest = read_manifest(local_path)
+    if manifest is None:
+        return None
+    return missing_or_corrupt(local_path, manifest, check_hash=VERIFY_HASHES)
+
 def model_exists(local_path):
-    """Проверяет наличие модели локально"""
-    path = Path(local_path)
-    if not path.exists():
+    """
+    Проверяет наличие модели локально. Модель считается загруженной только по манифесту:
+    каталог без манифеста (загрузка до манифестов или прерванная до его записи) сверяется
+    с эталоном заново, уже загруженные файлы при этом не перекачиваются.
+    """
+    if not Path(local_path).exists():
         return False
 
-    # Проверяем наличие ключевых файлов
-    required_files = ["config.json"]
-    for file in required_files:
-        if not (path / file).exists():
-            return False
+    missing = files_to_download(local_path)
+    if missing is None:
+        logger.info(f"В {local_path} нет манифеста, файлы будут сверены с эталоном")
+        return False
+    if missing:
+        logger.warning(f"В {local_path} отсутствуют или повреждены файлы: {', '.join(missing)}")
+    return not missing
+
+def resolve_manifest(repo_id, local_path) -> Tuple[Dict, str]:
+    """Эталонный манифест: из зеркала, из репозитория или по дереву файлов репозитория"""
+    if MODEL_MIRROR_DIR:
+        manifest = read_manifest(os.path.join(MODEL_MIRROR_DIR, local_path))
+        if manifest is not None:
+            return manifest, "mirror"
+
+    try:
+        manifest_path = hf_hub_download(repo_id=repo_id, filename=MANIFEST_NAME)
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f), "hub"
+    except Exception as e:
+        logger.info(f"В {repo_id} нет манифеста ({e}), используется дерево репозитория")
+
+    files = {}
+    for item in HfApi().list_repo_tree(repo_id, recursive=True):
+        size = getattr(item, "size", None)
+        if size is None:
+            continue  # Каталог
+        lfs = getattr(item, "lfs", None)
+        sha256 = (lfs.get("sha256") if isinstance(lfs, dict) else getattr(lfs, "sha256", None)) if lfs else None
+        files[item.path] = {"size": size, "sha256": sha256}
+    return {"version": 1, "created_at": time.time(), "files": files}, "tree"
 
-    return True
+class FileFetcher:
+    """Загрузка одного файла в <файл>.part с докачкой, проверкой и повторами"""
+
+    def __init__(self, repo_id, local_path):
+        self.repo_id = repo_id
+        self.local_path = local_path
+        self.mirror_path = os.path.join(MODEL_MIRROR_DIR, local_path) if MODEL_MIRROR_DIR else None
+
+    def fetch(self, rel_path, entry) -> Dict:
+        dest = os.path.join(self.local_path, rel_path)
+        part = dest + ".part"
+        os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+        resumed_bytes = None
+
+        for attempt in range(1, DOWNLOAD_RETRIES + 1):
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            if offset > entry["size"]:
+                os.remove(part)
+                offset = 0
+            if resumed_bytes is None:
+                resumed_bytes = offset
+            if offset == entry["size"]:
+                # Файл докачан целиком, но не переименован: запрос Range с его размером хаб отклонит (416)
+                if verify_file(self.local_path, os.path.relpath(part, self.local_path), entry, VERIFY_HASHES):
+                    os.replace(part, dest)
+                    return {"bytes": 0, "resumed_bytes": resumed_bytes, "source": "part"}
+                logger.warning(f"Недокачанный файл {part} не прошёл проверку, загрузка начнётся заново")
+                os.remove(part)
+                offset = 0
+            try:
+                source = self._from_mirror(rel_path, entry, part, offset) or self._from_hub(rel_path, part, offset)
+                if not verify_file(self.local_path, os.path.relpath(part, self.local_path), entry, VERIFY_HASHES):
+                    os.remove(part)
+                    raise IOError(f"файл {rel_path} не прошёл проверку размера/хэша")
+                os.replace(part, dest)
+                return {"bytes": entry["size"] - offset, "resumed_bytes": resumed_bytes, "source": source}
+            except Exception as e:
+                logger.warning(f"Попытка {attempt}/{DOWNLOAD_RETRIES} загрузки {rel_path} не удалась: {e}")
+                time.sleep(min(2 ** attempt, 30))
+        raise IOError(f"Не удалось загрузить {rel_path} из {self.repo_id}")
+
+    def _from_mirror(self, rel_path, entry, part, offset) -> Optional[str]:
+        if not self.mirror_path:
+            return None
+        source_path = os.path.join(self.mirror_path, rel_path)
+        if not os.path.isfile(source_path) or os.path.getsize(source_path) != entry["size"]:
+            return None
+        with open(source_path, "rb") as src, open(part, "ab") as dst:
+            src.seek(offset)
+            shutil.copyfileobj(src, dst, CHUNK_BYTES)
+        return "mirror"
+
+    def _from_hub(self, rel_path, part, offset) -> str:
+        import requests
+
+        headers = build_hf_headers()
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+        url = hf_hub_url(self.repo_id, rel_path)
+        with requests.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            if offset and response.status_code == 416:
+                # Диапазон не принят (файл в репозитории изменился) — качаем заново с начала
+                logger.warning(f"Хаб отклонил докачку {rel_path} с {offset} байт, загрузка начнётся заново")
+                os.remove(part)
+                return self._from_hub(rel_path, part, 0)
+            response.raise_for_status()
+            # Сервер без поддержки Range отдаёт файл целиком — начинаем заново
+            mode = "ab" if offset and response.status_code == 206 else "wb"
+            with open(part, mode) as f:
+                for chunk in response.iter_content(CHUNK_BYTES):
+                    f.write(chunk)
+        return "hub"
 
 def download_model(repo_id, local_path, model_type="model"):
-    """Загружает модель с HuggingFace Hub"""
+    """Загружает модель с HuggingFace Hub (или из зеркала) и возвращает отчёт о загрузке"""
+    start = time.time()
+    report = {"repo_id": repo_id, "local_path": local_path, "status": "ok", "files": 0,
+              "bytes": 0, "resumed_bytes": 0, "sources": {}}
     try:
         logger.info(f"Загрузка {model_type} из {repo_id} в {local_path}...")
+        manifest, manifest_source = resolve_manifest(repo_id, local_path)
+        report["manifest"] = manifest_source
+        os.makedirs(local_path, exist_ok=True)
+        # Эталонный манифест пишется до загрузки: если она прервётся, следующий запуск
+        # увидит недостающие файлы по манифесту и докачает их
+        with open(os.path.join(local_path, MANIFEST_NAME), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
 
-        snapshot_download(
-            repo_id=repo_id,
-            local_dir=local_path,
-            local_dir_use_symlinks=False,
-            resume_download=True,
-        )
+        pending = missing_or_corrupt(local_path, manifest, check_hash=VERIFY_HASHES)
+        logger.info(f"Требуется загрузить {len(pending)} из {len(manifest['files'])} файлов {repo_id}")
+        fetcher = FileFetcher(repo_id, local_path)
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+            results = list(pool.map(lambda rel_path: fetcher.fetch(rel_path, manifest["files"][rel_path]), pending))
+
+        for result in results:
+            report["files"] += 1
+            report["bytes"] += result["bytes"]
+            report["resumed_bytes"] += result["resumed_bytes"]
+            report["sources"][result["source"]] = report["sources"].get(result["source"], 0) + 1
 
         logger.info(f"✓ {model_type} успешно загружена в {local_path}")
-        return True
 
     except Exception as e:
         logger.error(f"Ошибка загрузки {model_type} из {repo_id}: {e}")
-        return False
+        report["status"] = "error"
+        report["error"] = str(e)
+
+    report["seconds"] = round(time.time() - start, 2)
+    report["throughput_mb_s"] = round(report["bytes"] / 1024 / 1024 / max(report["seconds"], 1e-3), 2)
+    return report
+
+def ensure_model(name, model_type):
+    config = MODELS_CONFIG[name]
+    start = time.time()
+    if model_exists(config["local_path"]):
+        logger.info(f"{model_type} уже загружена")
+        return {"repo_id": config["repo_id"], "local_path": config["local_path"], "status": "present",
+                "seconds": round(time.time() - start, 2)}
+    return download_model(config["repo_id"], config["local_path"], model_type)
 
 def main():
     """Основная функция для загрузки моделей"""
@@ -63,27 +226,30 @@ def main():
     os.chdir(base_dir)
 
     logger.info("Проверка и загрузка моделей...")
+    start = time.time()
+
+    # Базовая и embedding модели загружаются одновременно
+    with ThreadPoolExecutor(max_workers=len(MODELS_CONFIG)) as pool:
+        futures = {
+            "quantized_model": pool.submit(ensure_model, "quantized_model", "Базовая модель"),
+            "frida_embedding_model": pool.submit(ensure_model, "frida_embedding_model", "Embedding модель"),
+        }
+        models = {name: future.result() for name, future in futures.items()}
 
-    # Загружаем базовую модель
-    if not model_exists(MODELS_CONFIG["quantized_model"]["local_path"]):
-        download_model(
-            MODELS_CONFIG["quantized_model"]["repo_id"],
-            MODELS_CONFIG["quantized_model"]["local_path"],
-            "Базовая модель"
-        )
-    else:
-        logger.info("Базовая модель уже загружена")
-
-    # Загружаем embedding модель
-    if not model_exists(MODELS_CONFIG["frida_embedding_model"]["local_path"]):
-        download_model(
-            MODELS_CONFIG["frida_embedding_model"]["repo_id"],
-            MODELS_CONFIG["frida_embedding_model"]["local_path"],
-            "Embedding модель"
-        )
-    else:
-        logger.info("Embedding модель уже загружена")
+    report = {
+        "started_at": start,
+        "seconds": round(time.time() - start, 2),
+        "bytes": sum(model.get("bytes", 0) for model in models.values()),
+        "models": models,
+    }
+    report["throughput_mb_s"] = round(report["bytes"] / 1024 / 1024 / max(report["seconds"], 1e-3), 2)
+    with open(os.path.join(base_dir, REPORT_NAME), "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logger.info(f"Загрузка моделей: {report['bytes'] / 1024 / 1024:.1f} МБ за {report['seconds']} с "
+                f"({report['throughput_mb_s']} МБ/с), отчёт — {REPORT_NAME}")
 
+    if any(model["status"] == "error" for model in models.values()):
+        sys.exit(1)
     logger.info("Все модели готовы к использованию!")
 
 if __name__ == "__main__":
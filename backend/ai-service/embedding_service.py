@@ -0,0 +1,210 @@
+"""
+Сервис эмбеддингов: общий энкодер FRIDA с микро-батчингом запросов
+
+Эмбеддинги запрашиваются из многих мест (особые случаи, маршрутизация, поиск, проверка
+ответа), каждый раз по одной строке. EmbeddingService подменяет SentenceTransformer
+для всех этих мест (тот же метод encode). Единственный вызывающий поток кодирует в
+самом себе, без передачи в рабочий поток. Когда encode вызывают одновременно несколько
+потоков, запросы ставятся в общую очередь, рабочий поток собирает их в батч и кодирует
+одним вызовом модели. Батч ждёт других запросов не дольше max_wait_ms и только пока есть
+потоки, которые ещё могут в него попасть. Большие вызовы (параграфы базы знаний)
+кодируются сразу, без очереди.
+
+Консьюмер обрабатывает сообщения в одном потоке, поэтому батчи между потоками
+собираются только при параллельных вызовах. Повторные эмбеддинги одного запроса
+внутри обработки не кодируются: retriever.encode_query хранит их по prompt_name.
+
+Оптимизированный энкодер для CPU-реплик (EMBEDDING_BACKEND):
+- torch — SentenceTransformer как есть;
+- onnx — ONNX Runtime (onnx/model.onnx в каталоге модели);
+- onnx-int8 — динамически квантованная int8-модель ONNX.
+Модели ONNX собираются локально: python export_models.py build --targets embedding
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from numpy.typing import NDArray
+from sentence_transformers import SentenceTransformer
+
+from metrics import ai_embedding_batch_size, ai_embedding_queue_wait_seconds
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx-int8")
+ONNX_FILE = "onnx/model.onnx"
+# Набор инструкций для int8-квантования: arm64, avx2, avx512, avx512_vnni
+ONNX_QUANTIZATION = os.getenv("EMBEDDING_ONNX_QUANTIZATION", "avx512_vnni")
+
+
+def onnx_int8_file(quantization: str = ONNX_QUANTIZATION) -> str:
+    return f"onnx/model_qint8_{quantization}.onnx"
+
+
+def load_embedding_model(path: str, device: str, backend: str = "torch") -> SentenceTransformer:
+    """Загружает энкодер; если файла ONNX нет, используется torch"""
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Неизвестный бэкенд эмбеддингов: {backend}")
+    if backend != "torch":
+        file_name = ONNX_FILE if backend == "onnx" else onnx_int8_file()
+        if os.path.exists(os.path.join(path, file_name)):
+            logger.info(f"Энкодер эмбеддингов: ONNX Runtime, {file_name}")
+            return SentenceTransformer(path, device="cpu", backend="onnx", model_kwargs={"file_name": file_name})
+        logger.warning(f"Нет {file_name} в {path} (python export_models.py build --targets embedding), используется torch")
+    return SentenceTransformer(path, device=device)
+
+
+def export_onnx(path: str, quantization: Optional[str] = ONNX_QUANTIZATION) -> List[str]:
+    """Экспортирует энкодер в ONNX (и int8-вариант) в каталог модели; нужен optimum[onnxruntime]"""
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    start = time.time()
+    model = SentenceTransformer(path, device="cpu", backend="onnx")
+    model.save_pretrained(path)
+    files = [ONNX_FILE]
+    if quantization:
+        export_dynamic_quantized_onnx_model(model, quantization, path)
+        files.append(onnx_int8_file(quantization))
+    logger.info(f"Энкодер экспортирован в ONNX ({', '.join(files)}) за {time.time() - start:.1f} с")
+    return files
+
+
+class _EncodeRequest:
+    __slots__ = ("texts", "key", "enqueued_at", "done", "result", "error")
+
+    def __init__(self, texts: List[str], key: Tuple):
+        self.texts = texts
+        self.key = key
+        self.enqueued_at = time.perf_counter()
+        self.done = threading.Event()
+        self.result: Optional[NDArray] = None
+        self.error: Optional[BaseException] = None
+
+
+class EmbeddingService:
+    """Очередь запросов к энкодеру с микро-батчингом; интерфейс encode как у SentenceTransformer"""
+
+    def __init__(self, model: SentenceTransformer, max_batch: int = 32, max_wait_ms: float = 2.0):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue: "queue.Queue[Optional[_EncodeRequest]]" = queue.Queue()
+        self._model_lock = threading.Lock()
+        self._inflight = 0  # Запросы, поставленные или готовящиеся встать в очередь
+        self._callers = 0  # Потоки внутри encode (и в очереди, и кодирующие сами)
+        self._inflight_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def __getattr__(self, name: str) -> Any:
+        # Остальные атрибуты (get_sentence_embedding_dimension, device, …) — от модели
+        if name == "model":
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def start(self) -> "EmbeddingService":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="embedding-service", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def encode(self, sentences: Union[str, List[str]], prompt_name: Optional[str] = None,
+               convert_to_numpy: bool = True, normalize_embeddings: bool = False,
+               batch_size: int = 32, **kwargs) -> NDArray:
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if (kwargs or not convert_to_numpy or self._thread is None or len(texts) >= self.max_batch
+                or threading.current_thread() is self._thread):
+            # Нестандартные параметры и большие вызовы — напрямую, без очереди
+            with self._model_lock:
+                return self.model.encode(sentences, prompt_name=prompt_name, convert_to_numpy=convert_to_numpy,
+                                         normalize_embeddings=normalize_embeddings, batch_size=batch_size, **kwargs)
+
+        with self._inflight_lock:
+            self._callers += 1
+            alone = self._callers == 1
+            if not alone:
+                self._inflight += 1
+        try:
+            if alone:
+                # Других вызывающих нет — батчить не с чем, кодируем в этом же потоке
+                with self._model_lock:
+                    return self.model.encode(sentences, prompt_name=prompt_name, convert_to_numpy=True,
+                                             normalize_embeddings=normalize_embeddings, batch_size=batch_size)
+            request = _EncodeRequest(texts, (prompt_name, normalize_embeddings))
+            self._queue.put(request)
+            request.done.wait()
+        finally:
+            with self._inflight_lock:
+                self._callers -= 1
+                if not alone:
+                    self._inflight -= 1
+        if request.error is not None:
+            raise request.error
+        return request.result[0] if single else request.result
+
+    # --- Рабочий поток ---
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            size = len(first.texts)
+            deadline = first.enqueued_at + self.max_wait
+            # Ждём, пока батч не заполнен и есть потоки, чьи запросы ещё не собраны
+            while size < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if self._queue.empty() and (self._inflight <= len(batch) or remaining <= 0):
+                    break
+                try:
+                    request = self._queue.get(timeout=max(remaining, 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._queue.put(None)
+                    break
+                batch.append(request)
+                size += len(request.texts)
+            self._encode_batch(batch)
+
+    def _encode_batch(self, batch: List[_EncodeRequest]):
+        now = time.perf_counter()
+        groups: Dict[Tuple, List[_EncodeRequest]] = defaultdict(list)
+        for request in batch:
+            ai_embedding_queue_wait_seconds.observe(now - request.enqueued_at)
+            groups[request.key].append(request)
+        for (prompt_name, normalize), requests in groups.items():
+            texts = [text for request in requests for text in request.texts]
+            ai_embedding_batch_size.observe(len(texts))
+            try:
+                with self._model_lock:
+                    embeddings = np.asarray(self.model.encode(
+                        texts,
+                        prompt_name=prompt_name,
+                        batch_size=max(len(texts), 1),
+                        convert_to_numpy=True,
+                        normalize_embeddings=normalize
+                    ))
+            except Exception as e:
+                logger.error(f"Ошибка кодирования батча эмбеддингов ({len(texts)} текстов): {e}")
+                for request in requests:
+                    request.error = e
+                    request.done.set()
+                continue
+            offset = 0
+            for request in requests:
+                request.result = embeddings[offset:offset + len(request.texts)]
+                offset += len(request.texts)
+                request.done.set()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Оценка качества и скорости поиска по базам знаний агентов
+
+Пары вопрос→параграф синтезируются из баз знаний (<агент>.txt): вопросом служит
+заголовок параграфа до двоеточия ("Ускорение интернета: ..."), а без заголовка —
+начало первого предложения. Такие вопросы лексически близки к тексту, поэтому
+дополнительно можно передать размеченный набор (--questions, JSONL с полями message,
+agent и необязательным paragraph — точным текстом ожидаемого параграфа).
+
+Вопросы прогоняются через ParagraphRetriever теми же путями, что и в сервисе:
+- маршрутизация (route_query) — точность выбора агента;
+- поиск в базе правильного агента (search_agent) — recall@k и MRR;
+- глобальный поиск по всем агентам (search_all_agents, RETRIEVAL_MODE=global);
+- весь путь сервиса: агент по маршрутизации и лучший параграф выше порога.
+Для каждого пути считаются задержки p50/p99. Отчёт — JSON по агентам и в целом;
+условия --gate (например overall.recall@1>=0.8) превращают его в проверку:
+при невыполнении любого условия команда завершается с кодом 1.
+
+Использование:
+    python evaluate.py [--questions labelled.jsonl] [--per-agent 50] [--output report.json]
+    python evaluate.py --gate overall.recall@1>=0.8 --gate overall.pipeline_latency_ms_p99<=50
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from razdel import sentenize
+
+from agent_registry import AgentRegistry
+from chunking import paragraph_title
+from lexical_index import FUSION_MODES
+from router import load_router, load_embeddings_model, read_labelled_jsonl
+
+logger = logging.getLogger(__name__)
+
+RECALL_KS = (1, 3, 5, 10)
+GATE_OPERATORS = (">=", "<=")
+
+
+def synthesize_question(paragraph: str) -> Optional[str]:
+    """Вопрос к параграфу: его заголовок или начало первого предложения"""
+    title = paragraph_title(paragraph)
+    if title:
+        return title
+    sentences = [s.text for s in sentenize(paragraph)]
+    words = sentences[0].split() if sentences else []
+    if len(words) < 3:
+        return None
+    return " ".join(words[:12]).rstrip(".,;:!?")
+
+
+def synthesize_pairs(registry: AgentRegistry, per_agent: int = 0, seed: int = 0) -> List[Dict]:
+    """Пары {message, agent, paragraph} по всем базам знаний; per_agent > 0 — случайная выборка"""
+    rng = np.random.default_rng(seed)
+    pairs = []
+    for name in registry.agent_names:
+        spec = registry[name]
+        if not os.path.exists(spec.file_path):
+            continue
+        agent_pairs = []
+        for paragraph in spec.load_paragraphs():
+            question = synthesize_question(paragraph)
+            if question:
+                agent_pairs.append({"message": question, "agent": name, "paragraph": paragraph, "source": "synthetic"})
+        if 0 < per_agent < len(agent_pairs):
+            agent_pairs = [agent_pairs[i] for i in sorted(rng.choice(len(agent_pairs), per_agent, replace=False))]
+        pairs.extend(agent_pairs)
+    return pairs
+
+
+def load_labelled_pairs(path: str, registry: AgentRegistry) -> List[Dict]:
+    records = [r for r in read_labelled_jsonl(path) if r.get("agent") in registry]
+    return [
+        {"message": r["message"], "agent": r["agent"], "paragraph": r.get("paragraph"), "source": "labelled"}
+        for r in records
+    ]
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def _rank(hits: List[Tuple], gold: set) -> Optional[int]:
+    """Позиция (с 1) первого правильного параграфа в выдаче"""
+    for position, hit in enumerate(hits, start=1):
+        if hit in gold:
+            return position
+    return None
+
+
+def evaluate_pair(retriever, pair: Dict, top_k: int) -> Dict:
+    """Прогоняет один вопрос через все пути поиска и возвращает ранги и задержки"""
+    agent, query = pair["agent"], pair["message"]
+    paragraphs = retriever.paragraphs.get(agent, [])
+    gold = {i for i, text in enumerate(paragraphs) if pair.get("paragraph") and text == pair["paragraph"].strip()}
+    result = {"agent": agent, "has_gold": bool(gold)}
+
+    (routed, _), result["routing_ms"] = _timed(retriever.route_query, query)
+    result["routing_correct"] = routed == agent
+
+    if gold:
+        hits, result["search_ms"] = _timed(retriever.search_agent, agent, query, top_k)
+        result["rank"] = _rank([index for index, _ in hits], gold)
+        global_hits, result["global_ms"] = _timed(retriever.search_all_agents, query, top_k)
+        result["global_rank"] = _rank([(a, index) for a, index, _ in global_hits], {(agent, i) for i in gold})
+
+        # Путь сервиса: маршрутизация, затем лучший параграф выбранного агента выше порога
+        def pipeline() -> Tuple[bool, int]:
+            selected, _ = retriever.route_query(query)
+            if selected is None:
+                return False, 0
+            retriever.current_agent = selected
+            retriever.ensure_agent_paragraphs(selected)
+            docs = retriever._get_relevant_documents(query)
+            hit = retriever._last_hit
+            return hit is not None and hit[0] == agent and hit[1] in gold, len(docs[0].page_content) if hit else 0
+
+        (result["pipeline_correct"], context_chars), result["pipeline_ms"] = _timed(pipeline)
+        if context_chars:
+            result["context_chars"] = context_chars
+    return result
+
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    return round(float(np.percentile(values, q)), 3) if values else None
+
+
+def _mean(values: List[float]) -> Optional[float]:
+    return round(float(np.mean(values)), 4) if values else None
+
+
+def summarize(results: List[Dict], top_k: int) -> Dict:
+    """Метрики по набору результатов; ранги вне top_k считаются промахом"""
+    with_gold = [r for r in results if r["has_gold"]]
+    summary = {
+        "questions": len(results),
+        "retrieval_questions": len(with_gold),
+        "routing_accuracy": _mean([float(r["routing_correct"]) for r in results]),
+    }
+    for prefix, key in (("", "rank"), ("global_", "global_rank")):
+        ranks = [r[key] for r in with_gold]
+        for k in RECALL_KS:
+            if k <= top_k:
+                summary[f"{prefix}recall@{k}"] = _mean([float(rank is not None and rank <= k) for rank in ranks])
+        summary[f"{prefix}mrr@{top_k}"] = _mean([1.0 / rank if rank else 0.0 for rank in ranks])
+    summary["pipeline_accuracy"] = _mean([float(r["pipeline_correct"]) for r in with_gold])
+    # Размер контекста, который уходит в промпт (меньше при CONTEXT_SENTENCES > 0)
+    summary["context_chars_mean"] = _mean([r["context_chars"] for r in with_gold if "context_chars" in r])
+
+    for name, key in (("routing", "routing_ms"), ("search", "search_ms"), ("global", "global_ms"), ("pipeline", "pipeline_ms")):
+        latencies = [r[key] for r in results if key in r]
+        summary[f"{name}_latency_ms_p50"] = _percentile(latencies, 50)
+        summary[f"{name}_latency_ms_p99"] = _percentile(latencies, 99)
+    return summary
+
+
+def parse_gate(spec: str) -> Tuple[str, str, str, float]:
+    """Условие вида "<overall|агент>.<метрика>>=<число>" или с "<=" """
+    for op in GATE_OPERATORS:
+        if op in spec:
+            path, threshold = spec.split(op, 1)
+            scope, sep, metric = path.strip().partition(".")
+            if sep and metric:
+                return scope, metric, op, float(threshold)
+    raise ValueError(f"Некорректное условие: {spec}")
+
+
+def check_gates(report: Dict, gates: List[Tuple[str, str, str, float]]) -> List[Dict]:
+    checks = []
+    for scope, metric, op, threshold in gates:
+        scope_report = report["overall"] if scope == "overall" else report["agents"].get(scope, {})
+        value = scope_report.get(metric)
+        passed = value is not None and (value >= threshold if op == ">=" else value <= threshold)
+        checks.append({"gate": f"{scope}.{metric}{op}{threshold}", "value": value, "passed": passed})
+    return checks
+
+
+def main():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Оценка качества и задержки поиска по базам знаний")
+    parser.add_argument("--agents-dir", default=os.getenv("AGENTS_DIR", base_dir))
+    parser.add_argument("--questions", help="JSONL с размеченными вопросами {message, agent, paragraph?}")
+    parser.add_argument("--no-synthetic", action="store_true", help="Оценивать только размеченный набор")
+    parser.add_argument("--per-agent", type=int, default=0, help="Синтетических вопросов на агента (0 — все)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--threshold", type=float, default=0.25, help="similarity_threshold retriever")
+    parser.add_argument("--fusion", choices=FUSION_MODES, default=os.getenv("RETRIEVAL_FUSION", "dense"),
+                        help="Слияние с лексическим поиском BM25, см. lexical_index.py")
+    parser.add_argument("--lexical-weight", type=float, default=float(os.getenv("LEXICAL_WEIGHT", 0.5)))
+    parser.add_argument("--lexical-prefilter-min", type=int, default=int(os.getenv("LEXICAL_PREFILTER_MIN", 0)))
+    parser.add_argument("--context-sentences", type=int, default=int(os.getenv("CONTEXT_SENTENCES", 0)),
+                        help="Предложений параграфа в контексте (0 — параграф целиком), см. chunking.py")
+    parser.add_argument("--snapshot-dir", default=os.getenv("EMBEDDING_SNAPSHOT_DIR", os.path.join(base_dir, "embedding_snapshots")))
+    parser.add_argument("--gate", action="append", default=[], help="Условие на метрику, например overall.recall@1>=0.8")
+    parser.add_argument("--output", help="Куда записать JSON-отчёт (по умолчанию — только stdout)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        gates = [parse_gate(spec) for spec in args.gate]
+    except ValueError as e:
+        parser.error(str(e))
+
+    from retriever import ParagraphRetriever
+
+    emb_model = load_embeddings_model()
+    registry = AgentRegistry(args.agents_dir, embeddings_model=emb_model)
+    registry.refresh()
+    retriever = ParagraphRetriever(
+        paragraphs={},
+        paragraph_embeddings={},
+        embeddings_model=emb_model,
+        similarity_threshold=args.threshold,
+        registry=registry,
+        routing_model=load_router(args.agents_dir),
+        storage=os.getenv("EMBEDDING_STORAGE", "float32"),
+        rerank_k=int(os.getenv("EMBEDDING_RERANK_K", 0)),
+        snapshot_root=args.snapshot_dir or None,
+        fusion=args.fusion,
+        lexical_weight=args.lexical_weight,
+        lexical_prefilter_min=args.lexical_prefilter_min,
+        lexical_candidates=int(os.getenv("LEXICAL_CANDIDATES", 200)),
+        context_sentences=args.context_sentences
+    )
+    # Индексы строятся до замеров, чтобы в задержки не попала загрузка эмбеддингов
+    retriever.build_global_index()
+
+    pairs = [] if args.no_synthetic else synthesize_pairs(registry, args.per_agent, args.seed)
+    if args.questions:
+        pairs.extend(load_labelled_pairs(args.questions, registry))
+    if not pairs:
+        parser.error("нет вопросов для оценки")
+    logger.info(f"Вопросов для оценки: {len(pairs)}")
+
+    retriever.route_query(pairs[0]["message"])  # прогрев
+    results = [evaluate_pair(retriever, pair, args.top_k) for pair in pairs]
+
+    report = {
+        "config": {
+            "questions": len(pairs),
+            "labelled": sum(1 for p in pairs if p["source"] == "labelled"),
+            "top_k": args.top_k,
+            "similarity_threshold": args.threshold,
+            "storage": retriever.storage,
+            "rerank_k": retriever.rerank_k,
+            "fusion": retriever.fusion,
+            "lexical_prefilter_min": retriever.lexical_prefilter_min,
+            "context_sentences": retriever.context_sentences,
+            "router": retriever.routing_model.head if retriever.routing_model is not None else None,
+        },
+        "overall": summarize(results, args.top_k),
+        "agents": {
+            name: summarize([r for r in results if r["agent"] == name], args.top_k)
+            for name in registry.agent_names if any(r["agent"] == name for r in results)
+        },
+    }
+    report["gates"] = check_gates(report, gates)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+    failed = [check["gate"] for check in report["gates"] if not check["passed"]]
+    if failed:
+        logger.error(f"Не выполнены условия: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
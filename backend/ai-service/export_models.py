@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Офлайн-сборка артефактов моделей для быстрого холодного старта
+
+build собирает в каталоге артефактов:
+- quantized_model/ — базовая модель, пересохранённая шардами safetensors
+  (загружается memory-mapped, без промежуточной копии весов в памяти);
+- adapters/ — адаптеры всех агентов в одном safetensors-файле (см. adapter_stack.py);
+- merged/<агент>/ — модели с влитыми адаптерами (для CPU-бэкенда, нужна базовая модель в полной
+  точности --cpu-base-model / CPU_BASE_MODEL);
+  каталог по умолчанию — ARTIFACTS_DIR (model_artifacts), откуда их читает model.py;
+- embedding — энкодер эмбеддингов в ONNX и int8 ONNX (onnx/ в каталоге --embedding-model,
+  см. embedding_service.py; нужен optimum[onnxruntime]).
+В каждый каталог пишется model_manifest.json с размерами и sha256 файлов: по нему
+download_models.py проверяет загруженные файлы и докачивает только недостающие.
+
+Использование:
+    python export_models.py build [--targets base,adapters,merged,embedding] [--out model_artifacts]
+    python export_models.py manifest <каталог>   # манифест для уже готового каталога модели
+    python export_models.py verify <каталог>
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+
+from model_manifest import ARTIFACTS_DIR, write_manifest, read_manifest, missing_or_corrupt
+
+logger = logging.getLogger(__name__)
+
+BUILD_TARGETS = ("base", "adapters", "merged", "embedding")
+
+
+def build_base(base_model_path: str, out_dir: str, max_shard_size: str) -> str:
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    start = time.time()
+    model = AutoModelForCausalLM.from_pretrained(base_model_path, low_cpu_mem_usage=True)
+    model.save_pretrained(out_dir, safe_serialization=True, max_shard_size=max_shard_size)
+    AutoTokenizer.from_pretrained(base_model_path).save_pretrained(out_dir)
+    write_manifest(out_dir)
+    logger.info(f"Базовая модель сохранена шардами в {out_dir} за {time.time() - start:.1f} с")
+    return out_dir
+
+
+def build_adapters(registry, out_dir: str) -> str:
+    from adapter_stack import write_adapter_stack
+
+    write_adapter_stack([registry[name] for name in registry.agent_names], out_dir)
+    write_manifest(out_dir)
+    logger.info(f"Стек адаптеров ({len(registry.agent_names)} агентов) сохранён в {out_dir}")
+    return out_dir
+
+
+def build_merged(registry, base_model_path: str, out_root: str, max_shard_size: str):
+    from cpu_backend import export_agent
+
+    for name in registry.agent_names:
+        out_dir = export_agent(base_model_path, registry[name], out_root, max_shard_size=max_shard_size)
+        write_manifest(out_dir)
+
+
+def build_embedding(embedding_model_path: str, quantization: str) -> str:
+    from embedding_service import export_onnx
+
+    export_onnx(embedding_model_path, quantization or None)
+    write_manifest(embedding_model_path)
+    return embedding_model_path
+
+
+def main():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Сборка артефактов моделей")
+    parser.add_argument("command", choices=["build", "manifest", "verify"])
+    parser.add_argument("path", nargs="?", help="Каталог модели для manifest/verify")
+    parser.add_argument("--targets", default="base,adapters")
+    parser.add_argument("--out", default=ARTIFACTS_DIR)
+    parser.add_argument("--agents-dir", default=os.getenv("AGENTS_DIR", base_dir))
+    parser.add_argument("--base-model", default=os.path.join(base_dir, "quantized_model"))
+    parser.add_argument("--cpu-base-model", default=os.getenv("CPU_BASE_MODEL"),
+                        help="Базовая модель в полной точности для цели merged")
+    parser.add_argument("--shard-size", default="2GB")
+    parser.add_argument("--embedding-model", default=os.path.join(base_dir, "frida_embedding_model"))
+    parser.add_argument("--embedding-quantization", default=os.getenv("EMBEDDING_ONNX_QUANTIZATION", "avx512_vnni"),
+                        help="arm64 | avx2 | avx512 | avx512_vnni; пусто — без int8")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command in ("manifest", "verify"):
+        if not args.path:
+            parser.error(f"для {args.command} укажите каталог модели")
+        if args.command == "manifest":
+            manifest = write_manifest(args.path)
+            logger.info(f"Манифест {args.path}: {len(manifest['files'])} файлов")
+            return
+        manifest = read_manifest(args.path)
+        if manifest is None:
+            logger.error(f"В {args.path} нет манифеста")
+            sys.exit(1)
+        bad = missing_or_corrupt(args.path, manifest)
+        for rel_path in bad:
+            logger.error(f"Файл отсутствует или повреждён: {rel_path}")
+        logger.info(f"Проверено {len(manifest['files'])} файлов, ошибок: {len(bad)}")
+        sys.exit(1 if bad else 0)
+
+    targets = [t for t in args.targets.split(",") if t]
+    unknown = set(targets) - set(BUILD_TARGETS)
+    if unknown:
+        parser.error(f"неизвестные цели: {', '.join(sorted(unknown))}")
+    if "merged" in targets and not args.cpu_base_model:
+        parser.error("для merged укажите --cpu-base-model или CPU_BASE_MODEL: quantized_model на CPU не загружается")
+
+    from agent_registry import AgentRegistry
+
+    registry = AgentRegistry(args.agents_dir)
+    registry.refresh()
+    if "base" in targets:
+        build_base(args.base_model, os.path.join(args.out, "quantized_model"), args.shard_size)
+    if "adapters" in targets:
+        build_adapters(registry, os.path.join(args.out, "adapters"))
+    if "merged" in targets:
+        build_merged(registry, args.cpu_base_model, os.path.join(args.out, "merged"), args.shard_size)
+    if "embedding" in targets:
+        build_embedding(args.embedding_model, args.embedding_quantization)
+
+
+if __name__ == "__main__":
+    main()
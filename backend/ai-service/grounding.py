@@ -0,0 +1,92 @@
+"""
+Проверка обоснованности ответа контекстом без повторного кодирования параграфа
+
+Эмбеддинги параграфов с prompt_name="paraphrase" вычисляются один раз при загрузке
+базы знаний агента и хранятся рядом с поисковыми, поэтому на каждый запрос кодируется
+только короткий ответ. Перед кодированием ответ сверяется с контекстом по словам и
+биграммам: ответ, почти дословно скопированный из параграфа, принимается без модели.
+"""
+
+import re
+import logging
+from typing import List, Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from metrics import ai_grounding_checks_total
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r"[а-яa-z0-9]+")
+STEM_LENGTH = 5  # Усечение слов выравнивает словоформы ("пароль"/"пароля")
+
+
+def _stems(text: str) -> List[str]:
+    return [token[:STEM_LENGTH] for token in TOKEN_RE.findall(text.lower().replace("ё", "е"))]
+
+
+def overlap_score(answer: str, context: str) -> float:
+    """Доля слов и биграмм ответа, встречающихся в контексте (0..1)"""
+    answer_stems, context_stems = _stems(answer), _stems(context)
+    if not answer_stems or not context_stems:
+        return 0.0
+    context_unigrams = set(context_stems)
+    unigram_recall = sum(stem in context_unigrams for stem in answer_stems) / len(answer_stems)
+    if len(answer_stems) < 2:
+        return unigram_recall
+    answer_bigrams = list(zip(answer_stems, answer_stems[1:]))
+    context_bigrams = set(zip(context_stems, context_stems[1:]))
+    bigram_recall = sum(bigram in context_bigrams for bigram in answer_bigrams) / len(answer_bigrams)
+    return (unigram_recall + bigram_recall) / 2
+
+
+class GroundingVerifier:
+    """
+    Сравнивает ответ с контекстом косинусом эмбеддингов "paraphrase". Эмбеддинг контекста
+    берётся из кэша, если он передан. С overlap_accept > 0 (по умолчанию выключено) ответ,
+    почти дословно повторяющий контекст, принимается по пересечению слов без кодирования.
+    """
+
+    def __init__(self, embeddings_model, threshold: float = 0.5, overlap_accept: float = 0.0):
+        self.embeddings_model = embeddings_model
+        self.threshold = threshold
+        self.overlap_accept = overlap_accept
+
+    def encode_paragraphs(self, paragraphs: List[str]) -> NDArray:
+        """Эмбеддинги параграфов для проверки (вызывается один раз при загрузке базы знаний)"""
+        return np.asarray(self.embeddings_model.encode(
+            paragraphs,
+            prompt_name="paraphrase",
+            batch_size=64,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        ), dtype=np.float32)
+
+    def _encode(self, text: str) -> NDArray:
+        return self.embeddings_model.encode(text, prompt_name="paraphrase", convert_to_numpy=True, normalize_embeddings=True)
+
+    def check(self, answer: str, context: str, context_emb: Optional[NDArray] = None) -> Tuple[bool, Optional[float], str]:
+        """
+        Возвращает (обоснован ли ответ, косинусное сходство или None, способ проверки).
+
+        Способ: overlap — принят по пересечению слов без кодирования; cached — эмбеддинг
+        контекста взят из кэша; encoded — контекст пришлось закодировать.
+        """
+        if self.overlap_accept > 0:
+            overlap = overlap_score(answer, context)
+            if overlap >= self.overlap_accept:
+                ai_grounding_checks_total.labels(method="overlap").inc()
+                logger.info(f"Ответ принят по пересечению с контекстом: {overlap:.2f}")
+                return True, None, "overlap"
+
+        method = "cached"
+        if context_emb is None:
+            # Ответ и контекст кодируются одним вызовом энкодера
+            method = "encoded"
+            answer_emb, context_emb = self.encode_paragraphs([answer, context])
+        else:
+            answer_emb = self._encode(answer)
+        similarity = float(np.dot(answer_emb, np.asarray(context_emb, dtype=np.float32)))
+        ai_grounding_checks_total.labels(method=method).inc()
+        return similarity >= self.threshold, similarity, method
@@ -0,0 +1,177 @@
+"""
+Быстрый лексический фильтр приветствий, благодарностей, прощаний и ненормативной лексики
+
+Запрос нормализуется (регистр, ё → е, лемматизация) и прогоняется через автомат
+Ахо–Корасик над последовательностями лемм из словаря lexicon.json. Фильтр срабатывает
+без обращения к моделям только в очевидных случаях: сообщение почти целиком (не меньше
+min_coverage токенов) состоит из ругательств, разговорных фраз и слов-связок.
+Остальные сообщения уходят на семантическую проверку эмбеддингами; найденная в них
+фраза передаётся проверке как подсказка ("тупой компьютер не включается" — не ругань).
+"""
+
+import os
+import re
+import json
+import logging
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from metrics import ai_lexical_gate_total
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pymorphy3 as _pymorphy
+except ImportError:
+    try:
+        import pymorphy2 as _pymorphy
+    except ImportError:
+        _pymorphy = None
+
+TOKEN_RE = re.compile(r"[а-яa-z0-9]+")
+
+# Окончания для грубого стемминга, если pymorphy не установлен (от длинных к коротким)
+_ENDINGS = sorted([
+    "ами", "ями", "ого", "его", "ому", "ему", "ыми", "ими", "ой", "ей", "ый", "ий", "ая", "яя",
+    "ое", "ее", "ые", "ие", "ую", "юю", "ам", "ям", "ах", "ях", "ом", "ем", "ов", "ев",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь"
+], key=len, reverse=True)
+
+
+class Lemmatizer:
+    def __init__(self):
+        self._morph = _pymorphy.MorphAnalyzer() if _pymorphy is not None else None
+        self._cache: Dict[str, str] = {}
+
+    def __call__(self, token: str) -> str:
+        lemma = self._cache.get(token)
+        if lemma is None:
+            lemma = self._morph.parse(token)[0].normal_form if self._morph is not None else self._stem(token)
+            self._cache[token] = lemma
+        return lemma
+
+    @staticmethod
+    def _stem(token: str) -> str:
+        for ending in _ENDINGS:
+            if token.endswith(ending) and len(token) - len(ending) >= 3:
+                return token[:-len(ending)]
+        return token
+
+
+class AhoCorasick:
+    """Автомат Ахо–Корасик над последовательностями токенов"""
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[str, int]]] = [[]]
+
+    def add(self, tokens: List[str], label: str):
+        node = 0
+        for token in tokens:
+            child = self._goto[node].get(token)
+            if child is None:
+                child = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[node][token] = child
+            node = child
+        self._output[node].append((label, len(tokens)))
+
+    def build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for token, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and token not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(token, 0)
+                self._output[child].extend(self._output[self._fail[child]])
+
+    def find(self, tokens: List[str]) -> List[Tuple[int, int, str]]:
+        """Все вхождения: (начало, конец, метка)"""
+        matches = []
+        node = 0
+        for i, token in enumerate(tokens):
+            while node and token not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(token, 0)
+            for label, length in self._output[node]:
+                matches.append((i - length + 1, i + 1, label))
+        return matches
+
+
+class LexicalGate:
+    """
+    Лексический классификатор разговорных намерений.
+
+    lexicon.json: {"intents": {"greeting": [...], "thanks": [...], ...},
+                   "profanity": [...], "filler": [...]}
+    """
+
+    PROFANITY = "profanity"
+
+    def __init__(self, lexicon: Dict, min_coverage: float = 0.8):
+        self.min_coverage = min_coverage
+        self.lemmatize = Lemmatizer()
+        self.automaton = AhoCorasick()
+        for intent, phrases in lexicon.get("intents", {}).items():
+            for phrase in phrases:
+                self._add(phrase, intent)
+        for phrase in lexicon.get("profanity", []):
+            self._add(phrase, self.PROFANITY)
+        self.automaton.build()
+        self.filler = {self.lemmatize(token) for word in lexicon.get("filler", []) for token in self._tokens(word)}
+
+    @classmethod
+    def from_file(cls, path: str, min_coverage: float = 0.8) -> "LexicalGate":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f), min_coverage)
+
+    @staticmethod
+    def _tokens(text: str) -> List[str]:
+        return TOKEN_RE.findall(text.lower().replace("ё", "е"))
+
+    def _add(self, phrase: str, label: str):
+        lemmas = [self.lemmatize(token) for token in self._tokens(phrase)]
+        if lemmas:
+            self.automaton.add(lemmas, label)
+
+    def classify(self, text: str) -> Tuple[Optional[str], Optional[str], bool]:
+        """
+        Возвращает (намерение, совпавшая фраза, решено). Если решено — ответ без семантической
+        проверки; иначе намерение и фраза (или None) — подсказка для семантической проверки.
+        """
+        tokens = self._tokens(text)
+        lemmas = [self.lemmatize(token) for token in tokens]
+        matches = self.automaton.find(lemmas)
+        if not matches:
+            ai_lexical_gate_total.labels(intent="none").inc()
+            return None, None, False
+
+        # Ругательство важнее разговорной фразы, среди равных — самое позднее и длинное
+        start, end, intent = max(matches, key=lambda match: (match[2] == self.PROFANITY, match[1], match[1] - match[0]))
+        phrase = " ".join(tokens[start:end])
+
+        covered = [False] * len(lemmas)
+        for match_start, match_end, _ in matches:
+            for i in range(match_start, match_end):
+                covered[i] = True
+        # Сообщение почти целиком состоит из найденных фраз и слов-связок
+        coverage = sum(covered[i] or lemma in self.filler for i, lemma in enumerate(lemmas)) / len(lemmas)
+        decided = coverage >= self.min_coverage
+
+        ai_lexical_gate_total.labels(intent=intent if decided else "none").inc()
+        return intent, phrase, decided
+
+
+def load_lexical_gate(path: str, min_coverage: float = 0.8) -> Optional[LexicalGate]:
+    if not os.path.exists(path):
+        logger.warning(f"Словарь лексического фильтра {path} не найден, фильтр отключён")
+        return None
+    gate = LexicalGate.from_file(path, min_coverage)
+    logger.info(f"Лексический фильтр загружен из {path} (лемматизация: {'pymorphy' if _pymorphy else 'стемминг'})")
+    return gate
@@ -0,0 +1,158 @@
+"""
+Лексический поиск BM25 по параграфам баз знаний и слияние с плотным поиском
+
+Вопросы поддержки часто держатся на точных токенах — кодах ошибок, номерах портов,
+названиях продуктов, "VPN", — которые косинус эмбеддингов FRIDA размывает. Индекс
+строится при загрузке агента: текст режется razdel на токены, слова лемматизируются
+(как в lexical_gate.py), а токены с цифрами ("8.8.8.8", "0x80070005", "443") остаются
+как есть. Списки вхождений хранятся в CSR-виде: смещения по терминам и плоские массивы
+номеров параграфов и частот.
+
+Результаты объединяются с плотным top-k слиянием рангов (RRF) или нормированных
+оценок; лексические кандидаты можно использовать и как префильтр, сужающий плотный
+скан на больших базах.
+"""
+
+import logging
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+from razdel import tokenize
+
+from lexical_gate import Lemmatizer
+
+logger = logging.getLogger(__name__)
+
+FUSION_MODES = ("dense", "rrf", "score")
+RRF_K = 60
+
+_lemmatizer: Optional[Lemmatizer] = None
+
+
+def lexical_terms(text: str) -> List[str]:
+    """Термины для BM25: леммы слов и неизменённые токены с цифрами"""
+    global _lemmatizer
+    if _lemmatizer is None:
+        _lemmatizer = Lemmatizer()
+    terms = []
+    for token in tokenize(text.lower().replace("ё", "е")):
+        value = token.text
+        if not any(ch.isalnum() for ch in value):
+            continue
+        terms.append(_lemmatizer(value) if value.isalpha() else value)
+    return terms
+
+
+class LexicalIndex:
+    """Инвертированный индекс BM25 со списками вхождений в плоских массивах"""
+
+    def __init__(self, vocabulary: Dict[str, int], offsets: NDArray, doc_ids: NDArray, tfs: NDArray,
+                 doc_lengths: NDArray, k1: float = 1.2, b: float = 0.75):
+        self.vocabulary = vocabulary
+        self.offsets = offsets  # Списки вхождений термина t: doc_ids[offsets[t]:offsets[t + 1]]
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        n_docs = len(doc_lengths)
+        avg_length = float(doc_lengths.mean()) if n_docs else 0.0
+        df = np.diff(offsets).astype(np.float32)
+        self.idf = np.log(1.0 + (n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        # Знаменатель BM25 без частоты: k1 * (1 - b + b * |d| / avgdl)
+        self.length_norm = (k1 * (1 - b + b * doc_lengths / max(avg_length, 1e-9))).astype(np.float32)
+
+    @classmethod
+    def build(cls, paragraphs: Sequence[str], k1: float = 1.2, b: float = 0.75) -> "LexicalIndex":
+        vocabulary: Dict[str, int] = {}
+        terms, docs, counts = [], [], []
+        doc_lengths = np.zeros(len(paragraphs), dtype=np.float32)
+        for doc, paragraph in enumerate(paragraphs):
+            doc_terms = lexical_terms(paragraph)
+            doc_lengths[doc] = len(doc_terms)
+            for term, count in Counter(doc_terms).items():
+                terms.append(vocabulary.setdefault(term, len(vocabulary)))
+                docs.append(doc)
+                counts.append(count)
+
+        terms = np.array(terms, dtype=np.int32)
+        docs = np.array(docs, dtype=np.int32)
+        order = np.lexsort((docs, terms))
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(vocabulary)), out=offsets[1:])
+        tfs = np.minimum(np.array(counts, dtype=np.int64), np.iinfo(np.uint16).max).astype(np.uint16)
+        return cls(vocabulary, offsets, docs[order], tfs[order], doc_lengths, k1=k1, b=b)
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    @property
+    def nbytes(self) -> int:
+        """Память массивов индекса (словарь терминов не учитывается)"""
+        return sum(a.nbytes for a in (self.offsets, self.doc_ids, self.tfs, self.doc_lengths, self.idf, self.length_norm))
+
+    def scores(self, query: str) -> NDArray:
+        """Оценки BM25 запроса для всех параграфов (0 — нет общих терминов)"""
+        out = np.zeros(len(self), dtype=np.float32)
+        for term in set(lexical_terms(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, stop = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.doc_ids[start:stop]
+            tf = self.tfs[start:stop].astype(np.float32)
+            out[docs] += self.idf[term_id] * tf * (self.k1 + 1) / (tf + self.length_norm[docs])
+        return out
+
+    def top_k(self, query: str, k: int) -> Tuple[NDArray, NDArray]:
+        """Индексы и оценки k лучших параграфов среди содержащих хотя бы один термин запроса"""
+        scores = self.scores(query)
+        matched = np.flatnonzero(scores > 0)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        order = np.argsort(-scores[matched], kind="stable")
+        return matched[order], scores[matched[order]]
+
+
+def fuse(dense: Tuple[NDArray, NDArray], lexical: Tuple[NDArray, NDArray], mode: str = "rrf",
+         lexical_weight: float = 0.5) -> NDArray:
+    """
+    Объединяет плотный и лексический top-k в один порядок индексов.
+
+    rrf — сумма 1 / (RRF_K + ранг) по обоим спискам, score — сумма оценок, нормированных
+    в [0, 1] внутри каждого списка (отсутствие в списке — 0); вклад лексического списка
+    умножается на lexical_weight, плотного — на 1 - lexical_weight.
+    """
+    if mode not in FUSION_MODES:
+        raise ValueError(f"Неизвестный режим слияния: {mode}")
+    dense_ids, dense_scores = dense
+    lexical_ids, lexical_scores = lexical
+    if mode == "dense" or len(lexical_ids) == 0:
+        return dense_ids
+
+    fused: Dict[int, float] = {}
+    if mode == "rrf":
+        for weight, ids in ((1.0 - lexical_weight, dense_ids), (lexical_weight, lexical_ids)):
+            for rank, i in enumerate(ids, start=1):
+                fused[int(i)] = fused.get(int(i), 0.0) + weight / (RRF_K + rank)
+    else:
+        for weight, ids, scores in ((1.0 - lexical_weight, dense_ids, dense_scores),
+                                    (lexical_weight, lexical_ids, lexical_scores)):
+            if len(ids) == 0:
+                continue
+            low, high = float(np.min(scores)), float(np.max(scores))
+            normalized = (scores - low) / (high - low) if high > low else np.ones(len(scores), dtype=np.float32)
+            for i, value in zip(ids, normalized):
+                fused[int(i)] = fused.get(int(i), 0.0) + weight * float(value)
+    return np.array(sorted(fused, key=fused.get, reverse=True), dtype=np.int64)
+
+
+def first_above(sims: NDArray, threshold: float) -> Optional[int]:
+    """
+    Позиция первого кандидата слитого списка, чьё плотное сходство не ниже порога.
+    Лексический победитель слияния с низким косинусом не отсекает запрос целиком,
+    если ниже по списку есть кандидат, проходящий порог.
+    """
+    passing = np.flatnonzero(np.asarray(sims) >= threshold)
+    return int(passing[0]) if len(passing) else None
@@ -1,120 +1,126 @@
-from datasets import Dataset
-from transformers import AutoTokenizer, AutoModelForCausalLM, Trainer, TrainingArguments, DataCollatorForLanguageModeling
+from transformers import AutoTokenizer, AutoModelForCausalLM, Trainer, TrainingArguments
 from peft import LoraConfig, get_peft_model, TaskType
 import torch
 import os
 import math
+import time
+import hashlib
+
+from agent_registry import split_into_paragraphs
+from lora_data import load_or_build_datasets, make_collator, training_overrides, ThroughputCallback
 
 base_dir = os.path.dirname(os.path.abspath(__file__))
 
-# --- Модель и токенизатор ---
-model = AutoModelForCausalLM.from_pretrained(os.path.join(base_dir, "quantized_model"))
-tokenizer = AutoTokenizer.from_pretrained(os.path.join(base_dir, "quantized_model"))
+# --- LoRA ---
+LORA_PARAMS = {
+    "r": 64,  # Увеличенный ранг
+    "lora_alpha": 128,  # Увеличьте пропорционально
+    "lora_dropout": 0.1  # Уменьшите dropout для большей стабильности
+}
 
-# Убедитесь, что у токенизатора есть pad_token
-if tokenizer.pad_token is None:
-    tokenizer.pad_token = tokenizer.eos_token
+# --- Подготовка данных (pack | bucket | none), датасет кэшируется на диске ---
+PACKING_MODE = os.getenv("LORA_PACKING", "pack")
+SEQ_LEN = int(os.getenv("LORA_SEQ_LEN", 1024))
+DATA_CACHE_DIR = os.getenv("LORA_DATA_CACHE", os.path.join(base_dir, "lora_data_cache"))
 
-# --- LoRA ---
-lora_config = LoraConfig(
-    task_type=TaskType.CAUSAL_LM,
-    r=64,  # Увеличенный ранг
-    lora_alpha=128,  # Увеличьте пропорционально
-    lora_dropout=0.1  # Уменьшите dropout для большей стабильности
-)
-model = get_peft_model(model, lora_config)
-
-file_path = os.path.join(base_dir, "Сеть.txt")
-
-with open(file_path, "r", encoding="utf-8") as f:
-    text = f.read()
-
-# Разделяем текст на абзацы (предполагаем, что абзацы разделены двойным переносом строки)
-paragraphs = text.split("\n")  # Или "\n", если абзацы разделены одиночным переносом
-
-# Удаляем пустые абзацы и убираем лишние пробелы
-paragraphs = [p.strip() for p in paragraphs if p.strip()]
-
-# --- Токенизация абзацев ---
-max_length = 8192  # Максимальная длина токенизированного абзаца
-all_examples = []
-all_attention_masks = []
-
-for paragraph in paragraphs:
-    # Токенизируем абзац
-    tokens = tokenizer(
-        paragraph,
-        max_length=max_length,
-        truncation=True,
-        padding=False,  # Padding будет добавлен в DataCollator
-        return_tensors="pt",
-        add_special_tokens=True
-    )
-    input_ids = tokens["input_ids"].squeeze().tolist()
-    attention_mask = tokens["attention_mask"].squeeze().tolist()
-    
-    # Добавляем только непустые последовательности
-    if len(input_ids) > 1:  # Исключаем слишком короткие абзацы (например, 1 токен)
-        all_examples.append(input_ids)
-        all_attention_masks.append(attention_mask)
-
-# --- Разделение на тренировочные и валидационные данные ---
-train_size = int(0.8 * len(all_examples))
-train_examples = all_examples[:train_size]
-eval_examples = all_examples[train_size:]
-train_attention_masks = all_attention_masks[:train_size]
-eval_attention_masks = all_attention_masks[train_size:]
-
-# Создаем датасеты
-train_dataset = Dataset.from_dict({"input_ids": train_examples, "attention_mask": train_attention_masks})
-eval_dataset = Dataset.from_dict({"input_ids": eval_examples, "attention_mask": eval_attention_masks})
-
-# Проверяем размер датасетов
-print(f"Размер тренировочной выборки: {len(train_dataset)} примеров")
-print(f"Размер валидационной выборки: {len(eval_dataset)} примеров")
-
-# --- Рассчитываем eval_steps для 10 валидаций ---
 per_device_train_batch_size = 2
 num_train_epochs = 10
-total_training_steps = math.ceil(len(train_dataset) / per_device_train_batch_size) * num_train_epochs
-eval_steps = total_training_steps // 10
-
-# --- Data collator ---
-data_collator = DataCollatorForLanguageModeling(
-    tokenizer=tokenizer,
-    mlm=False,
-    pad_to_multiple_of=8  # Оптимизация для GPU
-)
-
-# --- Настройка Trainer ---
-training_args = TrainingArguments(
-    output_dir="./lora_finetuned",
-    per_device_train_batch_size=per_device_train_batch_size,
-    per_device_eval_batch_size=2,
-    num_train_epochs=num_train_epochs,
-    logging_steps=eval_steps,
-    save_steps=eval_steps,
-    save_total_limit=1,
-    eval_strategy="steps",
-    eval_steps=eval_steps,
-    save_strategy="steps",
-    load_best_model_at_end=True,
-    metric_for_best_model="eval_loss",
-    greater_is_better=False,
-    weight_decay=0.01,
-    fp16=True,
-)
-
-trainer = Trainer(
-    model=model,
-    args=training_args,
-    train_dataset=train_dataset,
-    eval_dataset=eval_dataset,
-    data_collator=data_collator,
-)
-
-# --- Обучение модели ---
-trainer.train()
-
-# --- Сохранение модели ---
-trainer.save_model("./Сеть/best_model")
\ No newline at end of file
+
+
+def load_base_model():
+    # --- Модель и токенизатор ---
+    model = AutoModelForCausalLM.from_pretrained(os.path.join(base_dir, "quantized_model"))
+    tokenizer = AutoTokenizer.from_pretrained(os.path.join(base_dir, "quantized_model"))
+
+    # Убедитесь, что у токенизатора есть pad_token
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return model, tokenizer
+
+
+def training_config_hash() -> str:
+    """Хэш параметров обучения: при их изменении адаптеры переобучаются"""
+    payload = repr((sorted(LORA_PARAMS.items()), PACKING_MODE, SEQ_LEN, per_device_train_batch_size, num_train_epochs))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def train_adapter(base_model, tokenizer, text: str, output_dir: str, checkpoint_dir: str = "./lora_finetuned"):
+    """
+    Обучает LoRA-адаптер на тексте базы знаний поверх base_model и сохраняет его в output_dir.
+    Возвращает базовую модель без адаптера (для обучения следующего) и сводку обучения.
+    """
+    start = time.time()
+    model = get_peft_model(base_model, LoraConfig(task_type=TaskType.CAUSAL_LM, **LORA_PARAMS))
+
+    # Абзацы разделены переносом строки, как в базе знаний сервиса
+    paragraphs = split_into_paragraphs(text)
+    train_dataset, eval_dataset, data_stats = load_or_build_datasets(
+        paragraphs,
+        corpus_hash=hashlib.sha256(text.encode("utf-8")).hexdigest(),
+        tokenizer=tokenizer,
+        mode=PACKING_MODE,
+        seq_len=SEQ_LEN,
+        cache_dir=DATA_CACHE_DIR
+    )
+
+    # Проверяем размер датасетов
+    print(f"Размер тренировочной выборки: {len(train_dataset)} примеров ({data_stats['train_tokens']} токенов)")
+    print(f"Размер валидационной выборки: {len(eval_dataset)} примеров")
+
+    # --- Рассчитываем eval_steps для 10 валидаций ---
+    total_training_steps = math.ceil(len(train_dataset) / per_device_train_batch_size) * num_train_epochs
+    eval_steps = max(total_training_steps // 10, 1)
+
+    # --- Настройка Trainer ---
+    training_args = TrainingArguments(
+        output_dir=checkpoint_dir,
+        per_device_train_batch_size=per_device_train_batch_size,
+        per_device_eval_batch_size=2,
+        num_train_epochs=num_train_epochs,
+        logging_steps=eval_steps,
+        save_steps=eval_steps,
+        save_total_limit=1,
+        eval_strategy="steps",
+        eval_steps=eval_steps,
+        save_strategy="steps",
+        load_best_model_at_end=True,
+        metric_for_best_model="eval_loss",
+        greater_is_better=False,
+        weight_decay=0.01,
+        fp16=True,
+        **training_overrides(PACKING_MODE)
+    )
+
+    throughput = ThroughputCallback(data_stats["train_tokens"])
+    trainer = Trainer(
+        model=model,
+        args=training_args,
+        train_dataset=train_dataset,
+        eval_dataset=eval_dataset,
+        # Блочная маска для упакованных последовательностей или паддинг до кратного 8
+        data_collator=make_collator(PACKING_MODE, tokenizer),
+        callbacks=[throughput],
+    )
+
+    # --- Обучение модели ---
+    trainer.train()
+
+    # --- Сохранение модели ---
+    trainer.save_model(output_dir)
+    tokenizer.save_pretrained(output_dir)
+
+    summary = {
+        "train_seconds": round(time.time() - start, 1),
+        "tokens_per_second": round(throughput.tokens_per_second, 1),
+        "best_eval_loss": trainer.state.best_metric,
+        "data": data_stats,
+    }
+    # Слои LoRA снимаются, базовая модель остаётся в памяти для следующего агента
+    return model.unload(), summary
+
+
+if __name__ == "__main__":
+    base_model, tokenizer = load_base_model()
+    with open(os.path.join(base_dir, "Сеть.txt"), "r", encoding="utf-8") as f:
+        text = f.read()
+    train_adapter(base_model, tokenizer, text, "./Сеть/best_model")
@@ -0,0 +1,208 @@
+"""
+Подготовка обучающих данных LoRA: упаковка абзацев и батчи без лишнего паддинга
+
+Абзацы баз знаний короткие (десятки токенов), поэтому по одному на пример почти
+весь батч занимает паддинг. Режимы:
+- pack — абзацы укладываются в последовательности длиной seq_len; блочно-диагональная
+  причинная маска и сброс position_ids не дают абзацам видеть друг друга;
+- bucket — абзац на пример, батчи собираются из примеров близкой длины (group_by_length);
+- none — как раньше: абзац на пример, произвольные батчи.
+Токенизированные датасеты кэшируются на диске по хэшу корпуса и параметрам подготовки.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+from typing import Dict, List, Tuple
+
+import torch
+from datasets import Dataset, load_from_disk
+from transformers import DataCollatorForLanguageModeling, TrainerCallback
+
+logger = logging.getLogger(__name__)
+
+PACKING_MODES = ("pack", "bucket", "none")
+CACHE_FORMAT_VERSION = 1
+
+
+def tokenize_paragraphs(tokenizer, paragraphs: List[str], max_length: int) -> List[List[int]]:
+    """Токенизирует абзацы; в конец каждого добавляется eos, чтобы модель училась завершать ответ"""
+    encoded = tokenizer(paragraphs, max_length=max_length, truncation=True, add_special_tokens=True)["input_ids"]
+    eos = tokenizer.eos_token_id
+    examples = []
+    for ids in encoded:
+        if len(ids) <= 1:  # Исключаем слишком короткие абзацы (например, 1 токен)
+            continue
+        if eos is not None and ids[-1] != eos and len(ids) < max_length:
+            ids = ids + [eos]
+        examples.append(ids)
+    return examples
+
+
+def pack_examples(examples: List[List[int]], seq_len: int) -> Tuple[List[List[int]], List[List[int]]]:
+    """
+    Укладывает примеры в последовательности до seq_len токенов (first-fit decreasing).
+    Возвращает input_ids и position_ids; position_ids начинаются с 0 в каждом абзаце.
+    """
+    chunks = []
+    for ids in examples:
+        chunks.extend(ids[start:start + seq_len] for start in range(0, len(ids), seq_len))
+
+    bins: List[List[List[int]]] = []
+    free: List[int] = []
+    for chunk in sorted(chunks, key=len, reverse=True):
+        for i, space in enumerate(free):
+            if len(chunk) <= space:
+                bins[i].append(chunk)
+                free[i] -= len(chunk)
+                break
+        else:
+            bins.append([chunk])
+            free.append(seq_len - len(chunk))
+
+    input_ids = [[token for chunk in packed for token in chunk] for packed in bins]
+    position_ids = [[pos for chunk in packed for pos in range(len(chunk))] for packed in bins]
+    return input_ids, position_ids
+
+
+class PackedCollator:
+    """Дополняет упакованные последовательности и строит 4D-маску внимания внутри абзацев"""
+
+    def __init__(self, pad_token_id: int, pad_to_multiple_of: int = 8):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, features: List[Dict]) -> Dict[str, torch.Tensor]:
+        length = max(len(f["input_ids"]) for f in features)
+        if self.pad_to_multiple_of:
+            length = -(-length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        batch = len(features)
+        input_ids = torch.full((batch, length), self.pad_token_id, dtype=torch.long)
+        position_ids = torch.zeros((batch, length), dtype=torch.long)
+        labels = torch.full((batch, length), -100, dtype=torch.long)
+        segments = torch.full((batch, length), -1, dtype=torch.long)
+        for row, feature in enumerate(features):
+            n = len(feature["input_ids"])
+            ids = torch.tensor(feature["input_ids"], dtype=torch.long)
+            pos = torch.tensor(feature["position_ids"], dtype=torch.long)
+            input_ids[row, :n] = ids
+            position_ids[row, :n] = pos
+            segments[row, :n] = torch.cumsum(pos == 0, dim=0)
+            labels[row, :n] = ids
+            # Первый токен абзаца не предсказывается по концу предыдущего
+            labels[row, :n][pos == 0] = -100
+
+        causal = torch.tril(torch.ones((length, length), dtype=torch.bool))
+        allowed = (segments[:, :, None] == segments[:, None, :]) & causal & (segments[:, :, None] >= 0)
+        # Паддинг видит сам себя, чтобы в строках маски не было одних -inf
+        allowed |= torch.eye(length, dtype=torch.bool)
+        attention_mask = torch.zeros((batch, 1, length, length), dtype=torch.float32)
+        attention_mask.masked_fill_(~allowed[:, None], torch.finfo(torch.float32).min)
+        return {"input_ids": input_ids, "attention_mask": attention_mask, "position_ids": position_ids, "labels": labels}
+
+
+def make_collator(mode: str, tokenizer):
+    if mode == "pack":
+        return PackedCollator(tokenizer.pad_token_id)
+    return DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False, pad_to_multiple_of=8)
+
+
+def training_overrides(mode: str) -> Dict:
+    """Параметры TrainingArguments, зависящие от режима подготовки данных"""
+    if mode == "bucket":
+        return {"group_by_length": True, "length_column_name": "length"}
+    return {}
+
+
+def _build_dataset(examples: List[List[int]], mode: str, seq_len: int) -> Dataset:
+    if mode == "pack":
+        input_ids, position_ids = pack_examples(examples, seq_len)
+        return Dataset.from_dict({"input_ids": input_ids, "position_ids": position_ids})
+    return Dataset.from_dict({
+        "input_ids": examples,
+        "attention_mask": [[1] * len(ids) for ids in examples],
+        "length": [len(ids) for ids in examples],
+    })
+
+
+def cache_key(corpus_hash: str, tokenizer, mode: str, seq_len: int, holdout: float) -> str:
+    payload = json.dumps({
+        "version": CACHE_FORMAT_VERSION,
+        "corpus": corpus_hash,
+        "tokenizer": getattr(tokenizer, "name_or_path", ""),
+        "vocab_size": len(tokenizer),
+        "mode": mode,
+        "seq_len": seq_len,
+        "holdout": holdout,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def load_or_build_datasets(paragraphs: List[str], corpus_hash: str, tokenizer, mode: str = "pack",
+                           seq_len: int = 1024, holdout: float = 0.2,
+                           cache_dir: str = "") -> Tuple[Dataset, Dataset, Dict]:
+    """Обучающий и валидационный датасеты из кэша или токенизированные заново"""
+    if mode not in PACKING_MODES:
+        raise ValueError(f"Неизвестный режим подготовки данных: {mode}")
+    cache_path = os.path.join(cache_dir, cache_key(corpus_hash, tokenizer, mode, seq_len, holdout)) if cache_dir else ""
+    if cache_path and os.path.exists(os.path.join(cache_path, "stats.json")):
+        with open(os.path.join(cache_path, "stats.json"), "r", encoding="utf-8") as f:
+            stats = json.load(f)
+        logger.info(f"Датасет загружен из кэша {cache_path}")
+        return load_from_disk(os.path.join(cache_path, "train")), load_from_disk(os.path.join(cache_path, "eval")), stats
+
+    start = time.time()
+    examples = tokenize_paragraphs(tokenizer, paragraphs, max_length=seq_len)
+    # Разделение на тренировочные и валидационные данные в исходном порядке абзацев
+    train_size = int((1 - holdout) * len(examples))
+    train_examples, eval_examples = examples[:train_size], examples[train_size:]
+    train_dataset = _build_dataset(train_examples, mode, seq_len)
+    eval_dataset = _build_dataset(eval_examples, mode, seq_len)
+
+    train_tokens = sum(len(ids) for ids in train_examples)
+    stats = {
+        "mode": mode,
+        "paragraphs": len(examples),
+        "train_tokens": train_tokens,
+        "eval_tokens": sum(len(ids) for ids in eval_examples),
+        "train_sequences": len(train_dataset),
+        "eval_sequences": len(eval_dataset),
+        # Доля реальных токенов в последовательностях длиной seq_len (для pack)
+        "fill_ratio": round(train_tokens / max(len(train_dataset) * seq_len, 1), 3) if mode == "pack" else None,
+        "prepare_seconds": round(time.time() - start, 2),
+    }
+    if cache_path:
+        train_dataset.save_to_disk(os.path.join(cache_path, "train"))
+        eval_dataset.save_to_disk(os.path.join(cache_path, "eval"))
+        with open(os.path.join(cache_path, "stats.json"), "w", encoding="utf-8") as f:
+            json.dump(stats, f, ensure_ascii=False, indent=2)
+    logger.info(f"Датасет подготовлен: {stats}")
+    return train_dataset, eval_dataset, stats
+
+
+class ThroughputCallback(TrainerCallback):
+    """Пишет в логи обучения скорость в реальных (не паддинговых) токенах в секунду"""
+
+    def __init__(self, train_tokens: int):
+        self.train_tokens = train_tokens
+        self.start = None
+        self.tokens_per_second = 0.0
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.start = time.time()
+
+    def _update(self, state) -> float:
+        elapsed = time.time() - self.start if self.start else 0.0
+        if elapsed > 0 and state.epoch:
+            self.tokens_per_second = state.epoch * self.train_tokens / elapsed
+        return self.tokens_per_second
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs is not None:
+            logs["train_tokens_per_second"] = round(self._update(state), 1)
+
+    def on_train_end(self, args, state, control, **kwargs):
+        logger.info(f"Скорость обучения: {self._update(state):.1f} токенов/с")
@@ -1,8 +1,17 @@
 """
 Метрики Prometheus для отслеживания эффективности AI-сервиса
+
+Сервер метрик отдаёт /metrics (и любой другой путь) в формате Prometheus, а также
+служебные пути, зарегистрированные через add_route (например, /ready).
 """
 
-from prometheus_client import Counter, Histogram, Gauge, start_http_server
+import threading
+from socketserver import ThreadingMixIn
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import parse_qs
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from prometheus_client import Counter, Histogram, Gauge, make_wsgi_app
 import logging
 
 logger = logging.getLogger(__name__)
@@ -62,10 +71,190 @@ ai_history_truncation_total = Counter(
     'Количество случаев обрезки истории'
 )
 
+ai_global_retrieval_total = Counter(
+    'ai_global_retrieval_total',
+    'Результаты поиска контекста по базам знаний всех агентов',
+    ['outcome']  # confirmed, switched, miss
+)
+
+ai_hybrid_retrieval_total = Counter(
+    'ai_hybrid_retrieval_total',
+    'Откуда взят лучший параграф при гибридном поиске',
+    ['source']  # both, dense, lexical
+)
+
+ai_lexical_gate_total = Counter(
+    'ai_lexical_gate_total',
+    'Результаты лексического фильтра до обращения к моделям',
+    ['intent']  # greeting, thanks, farewell, who_are_you, small_talk, profanity, none
+)
+
+ai_decoding_duration_seconds = Histogram(
+    'ai_decoding_duration_seconds',
+    'Время генерации ответа агента',
+    ['mode'],  # plain/prompt_lookup/draft
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+
+ai_decoding_tokens_per_step = Histogram(
+    'ai_decoding_tokens_per_step',
+    'Токенов ответа на один проход модели агента',
+    ['mode'],
+    buckets=(1, 1.5, 2, 3, 4, 6, 8, 12)
+)
+
+ai_decoding_tokens_total = Counter(
+    'ai_decoding_tokens_total',
+    'Сгенерированные токены ответов агентов',
+    ['mode', 'source']  # source - target (модель агента) / draft (принятые токены черновика)
+)
+
+ai_grounding_checks_total = Counter(
+    'ai_grounding_checks_total',
+    'Проверки ответа по контексту',
+    ['method']  # overlap/cached/encoded
+)
+
+ai_canned_responses_total = Counter(
+    'ai_canned_responses_total',
+    'Ответы на разговорные намерения',
+    ['intent', 'source']  # source - template/llm
+)
+
+# Метрики ленивой загрузки агентов
+ai_agents_loaded = Gauge(
+    'ai_agents_loaded',
+    'Количество агентов, загруженных в память'
+)
+
+ai_agent_memory_bytes = Gauge(
+    'ai_agent_memory_bytes',
+    'Оценка памяти, занятой загруженными агентами (адаптеры и эмбеддинги)'
+)
+
+ai_agent_load_duration_seconds = Histogram(
+    'ai_agent_load_duration_seconds',
+    'Время загрузки адаптера агента в секундах',
+    ['agent'],
+    buckets=(0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+)
+
+ai_agent_evictions_total = Counter(
+    'ai_agent_evictions_total',
+    'Количество выгрузок агентов из памяти',
+    ['reason']  # budget, idle
+)
+
+# Метрики реестра агентов
+ai_registry_agents = Gauge(
+    'ai_registry_agents',
+    'Количество агентов, зарегистрированных в реестре'
+)
+
+ai_registry_changes_total = Counter(
+    'ai_registry_changes_total',
+    'Количество изменений реестра агентов',
+    ['change']  # added, changed, removed
+)
+
+ai_registry_last_refresh_timestamp = Gauge(
+    'ai_registry_last_refresh_timestamp',
+    'Время последней синхронизации реестра агентов с диском (unix time)'
+)
+
+# Метрики публикации ответов (publisher confirms)
+ai_publish_confirm_seconds = Histogram(
+    'ai_publish_confirm_seconds',
+    'Время от публикации ответа до подтверждения брокером',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+)
+
+ai_publish_results_total = Counter(
+    'ai_publish_results_total',
+    'Результаты публикации ответов',
+    ['result']  # ack, nack, lost, unavailable, timeout
+)
+
+# Метрики сервиса эмбеддингов (микро-батчинг, см. embedding_service.py)
+ai_embedding_batch_size = Histogram(
+    'ai_embedding_batch_size',
+    'Число текстов в одном вызове энкодера эмбеддингов',
+    buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+
+ai_embedding_queue_wait_seconds = Histogram(
+    'ai_embedding_queue_wait_seconds',
+    'Время ожидания запроса эмбеддинга в очереди до кодирования',
+    buckets=(0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05)
+)
+
+# Формат входящих запросов (см. wire.py)
+ai_wire_requests_total = Counter(
+    'ai_wire_requests_total',
+    'Входящие запросы по формату и способу передачи истории',
+    ['format', 'history']  # format: json, msgpack; history: legacy, full, delta, resync
+)
+
+# Прогрев и готовность (см. warmup.py)
+ai_warmup_seconds = Gauge(
+    'ai_warmup_seconds',
+    'Время этапа прогрева агента при запуске',
+    ['agent', 'stage', 'round']  # stage: encode/retrieve/generate; round: first/last
+)
+
+ai_ready = Gauge(
+    'ai_ready',
+    'Сервис прогрет и принимает сообщения (1) или ещё прогревается (0)'
+)
+
+# Служебные пути сервера метрик: путь -> обработчик(параметры запроса) -> (HTTP-статус, тело)
+_routes: Dict[str, Callable[[Dict[str, List[str]]], Tuple[str, str]]] = {}
+_ready = threading.Event()
+
+
+def add_route(path: str, handler: Callable[[Dict[str, List[str]]], Tuple[str, str]]):
+    _routes[path] = handler
+
+
+def set_ready(ready: bool = True):
+    if ready:
+        _ready.set()
+    else:
+        _ready.clear()
+    ai_ready.set(1 if ready else 0)
+
+
+add_route("/ready", lambda params: ("200 OK", "ready") if _ready.is_set() else ("503 Service Unavailable", "warming up"))
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def _make_app():
+    metrics_app = make_wsgi_app()
+
+    def app(environ, start_response):
+        handler = _routes.get(environ.get("PATH_INFO", ""))
+        if handler is None:
+            return metrics_app(environ, start_response)
+        status, body = handler(parse_qs(environ.get("QUERY_STRING", "")))
+        start_response(status, [("Content-Type", "text/plain; charset=utf-8")])
+        return [body.encode("utf-8")]
+
+    return app
+
+
 def start_metrics_server(port=8000):
     """Запускает HTTP сервер для экспорта метрик"""
     try:
-        start_http_server(port)
+        server = make_server("", port, _make_app(), _ThreadingWSGIServer, handler_class=_QuietHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
         logger.info(f"Metrics server started on port {port}")
     except Exception as e:
         logger.error(f"Failed to start metrics server: {e}")
@@ -1,29 +1,39 @@
 import torch
 import numpy as np
-import re
 from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline, PreTrainedTokenizerBase
-from langchain_core.documents import Document
-from langchain_core.retrievers import BaseRetriever
-from sklearn.metrics.pairwise import cosine_similarity
 from typing import List, Dict, Tuple, Any, Optional
 import logging
-from peft import PeftModel
-from sentence_transformers import SentenceTransformer
 from razdel import sentenize
-from numpy.typing import NDArray
 import os
 import pika
-import json
-import chromadb
-from chromadb import HttpClient
-from chromadb.config import Settings
+from agent_pool import AgentPool
+from model_manifest import ARTIFACTS_DIR, artifact_path
+from adapter_stack import AdapterStack
+from cpu_backend import configure_threads, cpu_base_model_path, load_cpu_model
+from agent_registry import AgentRegistry, AgentSpec
+from router import load_router
+from retriever import ParagraphRetriever
+from lexical_gate import LexicalGate, load_lexical_gate
+from responses import load_response_templates
+from grounding import GroundingVerifier
+from prompts import render_chat_with_context, render_history_only
+from decoding import decoder_from_env
+from publisher import ConfirmedPublisher, ResponseOutput
+from wire import HistoryCache, decode_request, encode_response
+from vector_store import open_vector_store
+from embedding_service import EmbeddingService, load_embedding_model
+from profiling import RequestProfiler
+from traffic import TrafficRecorder
+from warmup import WarmupReport, compile_for_decoding, run_warmup, select_warmup_agents, warmup_questions
 import uuid
 import time
 from pythonjsonlogger import jsonlogger
 from metrics import (
     ai_requests_total, ai_request_duration_seconds, ai_tokens_used,
-    ai_agent_selection_similarity, ai_context_similarity, ai_special_cases_total,
-    ai_active_chats, ai_history_truncation_total, start_metrics_server
+    ai_context_similarity, ai_special_cases_total,
+    ai_active_chats, ai_history_truncation_total, ai_global_retrieval_total, ai_canned_responses_total,
+    ai_wire_requests_total,
+    start_metrics_server, set_ready, add_route
 )
 
 # Настройка структурированного JSON логирования
@@ -41,351 +51,188 @@ logger.setLevel(logging.INFO)
 device = "cuda" if torch.cuda.is_available() else "cpu"
 logger.info(f"Используемое устройство: {device}")
 
+# --- Бэкенд инференса: auto | cuda | cpu (модели агентов с влитыми адаптерами, см. cpu_backend.py) ---
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "auto")
+use_cpu_backend = INFERENCE_BACKEND == "cpu" or (INFERENCE_BACKEND == "auto" and device == "cpu")
+CPU_DTYPE = os.getenv("CPU_DTYPE", "bf16")
+CPU_STATIC_CACHE = os.getenv("CPU_STATIC_CACHE", "1") == "1"
+if use_cpu_backend:
+    configure_threads(int(os.getenv("CPU_THREADS", 0)), os.getenv("CPU_AFFINITY", ""))
+
 base_dir = os.path.dirname(os.path.abspath(__file__))
 
-# --- Инициализация ChromaDB ---
-chroma_host = os.getenv("CHROMADB_HOST", "localhost")
-chroma_port = int(os.getenv("CHROMADB_PORT", 8000))
-chroma_client = HttpClient(
-    host=chroma_host,
-    port=chroma_port,
-    settings=Settings(allow_reset=True, anonymized_telemetry=False)
+# --- Хранилище эмбеддингов (ChromaDB по HTTP, встроенная ChromaDB или SQLite, см. vector_store.py) ---
+collection = open_vector_store(
+    os.getenv("VECTOR_STORE", "http"),
+    "paragraph_embeddings",
+    path=os.getenv("VECTOR_STORE_PATH", os.path.join(base_dir, "vector_store")),
+    host=os.getenv("CHROMADB_HOST", "localhost"),
+    port=int(os.getenv("CHROMADB_PORT", 8000)),
+    batch_size=int(os.getenv("VECTOR_STORE_BATCH_SIZE", 512))
 )
 
-collection_name = "paragraph_embeddings"
-try:
-    collection = chroma_client.get_collection(collection_name)
-    logger.info(f"Коллекция {collection_name} найдена в ChromaDB.")
-except Exception as e:
-    logger.info(f"Создаём новую коллекцию {collection_name} в ChromaDB: {e}")
-    collection = chroma_client.create_collection(collection_name)
-
-# --- Разделение на абзацы ---
-def split_into_paragraphs(text: str) -> List[str]:
-    paragraphs = [p.strip() for p in re.split(r'\n\s*\n|\n', text) if p.strip()]
-    return paragraphs
-
-# Загрузка базовой модели
-model = AutoModelForCausalLM.from_pretrained(os.path.join(base_dir, "quantized_model"))
-base_tokenizer = AutoTokenizer.from_pretrained(os.path.join(base_dir, "quantized_model"))
+# Загрузка базовой модели: собранная export_models.py build в ARTIFACTS_DIR или исходная quantized_model
+base_model_path = artifact_path("quantized_model", os.path.join(base_dir, "quantized_model"))
+logger.info(f"Базовая модель: {base_model_path}")
+if use_cpu_backend:
+    # quantized_model квантована bitsandbytes; на CPU нужна базовая модель в полной точности (CPU_BASE_MODEL)
+    model = load_cpu_model(cpu_base_model_path(), CPU_DTYPE, static_cache=CPU_STATIC_CACHE)
+else:
+    # Шарды safetensors (export_models.py build) отображаются в память без промежуточной копии весов
+    model = AutoModelForCausalLM.from_pretrained(base_model_path, low_cpu_mem_usage=True)
+    if os.getenv("WARMUP_COMPILE", "0") == "1" and device == "cuda":
+        # Шаг декодирования захватывается в CUDA-граф при прогреве (см. warmup.py)
+        compile_for_decoding(model, os.getenv("WARMUP_COMPILE_MODE", "reduce-overhead"))
+base_tokenizer = AutoTokenizer.from_pretrained(base_model_path)
 if base_tokenizer.pad_token is None:
     base_tokenizer.pad_token = base_tokenizer.eos_token
 
-# --- Словарь для выбора модели, токенизатора и пути к файлу ---
-agent_map = {
-    "Сеть": {
-        "model": None,
-        "tokenizer": None,
-        "file_path": os.path.join(base_dir, "Сеть.txt")
-    },
-    "Приложение": {
-        "model": None,
-        "tokenizer": None,
-        "file_path": os.path.join(base_dir, "Приложение.txt")
-    },
-    "Оборудование": {
-        "model": None,
-        "tokenizer": None,
-        "file_path": os.path.join(base_dir, "Оборудование.txt")
-    },
-    "Доступ и пароли": {
-        "model": None,
-        "tokenizer": None,
-        "file_path": os.path.join(base_dir, "Доступ и пароли.txt")
-    },
-    "Безопасность": {
-        "model": None,
-        "tokenizer": None,
-        "file_path": os.path.join(base_dir, "Безопасность.txt")
-    }
-}
-
-# --- Загрузка моделей и токенизаторов ---
-for agent in agent_map:
-    agent_map[agent]["tokenizer"] = AutoTokenizer.from_pretrained(os.path.join(base_dir, f"{agent}/best_model"))
-    agent_map[agent]["model"] = PeftModel.from_pretrained(model, os.path.join(base_dir, f"{agent}/best_model"))
-    if agent_map[agent]["tokenizer"].pad_token is None:
-        agent_map[agent]["tokenizer"].pad_token = agent_map[agent]["tokenizer"].eos_token
+# --- Пул агентов: адаптеры и токенизаторы загружаются при первом обращении ---
+agent_pool = AgentPool(
+    model,
+    memory_budget_mb=int(os.getenv("AGENT_MEMORY_BUDGET_MB", 2048)),
+    idle_ttl_seconds=int(os.getenv("AGENT_IDLE_TTL_SECONDS", 1800)),
+    merged_dir=os.getenv("EXPORT_DIR", artifact_path("merged", os.path.join(base_dir, "exported_models"))) if use_cpu_backend else None,
+    cpu_dtype=CPU_DTYPE,
+    static_cache=CPU_STATIC_CACHE,
+    adapter_stack=AdapterStack.open(os.getenv("ADAPTER_STACK_DIR", os.path.join(ARTIFACTS_DIR, "adapters")))
+)
+preload_agents = [a.strip() for a in os.getenv("AGENT_PRELOAD", "").split(",") if a.strip()]
 
 local_emb_model_path = os.path.join(base_dir, "frida_embedding_model")
-emb_model = SentenceTransformer(local_emb_model_path, device=device)
-
-class ParagraphRetriever(BaseRetriever):
-    paragraphs: Dict[str, List[str]]  # Храним параграфы по агентам
-    paragraph_embeddings: Dict[str, List[NDArray]]  # Храним эмбеддинги по агентам
-    embeddings_model: SentenceTransformer
-    similarity_threshold: float = 0.25
-    prompt_token_len: int = 0
-    history_tokens: int = 0
-    question_tokens: int = 0
-    reserved_output_tokens: int = 150
-    tokenizer: Optional[PreTrainedTokenizerBase] = None
-    current_agent: Optional[str] = None  # ← добавьте эту строку
-
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self._last_context_tokens = 0
-        template_sample = "Ты — помощник, который строго отвечает только на основании предоставленного контекста и истории чата в одно предложение. Если контекста нет, отвечай на общие вопросы как дружелюбный бот (приветствия, прощания и т.д.).\n\n"
-        self.tokenizer = agent_map["Сеть"]["tokenizer"]
-        self.prompt_token_len = len(self.tokenizer.encode(template_sample))
-        self.paragraphs = {}  # Кэш параграфов
-        self.paragraph_embeddings = {}  # Кэш эмбеддингов
-        self.load_all_paragraphs()  # Загружаем все эмбеддинги при инициализации
-
-    def set_dynamic_limits(self, question_tokens: int, history_tokens: int, max_total_tokens: int = 8192):
-        self.question_tokens = question_tokens
-        self.history_tokens = history_tokens
-
-    def load_all_paragraphs(self):
-        """Загружает или вычисляет эмбеддинги параграфов для всех агентов и кэширует их."""
-        for agent, config in agent_map.items():
-            file_path = config["file_path"]
-            if not os.path.exists(file_path):
-                logger.error(f"Файл {file_path} не найден.")
-                self.paragraphs[agent] = []
-                self.paragraph_embeddings[agent] = np.array([], dtype=np.float32)
-                continue
-            
-            # Чтение файла
-            with open(file_path, "r", encoding="utf-8") as f:
-                text = f.read()
-            paragraphs = split_into_paragraphs(text)
-            logger.info(f"Разбито на {len(paragraphs)} абзацев из файла {file_path}")
-
-            try:
-                # Проверка, есть ли записи в ChromaDB
-                results = collection.get(where={"agent": agent}, include=["documents", "embeddings", "metadatas"])
-                existing_ids = results["ids"]
-                logger.info(f"Найдено {len(existing_ids)} записей в ChromaDB для агента {agent}")
-
-                if not existing_ids:
-                    if not paragraphs:
-                        logger.warning(f"Нет параграфов для агента {agent}")
-                        self.paragraphs[agent] = []
-                        self.paragraph_embeddings[agent] = np.array([], dtype=np.float32)
-                        continue
-                    
-                    # Вычисление эмбеддингов
-                    paragraph_embeddings = self.embeddings_model.encode(
-                        paragraphs,
-                        prompt_name="search_document",
-                        convert_to_numpy=True,
-                        normalize_embeddings=True
-                    )
-                    
-                    # Проверка формы и типа эмбеддингов
-                    if not isinstance(paragraph_embeddings, np.ndarray) or paragraph_embeddings.ndim != 2:
-                        logger.error(f"Некорректная форма эмбеддингов для агента {agent}: {type(paragraph_embeddings)}")
-                        self.paragraphs[agent] = []
-                        self.paragraph_embeddings[agent] = np.array([], dtype=np.float32)
-                        continue
-                    
-                    # Проверка на NaN
-                    if np.any(np.isnan(paragraph_embeddings)):
-                        logger.error(f"Обнаружены NaN в эмбеддингах для агента {agent}")
-                        self.paragraphs[agent] = []
-                        self.paragraph_embeddings[agent] = np.array([], dtype=np.float32)
-                        continue
-                    
-                    # Сохранение в ChromaDB
-                    ids = [f"{agent}_{i}" for i in range(len(paragraphs))]
-                    collection.add(
-                        documents=paragraphs,
-                        embeddings=paragraph_embeddings.tolist(),
-                        metadatas=[{"agent": agent} for _ in paragraphs],
-                        ids=ids
-                    )
-                    logger.info(f"Сохранены {len(paragraphs)} эмбеддингов для агента {agent} в ChromaDB, shape: {paragraph_embeddings.shape}")
-                    self.paragraphs[agent] = paragraphs
-                    self.paragraph_embeddings[agent] = paragraph_embeddings
-                else:
-                    # Загрузка из ChromaDB
-                    paragraphs = results["documents"]
-                    embeddings = results["embeddings"]
-                    
-                    if not paragraphs or not embeddings:
-                        logger.error(f"Пустые данные из ChromaDB для агента {agent}: documents={len(paragraphs)}, embeddings={len(embeddings)}")
-                        self.paragraphs[agent] = []
-                        self.paragraph_embeddings[agent] = np.array([], dtype=np.float32)
-                        continue
-                    
-                    # Преобразование эмбеддингов
-                    try:
-                        embeddings = np.array(embeddings, dtype=np.float32)
-                        if embeddings.ndim != 2 or embeddings.shape[0] != len(paragraphs):
-                            logger.error(f"Некорректная форма эмбеддингов для агента {agent}: shape={embeddings.shape}, expected {len(paragraphs)} rows")
-                            self.paragraphs[agent] = []
-                            self.paragraph_embeddings[agent] = np.array([], dtype=np.float32)
-                            continue
-                        
-                        if np.any(np.isnan(embeddings)):
-                            logger.error(f"Обнаружены NaN в эмбеддингах из ChromaDB для агента {agent}")
-                            self.paragraphs[agent] = []
-                            self.paragraph_embeddings[agent] = np.array([], dtype=np.float32)
-                            continue
-                        
-                        self.paragraphs[agent] = paragraphs
-                        self.paragraph_embeddings[agent] = embeddings
-                        logger.info(f"Загружено {len(paragraphs)} абзацев для агента {agent}, embeddings shape: {embeddings.shape}")
-                    except (ValueError, TypeError) as e:
-                        logger.error(f"Ошибка преобразования эмбеддингов из ChromaDB для агента {agent}: {e}")
-                        self.paragraphs[agent] = []
-                        self.paragraph_embeddings[agent] = np.array([], dtype=np.float32)
-                        
-            except Exception as e:
-                logger.error(f"Ошибка при загрузке/сохранении эмбеддингов для агента {agent}: {e}")
-                self.paragraphs[agent] = []
-                self.paragraph_embeddings[agent] = np.array([], dtype=np.float32)
-
-    def select_agent(self, query: str) -> Tuple[PreTrainedTokenizerBase, Any, str]:
-        query_emb = self.embeddings_model.encode(
-            query,
-            prompt_name="paraphrase",
-            convert_to_numpy=True,
-            normalize_embeddings=True
-        )
-        agent_names = list(agent_map.keys())
-        agent_embs = self.embeddings_model.encode(
-            agent_names,
-            prompt_name="paraphrase",
-            convert_to_numpy=True,
-            normalize_embeddings=True
-        )
-        sims = cosine_similarity([query_emb], agent_embs)[0]
-        max_sim = max(sims)
-        max_idx = sims.argmax()
-
-        if max_sim < self.similarity_threshold:
-            return None, None, None
-        selected_agent = agent_names[max_idx]
-
-        # Записываем метрику схожести с агентом
-        ai_agent_selection_similarity.labels(agent=selected_agent).observe(float(max_sim))
-
-        logger.info(f"Выбран агент: {selected_agent} (similarity: {max_sim:.2f})")
-        return agent_map[selected_agent]["tokenizer"], agent_map[selected_agent]["model"], agent_map[selected_agent]["file_path"]
-
-    def load_paragraphs(self, file_path: str) -> Tuple[List[str], List[NDArray]]:
-        agent = os.path.basename(file_path).split(".")[0]
-        if agent not in self.paragraphs or agent not in self.paragraph_embeddings:
-            logger.error(f"Эмбеддинги для агента {agent} не найдены в кэше.")
-            return [], []
-        logger.info(f"Используется кэш: загружено {len(self.paragraphs[agent])} абзацев для агента {agent}")
-        return self.paragraphs[agent], self.paragraph_embeddings[agent]
-
-    def _get_relevant_documents(self, query: str) -> List[Document]:
-        """
-        Получает релевантные документы на основе запроса, используя косинусное сходство.
-        
-        Args:
-            query (str): Входной запрос пользователя.
-            
-        Returns:
-            List[Document]: Список релевантных документов или сообщение об ошибке.
-        """
-        if not query or not isinstance(query, str):
-            logger.error("Запрос пуст или не является строкой")
-            return [Document(page_content="Не понял вопрос, уточните, пожалуйста!")]
-
-        if not self.current_agent or self.current_agent not in self.paragraph_embeddings:
-            logger.error(f"Текущий агент {self.current_agent} не найден или отсутствуют эмбеддинги")
-            return [Document(page_content="Не понял вопрос, уточните, пожалуйста!")]
-
-        try:
-            # Кодирование запроса
-            query_emb = self.embeddings_model.encode(
-                query,
-                prompt_name="search_query",
-                convert_to_numpy=True,
-                normalize_embeddings=True
-            )
-            if np.any(np.isnan(query_emb)):
-                logger.error("Обнаружены NaN в эмбеддингах запроса")
-                return [Document(page_content="Не понял вопрос, уточните, пожалуйста!")]
-
-            query_emb = query_emb.reshape(1, -1) if query_emb.ndim == 1 else query_emb
-            logger.info(f"Query embedding shape: {query_emb.shape}")
-
-            # Получение эмбеддингов параграфов
-            paragraph_embs = self.paragraph_embeddings[self.current_agent]
-            if not isinstance(paragraph_embs, np.ndarray) or paragraph_embs.ndim != 2 or paragraph_embs.size == 0:
-                logger.error(f"Эмбеддинги для агента {self.current_agent} некорректны, type: {type(paragraph_embs)}, shape: {getattr(paragraph_embs, 'shape', 'None')}")
-                # Попробуем загрузить из ChromaDB напрямую
-                results = collection.query(
-                    query_embeddings=[query_emb[0].tolist()],
-                    where={"agent": self.current_agent},
-                    n_results=10,
-                    include=["documents", "metadatas", "embeddings"]
-                )
-                if not results["documents"] or not results["embeddings"]:
-                    logger.error(f"Пустые данные из ChromaDB для агента {self.current_agent}: documents={len(results['documents'])}, embeddings={len(results['embeddings'])}")
-                    return [Document(page_content="Не понял вопрос, уточните, пожалуйста!")]
-                
-                self.paragraphs[self.current_agent] = results["documents"]
-                self.paragraph_embeddings[self.current_agent] = np.array(results["embeddings"], dtype=np.float32)
-                paragraph_embs = self.paragraph_embeddings[self.current_agent]
-                logger.info(f"Загружено {len(results['documents'])} документов из ChromaDB для агента {self.current_agent}")
-
-            if np.any(np.isnan(paragraph_embs)):
-                logger.error(f"Обнаружены NaN в эмбеддингах параграфов для агента {self.current_agent}")
-                return [Document(page_content="Не понял вопрос, уточните, пожалуйста!")]
-
-            logger.info(f"Paragraph embeddings shape: {paragraph_embs.shape}")
-
-            # Вычисление косинусного сходства
-            sims = cosine_similarity(query_emb, paragraph_embs)[0]
-            max_similarity = np.max(sims)
-            max_index = np.argmax(sims)
-
-            if max_similarity < self.similarity_threshold:
-                logger.info(f"Максимальное сходство {max_similarity:.2f} ниже порога {self.similarity_threshold}")
-                return [Document(page_content="Не понял вопрос, уточните, пожалуйста!")]
-
-            best_sentence = self.paragraphs[self.current_agent][max_index]
-            if self.tokenizer:
-                self._last_context_tokens = len(self.tokenizer.encode(best_sentence))
-            logger.info(f"Выбран параграф с индексом {max_index}, сходство: {max_similarity:.2f}")
-            return [Document(page_content=best_sentence)]
-
-        except Exception as e:
-            logger.error(f"Ошибка в _get_relevant_documents: {e}")
-            return [Document(page_content="Не понял вопрос, уточните, пожалуйста!")]
-
-    async def _aget_relevant_documents(self, query: str) -> List[Document]:
-        return self._get_relevant_documents(query)
-
-    @property
-    def last_context_tokens(self) -> int:
-        return self._last_context_tokens
-
-# --- Базовый промпт-шаблон для чата ---
-base_instruction = "Ты — помощник, который строго отвечает только на основании предоставленного контекста и истории чата в одно предложение. Если контекста нет, отвечай на общие вопросы как дружелюбный бот (приветствия, прощания и т.д.)."
+# Все вызовы encode идут через сервис эмбеддингов с микро-батчингом (см. embedding_service.py)
+emb_model = EmbeddingService(
+    load_embedding_model(local_emb_model_path, device, os.getenv("EMBEDDING_BACKEND", "torch")),
+    max_batch=int(os.getenv("EMBEDDING_MAX_BATCH", 32)),
+    max_wait_ms=float(os.getenv("EMBEDDING_MAX_WAIT_MS", 2))
+).start()
+
+# --- Реестр агентов: базы знаний и адаптеры обнаруживаются в каталоге AGENTS_DIR ---
+agent_registry = AgentRegistry(os.getenv("AGENTS_DIR", base_dir), embeddings_model=emb_model)
+agent_registry.refresh()
+logger.info(f"Зарегистрированы агенты: {', '.join(agent_registry.agent_names)}")
+
+# --- Обученный маршрутизатор (router.npz рядом с адаптерами), см. router.py ---
+routing_model = load_router(agent_registry.agents_dir)
+
+def reload_routing_model():
+    """Подхватывает новый или переобученный router.npz без перезапуска"""
+    global routing_model
+    if routing_model is None or routing_model.is_stale():
+        candidate = load_router(agent_registry.agents_dir)
+        if candidate is not None:
+            routing_model = candidate
+            logger.info(f"Загружен маршрутизатор {routing_model.head} для агентов: {', '.join(routing_model.agent_names)}")
+    if routing_model is not None and set(routing_model.agent_names) != set(agent_registry.agent_names):
+        logger.warning("Маршрутизатор обучен на другом наборе агентов, используется маршрутизация по реестру")
+    return routing_model
+
+reload_routing_model()
+
+# --- Хранение эмбеддингов параграфов: float32 | float16 | int8, снимки на диске ---
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "float32")
+EMBEDDING_RERANK_K = int(os.getenv("EMBEDDING_RERANK_K", 0))
+EMBEDDING_SNAPSHOT_DIR = os.getenv("EMBEDDING_SNAPSHOT_DIR", os.path.join(base_dir, "embedding_snapshots"))
+
+# --- Режим генерации ответов агентов (plain | prompt_lookup | draft), переопределяется в agents.json ---
+decoder = decoder_from_env(base_dir)
+
+# --- Проверка ответа по контексту: эмбеддинги "paraphrase" параграфов кэшируются при загрузке агента ---
+GROUNDING_CACHE = os.getenv("GROUNDING_CACHE", "1") == "1"
+grounding_verifier = GroundingVerifier(
+    emb_model,
+    threshold=float(os.getenv("GROUNDING_THRESHOLD", 0.5)),
+    overlap_accept=float(os.getenv("GROUNDING_OVERLAP_ACCEPT", 0))
+)
 
 # --- RAG ---
+# agent — поиск только в базе выбранного агента; fallback — при промахе поиск по всем агентам;
+# global — один поиск по всем агентам сразу выбирает и агента, и контекст
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "agent")
+
 retriever = ParagraphRetriever(
     paragraphs={},
     paragraph_embeddings={},
-    embeddings_model=emb_model
+    embeddings_model=emb_model,
+    global_top_k=int(os.getenv("RETRIEVAL_TOP_K", 5)),
+    tokenizer=base_tokenizer,
+    registry=agent_registry,
+    routing_model=routing_model,
+    collection=collection,
+    storage=EMBEDDING_STORAGE,
+    rerank_k=EMBEDDING_RERANK_K,
+    snapshot_root=EMBEDDING_SNAPSHOT_DIR,
+    grounding_verifier=grounding_verifier if GROUNDING_CACHE else None,
+    footprint_callback=agent_pool.add_footprint,
+    fusion=os.getenv("RETRIEVAL_FUSION", "dense"),
+    lexical_weight=float(os.getenv("LEXICAL_WEIGHT", 0.5)),
+    lexical_prefilter_min=int(os.getenv("LEXICAL_PREFILTER_MIN", 0)),
+    lexical_candidates=int(os.getenv("LEXICAL_CANDIDATES", 200)),
+    context_sentences=int(os.getenv("CONTEXT_SENTENCES", 0))
+)
+agent_pool.on_evict(retriever.release_agent)
+
+def activate_agent(agent: str) -> Tuple[PreTrainedTokenizerBase, Any]:
+    """Загружает адаптер и параграфы агента и делает его текущим для retriever"""
+    tokenizer, agent_model = agent_pool.acquire(agent, agent_registry[agent].adapter_path)
+    retriever.current_agent = agent
+    retriever.paragraphs[agent], retriever.paragraph_embeddings[agent] = retriever.load_paragraphs(agent)
+    retriever.tokenizer = tokenizer
+    return tokenizer, agent_model
+
+def on_agent_changed(agent: str, change: str, old_spec: Optional[AgentSpec]):
+    """Сбрасывает загруженные данные изменённого агента; новые версии загрузятся при обращении"""
+    agent_pool.evict(agent, reason="registry")
+    if agent_pool.adapter_stack is not None:
+        agent_pool.adapter_stack.discard(agent)
+    retriever.invalidate_global_index()
+    retriever.release_agent(agent)
+    new_spec = agent_registry.agents.get(agent)
+    if old_spec is not None and (new_spec is None or new_spec.knowledge_base_signature != old_spec.knowledge_base_signature):
+        # База знаний изменилась: эмбеддинги в хранилище будут пересчитаны при следующей загрузке
+        collection.delete(where={"agent": agent})
+        logger.info(f"Удалены устаревшие эмбеддинги агента {agent} из хранилища")
+
+agent_registry.on_change(on_agent_changed)
+
+# --- Фразы для семантической проверки особых случаев (эмбеддинги вычисляются один раз) ---
+spech_phrase = "Передай запрос специалисту."
+profanity_phrases = [
+    "дурак", "идиот", "глупый", "матерное слово",
+    "ругательство", "похабщина"
+]
+greeting_phrase_intents = {
+    "Ты кто?": "who_are_you", "Ты бот?": "who_are_you",
+    "Привет.": "greeting", "Здравствуйте.": "greeting",
+    "Как дела?": "small_talk",
+    "Спасибо.": "thanks",
+    "Пока.": "farewell", "До свидания.": "farewell"
+}
+greeting_phrases = list(greeting_phrase_intents)
+spech_phrase_emb, profanity_phrases_emb, greeting_phrases_emb = (
+    emb_model.encode(
+        phrases,
+        prompt_name="paraphrase",
+        convert_to_numpy=True,
+        normalize_embeddings=True
+    )
+    for phrases in (spech_phrase, profanity_phrases, greeting_phrases)
 )
 
-# --- Функция для рендеринга чата в текст (с контекстом) ---
-def render_chat_with_context(history: List[Dict[str, Any]], current_question: str, context: str, current_username: str) -> str:
-    messages = [{"role": "Система", "content": base_instruction + ("\nКонтекст: " + context if context else "")}]
-    for msg in history:
-        username = msg.get("username")
-        messages.append({"role": username, "content": msg["message"]})
-    messages.append({"role": current_username, "content": current_question})
-    prompt_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in messages]) + "\nAI-помощник:"
-    return prompt_text
-
-# --- Функция для рендеринга только истории (для подсчёта токенов) ---
-def render_history_only(history: List[Dict[str, Any]]) -> str:
-    history_messages = [{"role": "Система", "content": base_instruction}]
-    for msg in history:
-        username = msg.get("username")
-        history_messages.append({"role": username, "content": msg["message"]})
-    history_str = "\n".join([f"{m['role']}: {m['content']}" for m in history_messages])
-    return history_str
+# --- Лексический фильтр (lexicon.json) перед семантическими проверками ---
+lexical_gate = load_lexical_gate(
+    os.getenv("LEXICON_PATH", os.path.join(base_dir, "lexicon.json")),
+    min_coverage=float(os.getenv("LEXICAL_GATE_COVERAGE", 0.8))
+)
+# Порог семантической проверки ругательств, если лексический фильтр нашёл ругательство в длинном сообщении
+PROFANITY_HINT_THRESHOLD = float(os.getenv("PROFANITY_HINT_THRESHOLD", 0.6))
+
+# --- Шаблонные ответы на разговорные намерения; GREETING_RESPONSES=llm возвращает генерацию моделью ---
+GREETING_RESPONSES = os.getenv("GREETING_RESPONSES", "template")
+response_templates = load_response_templates(
+    os.getenv("RESPONSE_TEMPLATES_PATH", os.path.join(base_dir, "responses.json")),
+    os.getenv("RESPONSE_PROFILE", "default")
+)
 
 # --- Функция для обработки запросов ---
 def process_query(query: str, message_history: List[Dict[str, Any]] = None, current_username: str = "Пользователь", chat_id: str = None) -> Tuple[str, List[Dict[str, Any]]]:
@@ -410,61 +257,57 @@ def process_query(query: str, message_history: List[Dict[str, Any]] = None, curr
             logger.warning("Empty query received", extra={"chat_id": chat_id})
             return "Введите корректный запрос.", message_history
 
+        # Быстрый лексический фильтр: очевидные приветствия и ругательства без обращения к моделям
+        lexical_intent, lexical_phrase, lexical_decided = lexical_gate.classify(query) if lexical_gate else (None, None, False)
+        lexical_hint = None
+        if lexical_intent is not None:
+            logger.info(f"Лексический фильтр: {lexical_intent}, фраза: '{lexical_phrase}'"
+                        + ("" if lexical_decided else " (подсказка)"))
+            if not lexical_decided:
+                lexical_hint, lexical_intent = lexical_intent, None
+
         # Проверка на фразу "Передай запрос специалисту."
-        query_emb = emb_model.encode(
-            query,
-            prompt_name="paraphrase",
-            convert_to_numpy=True,
-            normalize_embeddings=True
-        )
-        spech_phrase = "Передай запрос специалисту."
-        phrase_emb = emb_model.encode(
-            spech_phrase,
-            prompt_name="paraphrase",
-            convert_to_numpy=True,
-            normalize_embeddings=True
-        )
-        sim = cosine_similarity([query_emb], [phrase_emb])[0][0]
-        if sim >= 0.7:
-            status = "escalated"
-            selected_agent = "specialist"
-            ai_requests_total.labels(agent=selected_agent, status=status).inc()
-            ai_special_cases_total.labels(case_type="escalation").inc()
+        query_emb = None
+        if lexical_intent is None:
+            # Тот же эмбеддинг "paraphrase" используется маршрутизацией по реестру (кэш retriever)
+            query_emb = retriever.encode_query(query, "paraphrase")
+            sim = float(spech_phrase_emb @ query_emb)
+            if sim >= 0.7:
+                status = "escalated"
+                selected_agent = "specialist"
+                ai_requests_total.labels(agent=selected_agent, status=status).inc()
+                ai_special_cases_total.labels(case_type="escalation").inc()
 
-            answer = "Запрос передан специалисту. Пожалуйста, подождите."
-            duration = time.time() - start_time
+                answer = "Запрос передан специалисту. Пожалуйста, подождите."
+                duration = time.time() - start_time
 
-            logger.info("Запрос передан специалисту", extra={
-                "chat_id": chat_id,
-                "username": current_username,
-                "similarity": float(sim),
-                "duration": duration,
-                "status": status
-            })
+                logger.info("Запрос передан специалисту", extra={
+                    "chat_id": chat_id,
+                    "username": current_username,
+                    "similarity": float(sim),
+                    "duration": duration,
+                    "status": status
+                })
 
-            ai_request_duration_seconds.labels(agent=selected_agent).observe(duration)
+                ai_request_duration_seconds.labels(agent=selected_agent).observe(duration)
 
-            message_history.append({"username": current_username, "message": query})
-            message_history.append({"answer": answer})
-            return answer, message_history
+                message_history.append({"username": current_username, "message": query})
+                message_history.append({"answer": answer})
+                return answer, message_history
 
         # Проверка на ненормативную лексику
-        profanity_phrases = [
-            "дурак", "идиот", "глупый", "матерное слово",
-            "ругательство", "похабщина"
-        ]
-        profanity_emb = emb_model.encode(
-            profanity_phrases,
-            prompt_name="paraphrase",
-            convert_to_numpy=True,
-            normalize_embeddings=True
-        )
-        profanity_sims = cosine_similarity([query_emb], profanity_emb)[0]
-        max_profanity_sim = max(profanity_sims)
-        max_profanity_idx = profanity_sims.argmax()
-        
-        logger.info(f"Ненормативная лексика - max_sim: {max_profanity_sim:.3f}, фраза: '{profanity_phrases[max_profanity_idx]}'")
-        if max_profanity_sim >= 0.7:
+        if lexical_intent == LexicalGate.PROFANITY:
+            max_profanity_sim, matched_profanity = 1.0, lexical_phrase
+        elif lexical_intent is None:
+            profanity_sims = profanity_phrases_emb @ query_emb
+            max_profanity_idx = int(profanity_sims.argmax())
+            max_profanity_sim, matched_profanity = float(profanity_sims[max_profanity_idx]), profanity_phrases[max_profanity_idx]
+            logger.info(f"Ненормативная лексика - max_sim: {max_profanity_sim:.3f}, фраза: '{matched_profanity}'")
+        else:
+            max_profanity_sim, matched_profanity = 0.0, None
+
+        profanity_threshold = PROFANITY_HINT_THRESHOLD if lexical_hint == LexicalGate.PROFANITY else 0.7
+        if max_profanity_sim >= profanity_threshold:
             status = "profanity"
             selected_agent = "moderation"
             ai_requests_total.labels(agent=selected_agent, status=status).inc()
@@ -477,7 +320,9 @@ def process_query(query: str, message_history: List[Dict[str, Any]] = None, curr
                 "chat_id": chat_id,
                 "username": current_username,
                 "similarity": float(max_profanity_sim),
-                "matched_phrase": profanity_phrases[max_profanity_idx],
+                "matched_phrase": matched_profanity,
+                "source": "lexical" if lexical_intent else "semantic",
+                "lexical_hint": lexical_hint,
                 "duration": duration
             })
 
@@ -488,48 +333,49 @@ def process_query(query: str, message_history: List[Dict[str, Any]] = None, curr
             return answer, message_history
 
         # Проверка на приветствия
-        greeting_phrases = [
-            "Ты кто?", "Ты бот?",
-            "Привет.", "Здравствуйте.",
-            "Как дела?",
-            "Спасибо.",
-            "Пока.", "До свидания."
-        ]
-        phrases_emb = emb_model.encode(
-            greeting_phrases,
-            prompt_name="paraphrase",
-            convert_to_numpy=True,
-            normalize_embeddings=True
-        )
-        similarities = cosine_similarity([query_emb], phrases_emb)[0]
-        max_sim_idx = np.argmax(similarities)
-        max_similarity = similarities[max_sim_idx]
-        
-        logger.info(f"Приветствие - max_sim: {max_similarity:.3f}, фраза: '{greeting_phrases[max_sim_idx]}'")
+        if lexical_intent is not None:
+            max_similarity, matched_greeting, greeting_intent = 1.0, lexical_phrase, lexical_intent
+        else:
+            similarities = greeting_phrases_emb @ query_emb
+            max_sim_idx = int(np.argmax(similarities))
+            max_similarity, matched_greeting = float(similarities[max_sim_idx]), greeting_phrases[max_sim_idx]
+            greeting_intent = greeting_phrase_intents[matched_greeting]
+            logger.info(f"Приветствие - max_sim: {max_similarity:.3f}, фраза: '{matched_greeting}'")
 
         if max_similarity >= 0.7:
             status = "greeting"
             selected_agent = "base_model"
             ai_special_cases_total.labels(case_type="greeting").inc()
 
-            full_prompt = render_chat_with_context(message_history, query, "", current_username)
-
-            hf_pipeline = pipeline(
-                "text-generation",
-                model=model,
-                tokenizer=base_tokenizer,
-                max_new_tokens=150,
-                temperature=0.1,
-                top_p=0.95,
-                repetition_penalty=1.1,
-                return_full_text=False
-            )
+            first_sentence = None
+            if GREETING_RESPONSES == "template" and response_templates is not None:
+                first_sentence = response_templates.render(greeting_intent, current_username)
+
+            response_source = "template"
+            if first_sentence is None:
+                # Генерация базовой моделью: явно включена или для намерения нет шаблонов
+                response_source = "llm"
+                full_prompt = render_chat_with_context(message_history, query, "", current_username)
+
+                with agent_pool.base_model_only() as greeting_model:
+                    hf_pipeline = pipeline(
+                        "text-generation",
+                        model=greeting_model,
+                        tokenizer=base_tokenizer,
+                        max_new_tokens=150,
+                        temperature=0.1,
+                        top_p=0.95,
+                        repetition_penalty=1.1,
+                        return_full_text=False
+                    )
+
+                    generated = hf_pipeline(full_prompt)
+                answer_text = generated[0]['generated_text'].strip()
 
-            generated = hf_pipeline(full_prompt)
-            answer_text = generated[0]['generated_text'].strip()
+                sentences = list(sentenize(answer_text))
+                first_sentence = sentences[0].text if sentences else answer_text
 
-            sentences = list(sentenize(answer_text))
-            first_sentence = sentences[0].text if sentences else answer_text
+            ai_canned_responses_total.labels(intent=greeting_intent, source=response_source).inc()
 
             duration = time.time() - start_time
             ai_requests_total.labels(agent=selected_agent, status=status).inc()
@@ -538,8 +384,11 @@ def process_query(query: str, message_history: List[Dict[str, Any]] = None, curr
             logger.info("Обработано приветствие", extra={
                 "chat_id": chat_id,
                 "username": current_username,
-                "matched_phrase": greeting_phrases[max_sim_idx],
+                "matched_phrase": matched_greeting,
+                "intent": greeting_intent,
                 "similarity": float(max_similarity),
+                "source": "lexical" if lexical_intent else "semantic",
+                "response_source": response_source,
                 "duration": duration,
                 "answer_length": len(first_sentence)
             })
@@ -548,9 +397,18 @@ def process_query(query: str, message_history: List[Dict[str, Any]] = None, curr
             message_history.append({"answer": first_sentence})
             return first_sentence, message_history
 
-        # Выбор агента
-        selected_tokenizer, selected_model, file_path = retriever.select_agent(query)
-        if selected_tokenizer is None or selected_model is None:
+        # Выбор агента: по маршрутизатору или, в глобальном режиме, по лучшему параграфу среди всех агентов
+        global_hit = None
+        if RETRIEVAL_MODE == "global":
+            global_hit = retriever.best_global_hit(query)
+            agent_name = global_hit[0] if global_hit else None
+        else:
+            agent_name, _ = retriever.select_agent_name(query)
+            if agent_name is None and RETRIEVAL_MODE == "fallback":
+                global_hit = retriever.best_global_hit(query)
+                agent_name = global_hit[0] if global_hit else None
+
+        if agent_name is None:
             status = "no_agent"
             ai_requests_total.labels(agent="none", status=status).inc()
             ai_special_cases_total.labels(case_type="no_context").inc()
@@ -567,28 +425,41 @@ def process_query(query: str, message_history: List[Dict[str, Any]] = None, curr
 
             return "Не понял вопрос, уточните, пожалуйста!", message_history
 
-        # Устанавливаем текущего агента
-        retriever.current_agent = os.path.basename(file_path).split(".")[0]
-        selected_agent = retriever.current_agent
+        selected_tokenizer, selected_model = activate_agent(agent_name)
+        selected_agent = agent_name
 
         logger.info("Выбран агент", extra={
             "chat_id": chat_id,
             "agent": selected_agent
         })
-        retriever.paragraphs[retriever.current_agent], retriever.paragraph_embeddings[retriever.current_agent] = retriever.load_paragraphs(file_path)
 
-        # Устанавливаем токенизатор для retriever
-        retriever.tokenizer = selected_tokenizer
+        if global_hit is not None:
+            docs = [retriever.document_for(selected_agent, global_hit[1], query)]
+        else:
+            docs = retriever._get_relevant_documents(query)
+            if docs[0].page_content == "Не понял вопрос, уточните, пожалуйста!" and RETRIEVAL_MODE == "fallback":
+                # Контекста у выбранного агента нет — проверяем базы знаний остальных агентов
+                global_hit = retriever.best_global_hit(query)
+                if global_hit is not None:
+                    outcome = "confirmed" if global_hit[0] == selected_agent else "switched"
+                    ai_global_retrieval_total.labels(outcome=outcome).inc()
+                    logger.info(f"Глобальный поиск: агент {selected_agent} → {global_hit[0]} (similarity: {global_hit[2]:.2f})")
+                    if global_hit[0] != selected_agent:
+                        selected_tokenizer, selected_model = activate_agent(global_hit[0])
+                        selected_agent = global_hit[0]
+                    docs = [retriever.document_for(selected_agent, global_hit[1], query)]
+                else:
+                    ai_global_retrieval_total.labels(outcome="miss").inc()
+
         question_tokens = len(selected_tokenizer.encode(query))
-        
+
         # Предварительный расчёт истории
         history_str = render_history_only(message_history)
         history_tokens = len(selected_tokenizer.encode(history_str))
-        
+
         # Устанавливаем лимиты
         retriever.set_dynamic_limits(question_tokens=question_tokens, history_tokens=history_tokens, max_total_tokens=8192)
 
-        docs = retriever._get_relevant_documents(query)
         if docs[0].page_content == "Не понял вопрос, уточните, пожалуйста!":
             status = "no_context"
             ai_requests_total.labels(agent=selected_agent, status=status).inc()
@@ -656,35 +527,30 @@ def process_query(query: str, message_history: List[Dict[str, Any]] = None, curr
 
         logger.info(f"Токены (после обрезки): история={history_tokens}, вопрос={question_tokens}, контекст={context_tokens}")
 
-        # Pipeline для генерации
-        hf_pipeline = pipeline(
-            "text-generation",
-            model=selected_model,
-            tokenizer=selected_tokenizer,
+        full_prompt = render_chat_with_context(message_history, query, context, current_username)
+
+        # Генерация в режиме агента: черновые токены из контекста или малой модели проверяются моделью агента
+        generated_text, _ = decoder.generate(
+            selected_model,
+            selected_tokenizer,
+            full_prompt,
             max_new_tokens=retriever.reserved_output_tokens,
-            temperature=0.1,
-            top_p=0.95,
-            repetition_penalty=1.1,
-            return_full_text=False
+            decoding=agent_registry[selected_agent].decoding
         )
-
-        full_prompt = render_chat_with_context(message_history, query, context, current_username)
-        
-        generated = hf_pipeline(full_prompt)
-        answer_text = generated[0]['generated_text'].strip()
+        answer_text = generated_text.strip()
         
         sentences = list(sentenize(answer_text))
         first_sentence = sentences[0].text if sentences else answer_text
 
-        # Проверка сходства ответа с контекстом
+        # Проверка сходства ответа с контекстом (кодируется только ответ, эмбеддинг параграфа берётся из кэша)
         if context:
-            answer_emb = emb_model.encode(first_sentence, prompt_name="paraphrase", convert_to_numpy=True, normalize_embeddings=True)
-            context_emb = emb_model.encode(context, prompt_name="paraphrase", convert_to_numpy=True, normalize_embeddings=True)
-            similarity = cosine_similarity([answer_emb], [context_emb])[0][0]
-
-            ai_context_similarity.observe(float(similarity))
+            grounded, similarity, grounding_method = grounding_verifier.check(
+                first_sentence, context, retriever.grounding_embedding(context)
+            )
+            if similarity is not None:
+                ai_context_similarity.observe(similarity)
 
-            if similarity < 0.5:
+            if not grounded:
                 status = "escalated"
                 ai_requests_total.labels(agent=selected_agent, status=status).inc()
                 ai_special_cases_total.labels(case_type="low_similarity").inc()
@@ -697,7 +563,8 @@ def process_query(query: str, message_history: List[Dict[str, Any]] = None, curr
                 logger.warning("Низкая схожесть ответа с контекстом", extra={
                     "chat_id": chat_id,
                     "agent": selected_agent,
-                    "similarity": float(similarity),
+                    "similarity": similarity,
+                    "grounding_method": grounding_method,
                     "duration": duration
                 })
             else:
@@ -713,7 +580,8 @@ def process_query(query: str, message_history: List[Dict[str, Any]] = None, curr
                     "chat_id": chat_id,
                     "agent": selected_agent,
                     "username": current_username,
-                    "context_similarity": float(similarity),
+                    "context_similarity": similarity,
+                    "grounding_method": grounding_method,
                     "duration": duration,
                     "total_tokens": total_tokens,
                     "answer_length": len(first_sentence)
@@ -738,16 +606,59 @@ def process_query(query: str, message_history: List[Dict[str, Any]] = None, curr
 
         return "Произошла ошибка при обработке запроса.", message_history
 
+# --- Прогрев перед приёмом сообщений (см. warmup.py) ---
+WARMUP_AGENTS = os.getenv("WARMUP_AGENTS", "preload")
+WARMUP_QUESTIONS = int(os.getenv("WARMUP_QUESTIONS", 2))
+WARMUP_ROUNDS = int(os.getenv("WARMUP_ROUNDS", 2))
+
+def warm_up_agent(agent: str, report: WarmupReport):
+    """Один круг прогрева агента: те же этапы, что у запроса, на его типичных вопросах"""
+    spec = agent_registry[agent]
+    for question in warmup_questions(spec, WARMUP_QUESTIONS):
+        with report.stage(agent, "encode"):
+            emb_model.encode(question, prompt_name="paraphrase", convert_to_numpy=True, normalize_embeddings=True)
+            retriever.select_agent_name(question)
+        with report.stage(agent, "retrieve"):
+            tokenizer, agent_model = activate_agent(agent)
+            docs = retriever._get_relevant_documents(question)
+        with report.stage(agent, "generate"):
+            prompt = render_chat_with_context([], question, docs[0].page_content, "Пользователь")
+            decoder.generate(agent_model, tokenizer, prompt, max_new_tokens=retriever.reserved_output_tokens,
+                             decoding=spec.decoding)
+
 # --- RabbitMQ интеграция ---
 RABBITMQ_HOST = os.getenv('RABBITMQ_HOST')
 QUEUE_IN = os.getenv('QUEUE_IN')
 QUEUE_OUT = os.getenv('QUEUE_OUT')
 BOT_USERNAME = "AI-помощник"
+PUBLISH_CONFIRMS = os.getenv("PUBLISH_CONFIRMS", "1") == "1"
+PREFETCH_COUNT = int(os.getenv("PREFETCH_COUNT", 4))
+PUBLISH_CONFIRM_TIMEOUT = float(os.getenv("PUBLISH_CONFIRM_TIMEOUT", 30))
+response_output: Optional[ResponseOutput] = None
+# Истории чатов для запросов с дельтой истории (см. wire.py)
+history_cache = HistoryCache(max_chats=int(os.getenv("WIRE_HISTORY_CACHE_CHATS", 10000)))
+# Профилирование следующих N запросов по сигналу или /profile сервера метрик (см. profiling.py)
+profiler = RequestProfiler(
+    os.getenv("PROFILE_DIR", os.path.join(base_dir, "profiles")),
+    max_requests=int(os.getenv("PROFILE_MAX_REQUESTS", 20)),
+    sample_interval_ms=float(os.getenv("PROFILE_SAMPLE_MS", 5))
+)
+# Запись обезличенного входящего трафика для воспроизведения (python traffic.py replay, см. traffic.py)
+TRAFFIC_CAPTURE = os.getenv("TRAFFIC_CAPTURE", "")
+traffic_recorder = TrafficRecorder(TRAFFIC_CAPTURE, max_records=int(os.getenv("TRAFFIC_CAPTURE_MAX", 100000))) if TRAFFIC_CAPTURE else None
 
 def callback(ch, method, properties, body):
     is_manager = False  # Локальная переменная
     try:
-        data = json.loads(body)
+        # Запрос версии 1 (JSON с полной историей) или 2 (JSON/msgpack, возможно дельта истории)
+        data = decode_request(body, properties.content_type, history_cache)
+        if traffic_recorder is not None:
+            # Воспроизведение идёт по времени получения; время отправки сохраняется отдельно
+            traffic_recorder.record(data, sent_at=properties.timestamp)
+        ai_wire_requests_total.labels(
+            format=data["_format"],
+            history="legacy" if data["_version"] < 2 else "resync" if data["_resync"] else "delta" if data["_delta"] else "full"
+        ).inc()
         query = data.get('message', '')
         message_history = data.get('messageHistory', [])
         chat_id = data.get('chatId', None)
@@ -759,7 +670,9 @@ def callback(ch, method, properties, body):
         
         logger.info(f"Получен запрос из RabbitMQ: {query}")
         
-        answer, new_history = process_query(query, message_history, current_username, chat_id)
+        request_id = properties.message_id or uuid.uuid4().hex
+        with profiler.capture(request_id, chat_id):
+            answer, new_history = process_query(query, message_history, current_username, chat_id)
 
         if answer == "Запрос передан специалисту. Пожалуйста, подождите.":
             is_manager = True
@@ -771,28 +684,73 @@ def callback(ch, method, properties, body):
             'isManager': is_manager
         }
 
-        ch.basic_publish(exchange='', routing_key=QUEUE_OUT, body=json.dumps(response))
+        # Вход подтверждается после подтверждения ответа брокером (см. publisher.py)
+        response_body, content_type = encode_response(response, data)
+        response_output.send(method.delivery_tag, response_body, content_type)
         logger.info(f"Отправлен ответ в {QUEUE_OUT}: {answer}")
-        
-        ch.basic_ack(delivery_tag=method.delivery_tag)
     except Exception as e:
         logger.error(f"Ошибка в callback: {e}")
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        response_output.reject(method.delivery_tag)
 
 if __name__ == "__main__":
     # Запускаем сервер метрик Prometheus на порту 1234
     metrics_port = int(os.getenv('METRICS_PORT', 1234))
     start_metrics_server(port=metrics_port)
     logger.info(f"Сервер метрик Prometheus запущен на порту {metrics_port}")
+    # /profile открыт всем, кто видит порт метрик, поэтому подключается только явно
+    if os.getenv("PROFILE_HTTP", "0") == "1":
+        add_route("/profile", profiler.http_handler)
+    profiler.install_signal(int(os.getenv("PROFILE_SIGNAL_REQUESTS", 5)))
+
+    # Предзагрузка «горячих» агентов, остальные загружаются при первом обращении
+    for agent in preload_agents:
+        if agent not in agent_registry:
+            logger.warning(f"Агент {agent} из AGENT_PRELOAD не найден")
+            continue
+        agent_pool.acquire(agent, agent_registry[agent].adapter_path)
+        retriever.ensure_agent_paragraphs(agent)
+
+    if RETRIEVAL_MODE != "agent":
+        retriever.build_global_index()
+
+    # Сообщения принимаются только после прогрева: /ready сервера метрик отвечает 200 с этого момента
+    run_warmup(select_warmup_agents(WARMUP_AGENTS, agent_registry.agent_names, preload_agents), warm_up_agent, WARMUP_ROUNDS)
 
     connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
     channel = connection.channel()
 
+    # Периодическая выгрузка простаивающих агентов в потоке консьюмера
+    idle_check_interval = int(os.getenv("AGENT_IDLE_CHECK_SECONDS", 60))
+
+    def evict_idle_agents():
+        agent_pool.evict_idle()
+        connection.call_later(idle_check_interval, evict_idle_agents)
+
+    connection.call_later(idle_check_interval, evict_idle_agents)
+
+    # Отслеживание добавленных и изменённых агентов без перезапуска
+    registry_poll_interval = int(os.getenv("AGENT_REGISTRY_POLL_SECONDS", 30))
+
+    def refresh_agent_registry():
+        try:
+            agent_registry.refresh()
+            retriever.routing_model = reload_routing_model()
+        except Exception as e:
+            logger.error(f"Ошибка синхронизации реестра агентов: {e}")
+        connection.call_later(registry_poll_interval, refresh_agent_registry)
+
+    connection.call_later(registry_poll_interval, refresh_agent_registry)
+
     channel.queue_declare(queue=QUEUE_IN, durable=True)
     channel.queue_declare(queue=QUEUE_OUT, durable=True)
 
-    channel.basic_qos(prefetch_count=1)
+    # Ответы публикуются в отдельном соединении с подтверждениями, вход подтверждается пакетами
+    publisher = ConfirmedPublisher(pika.ConnectionParameters(host=RABBITMQ_HOST), QUEUE_OUT).start() if PUBLISH_CONFIRMS else None
+    response_output = ResponseOutput(connection, channel, QUEUE_OUT, publisher, confirm_timeout=PUBLISH_CONFIRM_TIMEOUT)
+
+    channel.basic_qos(prefetch_count=PREFETCH_COUNT if PUBLISH_CONFIRMS else 1)
     channel.basic_consume(queue=QUEUE_IN, on_message_callback=callback)
 
+    set_ready()
     logger.info("Ожидание сообщений из RabbitMQ. Для выхода нажмите CTRL+C")
     channel.start_consuming()
\ No newline at end of file
@@ -0,0 +1,83 @@
+"""
+Манифест файлов модели: размеры и sha256 для проверки целостности и докачки
+
+model_manifest.json лежит в корне каталога модели:
+{"version": 1, "created_at": ..., "files": {"<относительный путь>": {"size": ..., "sha256": ...}}}
+
+ARTIFACTS_DIR — общий корень артефактов export_models.py build (quantized_model/, adapters/,
+merged/); сервис читает модели оттуда, если они собраны, иначе из прежних каталогов.
+"""
+
+import os
+import json
+import time
+import hashlib
+from typing import Dict, List, Optional
+
+MANIFEST_NAME = "model_manifest.json"
+HASH_CHUNK_BYTES = 8 * 1024 * 1024
+ARTIFACTS_DIR = os.getenv("ARTIFACTS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_artifacts"))
+
+
+def artifact_path(name: str, fallback: str) -> str:
+    """Каталог артефакта name в ARTIFACTS_DIR, если он собран, иначе fallback"""
+    path = os.path.join(ARTIFACTS_DIR, name)
+    return path if os.path.isdir(path) else fallback
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _walk_files(root: str) -> List[str]:
+    files = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = sorted(d for d in dir_names if not d.startswith("."))
+        for name in sorted(file_names):
+            if name == MANIFEST_NAME or name.startswith("."):
+                continue
+            files.append(os.path.relpath(os.path.join(dir_path, name), root).replace(os.sep, "/"))
+    return files
+
+
+def build_manifest(root: str) -> Dict:
+    files = {}
+    for rel_path in _walk_files(root):
+        full_path = os.path.join(root, rel_path)
+        files[rel_path] = {"size": os.path.getsize(full_path), "sha256": file_sha256(full_path)}
+    return {"version": 1, "created_at": time.time(), "files": files}
+
+
+def write_manifest(root: str) -> Dict:
+    manifest = build_manifest(root)
+    with open(os.path.join(root, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+def read_manifest(root: str) -> Optional[Dict]:
+    path = os.path.join(root, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def verify_file(root: str, rel_path: str, entry: Dict, check_hash: bool = True) -> bool:
+    path = os.path.join(root, rel_path)
+    if not os.path.isfile(path) or os.path.getsize(path) != entry["size"]:
+        return False
+    # Для файлов без хэша (не-LFS файлы из дерева репозитория) проверяется только размер
+    return not check_hash or entry.get("sha256") is None or file_sha256(path) == entry["sha256"]
+
+
+def missing_or_corrupt(root: str, manifest: Dict, check_hash: bool = True) -> List[str]:
+    """Файлы манифеста, которых нет на диске или которые не совпадают по размеру/хэшу"""
+    return [
+        rel_path for rel_path, entry in manifest["files"].items()
+        if not verify_file(root, rel_path, entry, check_hash)
+    ]
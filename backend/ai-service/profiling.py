@@ -0,0 +1,199 @@
+"""
+Профилирование по запросу в работающем консьюмере
+
+Профилирование включается без перезапуска — сигналом SIGUSR2 или запросом к серверу
+метрик (маршрут /profile без аутентификации, подключается только при PROFILE_HTTP=1):
+    kill -USR2 <pid>                                   # PROFILE_SIGNAL_REQUESTS запросов
+    curl 'http://localhost:1234/profile?requests=5'    # torch=0 / python=0 — выключить часть
+    curl 'http://localhost:1234/profile'               # состояние
+Следующие N запросов, обработанных process_query, записываются в каталог сессии
+PROFILE_DIR/<время>/:
+- <request_id>.torch.json — трасса torch.profiler (CPU и CUDA), открывается в chrome://tracing
+  или Perfetto;
+- <request_id>.folded — сэмплы стека Python потока запроса в формате collapsed stacks
+  (flamegraph.pl, speedscope);
+- index.json — request_id, chatId, длительность и файлы каждого запроса.
+Пока профилирование не включено, обёртка запроса — одна проверка счётчика.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import threading
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAX_STACK_DEPTH = 64
+
+
+class StackSampler:
+    """Сэмплирование стека одного потока через sys._current_frames в фоновом потоке"""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def __enter__(self) -> "StackSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def write_folded(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class RequestProfiler:
+    """Профилирование следующих N запросов; включается из любого потока или обработчика сигнала"""
+
+    def __init__(self, out_dir: str, max_requests: int = 20, sample_interval_ms: float = 5.0):
+        self.out_dir = out_dir
+        self.max_requests = max_requests
+        self.sample_interval = sample_interval_ms / 1000
+        self._remaining = 0
+        self._lock = threading.Lock()
+        self._session_dir: Optional[str] = None
+        self._torch = True
+        self._python = True
+        self._index: List[Dict] = []
+
+    @property
+    def active(self) -> bool:
+        return self._remaining > 0
+
+    def arm(self, requests: int, torch_profile: bool = True, python_profile: bool = True) -> str:
+        """Включает профилирование следующих requests запросов (не больше max_requests)"""
+        requests = max(1, min(requests, self.max_requests))
+        with self._lock:
+            if self._remaining > 0:
+                return f"Профилирование уже идёт: осталось {self._remaining} запросов, {self._session_dir}"
+            now = time.time()
+            self._session_dir = os.path.join(self.out_dir, time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + f".{int(now * 1000) % 1000:03d}")
+            os.makedirs(self._session_dir, exist_ok=True)
+            self._torch, self._python = torch_profile, python_profile
+            self._index = []
+            self._remaining = requests
+        logger.info(f"Профилирование включено: {requests} запросов, трассы в {self._session_dir}")
+        return f"Профилирование {requests} запросов, трассы в {self._session_dir}"
+
+    def status(self) -> str:
+        if self.active:
+            return f"Идёт профилирование: осталось {self._remaining} запросов, {self._session_dir}"
+        return f"Профилирование выключено; последняя сессия: {self._session_dir or '—'}"
+
+    def _claim(self) -> Optional[Tuple[str, bool, bool]]:
+        with self._lock:
+            if self._remaining <= 0:
+                return None
+            self._remaining -= 1
+            return self._session_dir, self._torch, self._python
+
+    @contextmanager
+    def capture(self, request_id: str, chat_id: Optional[str] = None):
+        """Оборачивает обработку запроса; без включённого профилирования ничего не делает"""
+        if self._remaining <= 0:
+            yield
+            return
+        claimed = self._claim()
+        if claimed is None:
+            yield
+            return
+        session_dir, torch_profile, python_profile = claimed
+
+        with ExitStack() as stack:
+            torch_prof, sampler = None, None
+            if torch_profile:
+                try:
+                    torch_prof = stack.enter_context(self._torch_profiler())
+                except Exception as e:
+                    # Ошибка профилировщика не должна ломать обработку запроса
+                    logger.error(f"Не удалось запустить torch.profiler для запроса {request_id}: {e}")
+            if python_profile:
+                sampler = stack.enter_context(StackSampler(threading.get_ident(), self.sample_interval))
+            start = time.time()
+            try:
+                yield
+            finally:
+                duration = time.time() - start
+                stack.close()
+                self._write(session_dir, request_id, chat_id, duration, torch_prof, sampler)
+
+    @staticmethod
+    def _torch_profiler():
+        import torch
+        from torch.profiler import ProfilerActivity, profile
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        return profile(activities=activities, record_shapes=True)
+
+    def _write(self, session_dir: str, request_id: str, chat_id: Optional[str], duration: float,
+               torch_prof, sampler: Optional[StackSampler]):
+        entry = {"request_id": request_id, "chat_id": chat_id, "duration": round(duration, 4), "files": []}
+        try:
+            if torch_prof is not None:
+                torch_prof.export_chrome_trace(os.path.join(session_dir, f"{request_id}.torch.json"))
+                entry["files"].append(f"{request_id}.torch.json")
+            if sampler is not None:
+                sampler.write_folded(os.path.join(session_dir, f"{request_id}.folded"))
+                entry["files"].append(f"{request_id}.folded")
+                entry["samples"] = sum(sampler.samples.values())
+        except Exception as e:
+            logger.error(f"Не удалось записать профиль запроса {request_id}: {e}")
+        with self._lock:
+            self._index.append(entry)
+            finished = self._remaining == 0
+            try:
+                with open(os.path.join(session_dir, "index.json"), "w", encoding="utf-8") as f:
+                    json.dump(self._index, f, ensure_ascii=False, indent=2)
+            except Exception as e:
+                logger.error(f"Не удалось записать index.json сессии профилирования {session_dir}: {e}")
+        logger.info(f"Профиль запроса {request_id} записан в {session_dir}" + (" (сессия завершена)" if finished else ""))
+
+    # --- Управление ---
+    def install_signal(self, requests: int, signum: int = getattr(signal, "SIGUSR2", 0)):
+        """Профилирование requests запросов по сигналу (вызывать из главного потока)"""
+        if not signum:
+            logger.warning("Сигналы для профилирования недоступны на этой платформе")
+            return
+        # arm берёт блокировку, поэтому из обработчика сигнала вызывается в отдельном потоке
+        signal.signal(signum, lambda *_: threading.Thread(target=self.arm, args=(requests,), daemon=True).start())
+
+    def http_handler(self, params: Dict[str, List[str]]) -> Tuple[str, str]:
+        """Обработчик /profile сервера метрик: ?requests=N[&torch=0][&python=0], без параметров — состояние"""
+        if "requests" not in params:
+            return "200 OK", self.status()
+        try:
+            requests = int(params["requests"][0])
+        except ValueError:
+            return "400 Bad Request", "requests должно быть числом"
+
+        def flag(name: str) -> bool:
+            return params.get(name, ["1"])[0] != "0"
+
+        return "200 OK", self.arm(requests, torch_profile=flag("torch"), python_profile=flag("python"))
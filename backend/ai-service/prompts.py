@@ -0,0 +1,29 @@
+"""
+Промпт-шаблон чата: используется сервисом (model.py) и офлайн-инструментами (бенчмарки, оценка)
+"""
+
+from typing import Any, Dict, List
+
+# --- Базовый промпт-шаблон для чата ---
+base_instruction = "Ты — помощник, который строго отвечает только на основании предоставленного контекста и истории чата в одно предложение. Если контекста нет, отвечай на общие вопросы как дружелюбный бот (приветствия, прощания и т.д.)."
+
+
+# --- Функция для рендеринга чата в текст (с контекстом) ---
+def render_chat_with_context(history: List[Dict[str, Any]], current_question: str, context: str, current_username: str) -> str:
+    messages = [{"role": "Система", "content": base_instruction + ("\nКонтекст: " + context if context else "")}]
+    for msg in history:
+        username = msg.get("username")
+        messages.append({"role": username, "content": msg["message"]})
+    messages.append({"role": current_username, "content": current_question})
+    prompt_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in messages]) + "\nAI-помощник:"
+    return prompt_text
+
+
+# --- Функция для рендеринга только истории (для подсчёта токенов) ---
+def render_history_only(history: List[Dict[str, Any]]) -> str:
+    history_messages = [{"role": "Система", "content": base_instruction}]
+    for msg in history:
+        username = msg.get("username")
+        history_messages.append({"role": username, "content": msg["message"]})
+    history_str = "\n".join([f"{m['role']}: {m['content']}" for m in history_messages])
+    return history_str
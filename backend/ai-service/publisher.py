@@ -0,0 +1,284 @@
+"""
+Выходная стадия: публикация ответов с подтверждениями брокера и пакетные ack входа
+
+Ответы публикуются персистентными сообщениями через отдельное соединение
+(pika.SelectConnection в собственном потоке) с включёнными publisher confirms, поэтому
+обработчик запроса не ждёт брокер. Входное сообщение подтверждается только после того,
+как брокер подтвердил ответ на него: подтверждённые ответы копятся, и непрерывный
+префикс входных сообщений подтверждается одним basic_ack(multiple=True). Ответ, не
+принятый брокером (nack или обрыв соединения), возвращает вход в очередь — доставка
+"хотя бы один раз" без ожидания брокера на каждом сообщении. Вход, ответ на который не
+получил результата за confirm_timeout секунд, тоже возвращается в очередь, чтобы
+префикс подтверждений не останавливался.
+
+Входные сообщения обрабатываются консьюмером последовательно, поэтому к моменту
+подтверждения префикса все сообщения с меньшими delivery_tag уже переданы сюда.
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+import pika
+from pika.spec import Basic
+
+from metrics import ai_publish_confirm_seconds, ai_publish_results_total
+
+logger = logging.getLogger(__name__)
+
+PERSISTENT_DELIVERY_MODE = 2
+
+
+class ConfirmedPublisher:
+    """Публикация в очередь с подтверждениями брокера; соединение живёт в своём потоке"""
+
+    def __init__(self, parameters: pika.ConnectionParameters, routing_key: str, exchange: str = "",
+                 content_type: str = "application/json", reconnect_delay: float = 5.0):
+        self.parameters = parameters
+        self.routing_key = routing_key
+        self.exchange = exchange
+        self.content_type = content_type
+        self.reconnect_delay = reconnect_delay
+        self._connection: Optional[pika.SelectConnection] = None
+        self._channel = None
+        self._next_tag = 1
+        # delivery_tag публикации -> (время публикации, обработчик результата); порядок вставки = порядок тегов
+        self._pending: Dict[int, Tuple[float, Callable[[bool], None]]] = {}
+        # Публикации, переданные в ioloop, но ещё не выполненные; если цикл остановится раньше, они отклоняются
+        self._queued: Dict[int, Callable[[bool], None]] = {}
+        self._next_queued = 0
+        # Проверка готовности и постановка в ioloop атомарны относительно остановки цикла
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="response-publisher", daemon=True)
+
+    def start(self, timeout: float = 30.0) -> "ConfirmedPublisher":
+        self._thread.start()
+        if not self._ready.wait(timeout):
+            raise RuntimeError(f"Не удалось открыть канал публикации в {self.routing_key} за {timeout} с")
+        return self
+
+    def stop(self):
+        self._stopping = True
+        if self._connection is not None:
+            self._connection.ioloop.add_callback_threadsafe(self._connection.close)
+        self._thread.join(timeout=10)
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def publish(self, body: bytes, on_result: Callable[[bool], None], content_type: Optional[str] = None):
+        """
+        Ставит сообщение в очередь публикации (из любого потока). on_result(True) вызывается
+        в потоке публикатора после подтверждения брокером, on_result(False) — при отказе.
+        """
+        with self._lock:
+            queued = self._ready.is_set()
+            if queued:
+                queued_id = self._next_queued
+                self._next_queued += 1
+                self._queued[queued_id] = on_result
+                try:
+                    self._connection.ioloop.add_callback_threadsafe(
+                        lambda: self._publish(queued_id, body, content_type or self.content_type)
+                    )
+                except Exception as e:
+                    logger.error(f"Не удалось передать ответ в поток публикации: {e}")
+                    del self._queued[queued_id]
+                    queued = False
+        if not queued:
+            ai_publish_results_total.labels(result="unavailable").inc()
+            on_result(False)
+
+    # --- Поток публикатора ---
+    def _run(self):
+        while not self._stopping:
+            self._connection = pika.SelectConnection(
+                self.parameters,
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_error,
+                on_close_callback=self._on_connection_closed
+            )
+            self._connection.ioloop.start()
+            self._set_unavailable()
+            # Публикации, поставленные в цикл, который уже не выполнит их, и неподтверждённые
+            with self._lock:
+                queued, self._queued = self._queued, {}
+            for on_result in queued.values():
+                ai_publish_results_total.labels(result="lost").inc()
+                on_result(False)
+            self._fail_pending()
+            if not self._stopping:
+                logger.warning(f"Соединение публикации закрыто, переподключение через {self.reconnect_delay} с")
+                time.sleep(self.reconnect_delay)
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, connection, error):
+        logger.error(f"Не удалось подключиться для публикации ответов: {error}")
+        connection.ioloop.stop()
+
+    def _set_unavailable(self):
+        with self._lock:
+            self._ready.clear()
+
+    def _on_connection_closed(self, connection, reason):
+        self._set_unavailable()
+        self._fail_pending()
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        self._next_tag = 1
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(self._on_delivery_confirmation)
+        self._ready.set()
+        logger.info(f"Канал публикации в {self.routing_key} открыт (publisher confirms)")
+
+    def _on_channel_closed(self, channel, reason):
+        logger.warning(f"Канал публикации закрыт: {reason}")
+        self._set_unavailable()
+        self._fail_pending()
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+
+    def _publish(self, queued_id: int, body: bytes, content_type: str):
+        with self._lock:
+            on_result = self._queued.pop(queued_id, None)
+        if on_result is None:
+            return
+        if self._channel is None or not self._channel.is_open:
+            ai_publish_results_total.labels(result="unavailable").inc()
+            on_result(False)
+            return
+        self._channel.basic_publish(
+            exchange=self.exchange,
+            routing_key=self.routing_key,
+            body=body,
+            properties=pika.BasicProperties(delivery_mode=PERSISTENT_DELIVERY_MODE, content_type=content_type)
+        )
+        self._pending[self._next_tag] = (time.time(), on_result)
+        self._next_tag += 1
+
+    def _on_delivery_confirmation(self, frame):
+        method = frame.method
+        ok = isinstance(method, Basic.Ack)
+        tags = [t for t in self._pending if t <= method.delivery_tag] if method.multiple else [method.delivery_tag]
+        now = time.time()
+        for tag in tags:
+            entry = self._pending.pop(tag, None)
+            if entry is None:
+                continue
+            published_at, on_result = entry
+            ai_publish_confirm_seconds.observe(now - published_at)
+            ai_publish_results_total.labels(result="ack" if ok else "nack").inc()
+            on_result(ok)
+
+    def _fail_pending(self):
+        pending, self._pending = self._pending, {}
+        for _, on_result in pending.values():
+            ai_publish_results_total.labels(result="lost").inc()
+            on_result(False)
+
+
+class ResponseOutput:
+    """
+    Отправка ответов консьюмера. С публикатором вход подтверждается после подтверждения
+    ответа, пакетами; без него — прежний синхронный путь (публикация и ack в канале консьюмера).
+    """
+
+    def __init__(self, connection, channel, routing_key: str, publisher: Optional[ConfirmedPublisher] = None,
+                 confirm_timeout: float = 30.0):
+        self.connection = connection
+        self.channel = channel
+        self.routing_key = routing_key
+        self.publisher = publisher
+        self.confirm_timeout = confirm_timeout
+        self._outstanding: Deque[int] = deque()  # Входные delivery_tag в порядке получения
+        self._sent_at: Dict[int, float] = {}  # Входы, ожидающие результата публикации ответа
+        self._settled: Dict[int, bool] = {}  # delivery_tag -> ответ подтверждён (True) или вход отклонён
+        self._results: List[Tuple[int, bool]] = []  # Результаты из потока публикатора
+        self._lock = threading.Lock()
+        self._flush_scheduled = False
+        if publisher is not None and confirm_timeout > 0:
+            self.connection.call_later(self._expiry_interval, self._expire)
+
+    @property
+    def _expiry_interval(self) -> float:
+        return max(self.confirm_timeout / 4, 1.0)
+
+    def send(self, delivery_tag: int, body: bytes, content_type: str = "application/json"):
+        if self.publisher is None:
+            self.channel.basic_publish(
+                exchange="",
+                routing_key=self.routing_key,
+                body=body,
+                properties=pika.BasicProperties(delivery_mode=PERSISTENT_DELIVERY_MODE, content_type=content_type)
+            )
+            self.channel.basic_ack(delivery_tag=delivery_tag)
+            return
+        self._outstanding.append(delivery_tag)
+        self._sent_at[delivery_tag] = time.monotonic()
+        self.publisher.publish(body, lambda ok: self._on_result(delivery_tag, ok), content_type)
+
+    def reject(self, delivery_tag: int):
+        """Отклоняет вход, который не удалось обработать (без возврата в очередь)"""
+        if self.publisher is None:
+            self.channel.basic_nack(delivery_tag=delivery_tag, requeue=False)
+            return
+        self._outstanding.append(delivery_tag)
+        self._settle(delivery_tag, ok=False, requeue=False)
+        self._ack_prefix()
+
+    def _on_result(self, delivery_tag: int, ok: bool):
+        # Поток публикатора: результаты копятся и применяются одним вызовом в потоке консьюмера
+        with self._lock:
+            self._results.append((delivery_tag, ok))
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self.connection.add_callback_threadsafe(self._flush)
+
+    def _flush(self):
+        with self._lock:
+            results, self._results = self._results, []
+            self._flush_scheduled = False
+        for delivery_tag, ok in results:
+            if self._sent_at.pop(delivery_tag, None) is None:
+                continue  # Вход уже возвращён в очередь по таймауту
+            self._settle(delivery_tag, ok, requeue=True)
+        self._ack_prefix()
+
+    def _expire(self):
+        """Возвращает в очередь входы, ответы на которые не получили результата за confirm_timeout"""
+        deadline = time.monotonic() - self.confirm_timeout
+        expired = [delivery_tag for delivery_tag, sent_at in self._sent_at.items() if sent_at <= deadline]
+        for delivery_tag in expired:
+            del self._sent_at[delivery_tag]
+            ai_publish_results_total.labels(result="timeout").inc()
+            self._settle(delivery_tag, ok=False, requeue=True)
+        if expired:
+            logger.warning(f"Нет подтверждения ответа за {self.confirm_timeout} с, входы возвращены в очередь: {expired}")
+            self._ack_prefix()
+        self.connection.call_later(self._expiry_interval, self._expire)
+
+    def _settle(self, delivery_tag: int, ok: bool, requeue: bool):
+        if not ok:
+            # Ответ не принят брокером — вход возвращается в очередь и будет обработан заново
+            self.channel.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
+        self._settled[delivery_tag] = ok
+
+    def _ack_prefix(self):
+        """Одним basic_ack(multiple=True) подтверждает непрерывный префикс обработанных входов"""
+        last_ok = None
+        while self._outstanding and self._outstanding[0] in self._settled:
+            delivery_tag = self._outstanding.popleft()
+            if self._settled.pop(delivery_tag):
+                last_ok = delivery_tag
+        if last_ok is not None:
+            self.channel.basic_ack(delivery_tag=last_ok, multiple=True)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Компактное хранение и скоринг матриц эмбеддингов параграфов (float32 / float16 / int8)
+
+int8 — скалярное квантование с масштабом на вектор: x ≈ codes * scale, scale = max|x| / 127.
+Скоринг идёт прямо по компактному представлению блоками строк, поэтому временная
+копия в float32 не превышает одного блока. Точные float32-векторы могут лежать на диске
+(memory-mapped) и использоваться только для переранжирования лучших кандидатов.
+
+Скоринг float16 и int8 переводит каждый блок в float32 на каждом запросе, поэтому он
+медленнее float32 (float16 — в разы: в NumPy нет BLAS для половинной точности). Для
+экономии памяти рекомендуется int8: вчетверо меньше памяти при умеренной задержке.
+
+Бенчмарк памяти, задержки и recall@1 относительно float32:
+    python quantization.py bench [--synthetic 100000]
+"""
+
+import os
+import json
+import time
+import hashlib
+import argparse
+import logging
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+logger = logging.getLogger(__name__)
+
+STORAGE_TYPES = ("float32", "float16", "int8")
+SCORE_CHUNK_ROWS = 8192
+
+
+class RowBlocks:
+    """
+    Строки нескольких матриц (обычно memory-mapped оригиналов снимков) как одна матрица
+    без копирования: срезы остаются представлениями блоков, выборка по индексам читает
+    только нужные строки.
+    """
+
+    def __init__(self, blocks: Sequence[NDArray]):
+        self.blocks = list(blocks)
+        self.offsets = np.cumsum([0] + [len(block) for block in self.blocks])
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getitem__(self, rows):
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(len(self))
+            if step != 1:
+                raise ValueError("Срезы RowBlocks поддерживаются только с шагом 1")
+            parts = []
+            for block, offset in zip(self.blocks, self.offsets):
+                lo, hi = max(start - offset, 0), min(stop - offset, len(block))
+                if lo < hi:
+                    parts.append(block[lo:hi])
+            return parts[0] if len(parts) == 1 else RowBlocks(parts)
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        out = np.empty((len(rows), self.blocks[0].shape[1]), dtype=np.float32)
+        block_ids = np.searchsorted(self.offsets, rows, side="right") - 1
+        for block_id in np.unique(block_ids):
+            mask = block_ids == block_id
+            out[mask] = self.blocks[block_id][rows[mask] - self.offsets[block_id]]
+        return out
+
+
+class QuantizedEmbeddings:
+    """Матрица нормализованных эмбеддингов (строки — параграфы) в компактном виде"""
+
+    def __init__(self, codes: NDArray, scales: Optional[NDArray] = None, exact: Optional[NDArray] = None):
+        self.codes = codes
+        self.scales = scales
+        self.exact = exact  # float32-оригинал (обычно np.memmap со снимка) для переранжирования
+
+    @classmethod
+    def quantize(cls, embeddings: NDArray, storage: str = "float32", exact: Optional[NDArray] = None) -> "QuantizedEmbeddings":
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if storage == "float32":
+            return cls(np.ascontiguousarray(embeddings), exact=exact)
+        if storage == "float16":
+            return cls(embeddings.astype(np.float16), exact=exact)
+        if storage == "int8":
+            scales = np.abs(embeddings).max(axis=1) / 127.0
+            scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+            codes = np.clip(np.rint(embeddings / scales[:, None]), -127, 127).astype(np.int8)
+            return cls(codes, scales=scales, exact=exact)
+        raise ValueError(f"Неизвестный тип хранения эмбеддингов: {storage}")
+
+    @classmethod
+    def concatenate(cls, blocks: Sequence["QuantizedEmbeddings"]) -> "QuantizedEmbeddings":
+        storages = {block.storage for block in blocks}
+        if len(storages) != 1:
+            raise ValueError(f"Нельзя объединить матрицы с разным типом хранения: {storages}")
+        codes = np.concatenate([block.codes for block in blocks])
+        scales = np.concatenate([block.scales for block in blocks]) if blocks[0].scales is not None else None
+        # memory-mapped оригиналы не склеиваются (это загрузило бы их целиком в память),
+        # а объединяются ссылками; переранжирование возможно, только если оригинал есть у всех блоков
+        exact = None
+        if all(block.exact is not None for block in blocks):
+            exact = blocks[0].exact if len(blocks) == 1 else RowBlocks([block.exact for block in blocks])
+        return cls(codes, scales=scales, exact=exact)
+
+    @property
+    def storage(self) -> str:
+        return self.codes.dtype.name
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.codes.shape
+
+    @property
+    def ndim(self) -> int:
+        return self.codes.ndim
+
+    @property
+    def size(self) -> int:
+        return self.codes.size
+
+    @property
+    def nbytes(self) -> int:
+        """Память, занятая в RAM (memory-mapped оригинал не учитывается)"""
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self) -> int:
+        return self.codes.shape[0]
+
+    def __getitem__(self, rows: slice) -> "QuantizedEmbeddings":
+        return QuantizedEmbeddings(
+            self.codes[rows],
+            scales=self.scales[rows] if self.scales is not None else None,
+            exact=self.exact[rows] if self.exact is not None else None,
+        )
+
+    def dequantize(self, rows: Optional[NDArray] = None) -> NDArray:
+        codes = self.codes if rows is None else self.codes[rows]
+        values = codes.astype(np.float32)
+        if self.scales is not None:
+            values *= (self.scales if rows is None else self.scales[rows])[:, None]
+        return values
+
+    def has_nan(self) -> bool:
+        if self.storage == "int8":
+            return bool(np.any(np.isnan(self.scales)))
+        return bool(np.any(np.isnan(self.codes)))
+
+    def scores(self, query: NDArray) -> NDArray:
+        """Скалярные произведения запроса со всеми строками (косинус для нормализованных векторов)"""
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        if self.storage == "float32":
+            return self.codes @ query
+        out = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), SCORE_CHUNK_ROWS):
+            stop = start + SCORE_CHUNK_ROWS
+            out[start:stop] = self.codes[start:stop].astype(np.float32) @ query
+        if self.scales is not None:
+            out *= self.scales
+        return out
+
+    def top_k(self, query: NDArray, k: int = 1, rerank: int = 0) -> Tuple[NDArray, NDArray]:
+        """
+        Индексы и сходства k лучших строк.
+
+        При rerank > k и наличии float32-оригинала сначала отбираются rerank кандидатов
+        по компактным векторам, затем они пересчитываются точно.
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        sims = self.scores(query)
+        n_candidates = max(k, rerank if self.exact is not None else 0)
+        n_candidates = min(n_candidates, sims.shape[0])
+        if n_candidates <= 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+
+        candidates = np.argpartition(-sims, n_candidates - 1)[:n_candidates]
+        if n_candidates > k and self.exact is not None:
+            candidates = np.sort(candidates)  # последовательное чтение memory-mapped строк
+            candidate_sims = np.asarray(self.exact[candidates], dtype=np.float32) @ query
+        else:
+            candidate_sims = sims[candidates]
+        order = np.argsort(-candidate_sims)[:k]
+        return candidates[order], candidate_sims[order]
+
+    # --- Снимки на диске ---
+    def save(self, snapshot_dir: str, paragraphs: List[str], keep_exact: Optional[NDArray] = None):
+        """Сохраняет компактные коды, масштабы, параграфы и (опционально) float32-оригинал"""
+        os.makedirs(snapshot_dir, exist_ok=True)
+        np.save(os.path.join(snapshot_dir, "codes.npy"), self.codes)
+        if self.scales is not None:
+            np.save(os.path.join(snapshot_dir, "scales.npy"), self.scales)
+        if keep_exact is not None:
+            np.save(os.path.join(snapshot_dir, "exact.npy"), np.asarray(keep_exact, dtype=np.float32))
+        with open(os.path.join(snapshot_dir, "paragraphs.json"), "w", encoding="utf-8") as f:
+            json.dump(paragraphs, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, snapshot_dir: str) -> Tuple[List[str], "QuantizedEmbeddings"]:
+        with open(os.path.join(snapshot_dir, "paragraphs.json"), "r", encoding="utf-8") as f:
+            paragraphs = json.load(f)
+        codes = np.load(os.path.join(snapshot_dir, "codes.npy"))
+        scales_path = os.path.join(snapshot_dir, "scales.npy")
+        exact_path = os.path.join(snapshot_dir, "exact.npy")
+        scales = np.load(scales_path) if os.path.exists(scales_path) else None
+        exact = np.load(exact_path, mmap_mode="r") if os.path.exists(exact_path) else None
+        return paragraphs, cls(codes, scales=scales, exact=exact)
+
+
+def snapshot_dir_for(root: str, agent: str, source_signature: str, storage: str) -> str:
+    """Каталог снимка агента: меняется вместе с базой знаний и типом хранения"""
+    digest = hashlib.sha256(source_signature.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(root, agent, f"{digest}-{storage}")
+
+
+# --- Бенчмарк ---
+def _benchmark_storage(embeddings: NDArray, queries: NDArray, storage: str, rerank: int) -> dict:
+    truth = (queries @ embeddings.T).argmax(axis=1)
+    matrix = QuantizedEmbeddings.quantize(embeddings, storage, exact=embeddings if rerank else None)
+    hits, latencies = 0, []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        indices, _ = matrix.top_k(query, k=1, rerank=rerank)
+        latencies.append(time.perf_counter() - start)
+        hits += int(indices[0] == expected)
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "storage": storage,
+        "rerank": rerank,
+        "memory_bytes": matrix.nbytes,
+        "latency_ms_p50": round(float(np.percentile(latencies_ms, 50)), 4),
+        "latency_ms_p99": round(float(np.percentile(latencies_ms, 99)), 4),
+        "recall_at_1": round(hits / len(queries), 4),
+    }
+
+
+def _load_corpus_and_queries(agents_dir: str, n_queries: int) -> Tuple[NDArray, NDArray]:
+    from agent_registry import AgentRegistry
+    from router import load_embeddings_model, encode
+
+    emb_model = load_embeddings_model()
+    registry = AgentRegistry(agents_dir)
+    registry.refresh()
+    paragraphs, questions = [], []
+    for name in registry.agent_names:
+        spec = registry[name]
+        paragraphs.extend(spec.load_paragraphs())
+        questions.extend(spec.sample_questions)
+    # Вопросами служат примеры из манифеста и сами параграфы, закодированные как запросы
+    questions = (questions + paragraphs)[:n_queries]
+    return encode(emb_model, paragraphs, "search_document"), encode(emb_model, questions, "search_query")
+
+
+def main():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Бенчмарк компактного хранения эмбеддингов")
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--agents-dir", default=os.getenv("AGENTS_DIR", base_dir))
+    parser.add_argument("--synthetic", type=int, default=0, help="Число случайных векторов вместо баз знаний")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--rerank", type=int, default=10)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.synthetic:
+        rng = np.random.default_rng(0)
+        embeddings = rng.standard_normal((args.synthetic, args.dim)).astype(np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        # Запросы — зашумлённые копии случайных строк, как близкие перефразировки
+        queries = embeddings[rng.integers(0, args.synthetic, args.queries)] + 0.05 * rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    else:
+        embeddings, queries = _load_corpus_and_queries(args.agents_dir, args.queries)
+
+    report = {"rows": int(embeddings.shape[0]), "dim": int(embeddings.shape[1]), "queries": int(queries.shape[0]), "results": []}
+    for storage in STORAGE_TYPES:
+        report["results"].append(_benchmark_storage(embeddings, queries, storage, rerank=0))
+        if storage != "float32" and args.rerank:
+            report["results"].append(_benchmark_storage(embeddings, queries, storage, rerank=args.rerank))
+    # Цена компактного хранения в задержке относительно float32
+    baseline = report["results"][0]["latency_ms_p50"]
+    for result in report["results"]:
+        result["latency_vs_float32"] = round(result["latency_ms_p50"] / max(baseline, 1e-9), 2)
+    report["note"] = ("float16 и int8 переводят блоки в float32 на каждом запросе и медленнее float32; "
+                      "float16 — в разы, для экономии памяти рекомендуется int8")
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
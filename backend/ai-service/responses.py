@@ -0,0 +1,53 @@
+"""
+Шаблонные ответы на разговорные намерения (приветствие, благодарность, прощание, «кто ты»)
+без генерации LLM
+"""
+
+import os
+import json
+import random
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_USERNAME = "Пользователь"
+
+
+class ResponseTemplates:
+    """
+    Пулы ответов по намерениям для выбранного профиля развёртывания.
+
+    responses.json: {"profiles": {"<профиль>": {"<намерение>": ["ответ", "ответ с {username}", ...]}}}
+    Шаблоны с {username} используются только когда имя пользователя известно.
+    """
+
+    def __init__(self, pools: Dict[str, List[str]], profile: str = "default"):
+        self.pools = pools
+        self.profile = profile
+
+    @classmethod
+    def from_file(cls, path: str, profile: str = "default") -> "ResponseTemplates":
+        with open(path, "r", encoding="utf-8") as f:
+            profiles = json.load(f).get("profiles", {})
+        if profile not in profiles:
+            logger.warning(f"Профиль ответов {profile} не найден в {path}, используется default")
+            profile = "default"
+        return cls(profiles.get(profile, {}), profile)
+
+    def render(self, intent: str, username: Optional[str] = None) -> Optional[str]:
+        pool = self.pools.get(intent) or []
+        personalized = bool(username) and username != DEFAULT_USERNAME
+        candidates = [t for t in pool if personalized or "{username}" not in t]
+        if not candidates:
+            return None
+        return random.choice(candidates).format(username=username or "")
+
+
+def load_response_templates(path: str, profile: str) -> Optional[ResponseTemplates]:
+    if not os.path.exists(path):
+        logger.warning(f"Файл шаблонов ответов {path} не найден, приветствия генерируются моделью")
+        return None
+    templates = ResponseTemplates.from_file(path, profile)
+    logger.info(f"Загружены шаблоны ответов: профиль {templates.profile}, намерения: {', '.join(templates.pools)}")
+    return templates
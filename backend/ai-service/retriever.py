@@ -0,0 +1,573 @@
+"""
+Поиск контекста по базам знаний агентов
+
+ParagraphRetriever выбирает агента (обученным маршрутизатором или по эмбеддингам реестра)
+и находит параграф его базы знаний, ближайший к вопросу. Эмбеддинги параграфов хранятся
+компактно (quantization.py), кэшируются снимками на диске и в хранилище эмбеддингов
+(vector_store.py). Все зависимости
+передаются при создании, поэтому retriever используется и сервисом (model.py), и
+офлайн-инструментами без загрузки LLM и хранилища эмбеддингов (evaluate.py).
+"""
+
+import os
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from transformers import PreTrainedTokenizerBase
+
+from agent_registry import split_into_paragraphs
+from quantization import QuantizedEmbeddings, snapshot_dir_for
+from lexical_index import LexicalIndex, first_above, fuse
+from chunking import SentenceIndex, split_paragraphs
+from metrics import ai_agent_selection_similarity, ai_hybrid_retrieval_total
+
+logger = logging.getLogger(__name__)
+
+
+class ParagraphRetriever(BaseRetriever):
+    paragraphs: Dict[str, List[str]]  # Храним параграфы по агентам
+    paragraph_embeddings: Dict[str, List[NDArray]]  # Храним эмбеддинги по агентам
+    embeddings_model: Any  # SentenceTransformer или EmbeddingService (embedding_service.py)
+    similarity_threshold: float = 0.25
+    prompt_token_len: int = 0
+    history_tokens: int = 0
+    question_tokens: int = 0
+    reserved_output_tokens: int = 150
+    tokenizer: Optional[PreTrainedTokenizerBase] = None
+    current_agent: Optional[str] = None  # ← добавьте эту строку
+    global_top_k: int = 5
+    registry: Any = None  # AgentRegistry: базы знаний и эмбеддинги агентов для маршрутизации
+    routing_model: Any = None  # Обученный маршрутизатор (router.py), None — маршрутизация по реестру
+    collection: Any = None  # Хранилище эмбеддингов (vector_store.py); None — эмбеддинги только в памяти и снимках
+    storage: str = "float32"  # Хранение эмбеддингов: float32 | float16 | int8
+    rerank_k: int = 0
+    snapshot_root: Optional[str] = None  # Каталог снимков эмбеддингов
+    grounding_verifier: Any = None  # GroundingVerifier; None — эмбеддинги проверки ответа не кэшируются
+    footprint_callback: Optional[Callable[[str, str, int], None]] = None  # Учёт памяти агента (AgentPool.add_footprint)
+    fusion: str = "dense"  # Слияние с лексическим поиском BM25: dense | rrf | score, см. lexical_index.py
+    lexical_weight: float = 0.5
+    fusion_depth: int = 20  # Сколько кандидатов каждого списка участвует в слиянии
+    lexical_prefilter_min: int = 0  # С какого числа параграфов плотный скан сужается лексическими кандидатами (0 — никогда)
+    lexical_candidates: int = 200
+    context_sentences: int = 0  # Сколько предложений параграфа идёт в контекст (0 — параграф целиком), см. chunking.py
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._last_context_tokens = 0
+        template_sample = "Ты — помощник, который строго отвечает только на основании предоставленного контекста и истории чата в одно предложение. Если контекста нет, отвечай на общие вопросы как дружелюбный бот (приветствия, прощания и т.д.).\n\n"
+        if self.tokenizer is not None:
+            self.prompt_token_len = len(self.tokenizer.encode(template_sample))
+        self.paragraphs = {}  # Кэш параграфов, заполняется при первом обращении к агенту
+        self.paragraph_embeddings = {}  # Кэш эмбеддингов
+        self._grounding_embeddings: Dict[str, QuantizedEmbeddings] = {}  # Эмбеддинги "paraphrase" для проверки ответа
+        self._last_hit: Optional[Tuple[str, int]] = None  # Агент и индекс последнего выбранного параграфа
+        self._lexical_indexes: Dict[str, LexicalIndex] = {}  # Индексы BM25 параграфов по агентам
+        self._sentence_indexes: Dict[str, SentenceIndex] = {}  # Предложения параграфов по агентам
+        self._query_cache: Optional[Tuple[str, Dict[str, NDArray]]] = None  # Эмбеддинги последнего запроса по prompt_name
+        self.invalidate_global_index()
+
+    def set_dynamic_limits(self, question_tokens: int, history_tokens: int, max_total_tokens: int = 8192):
+        self.question_tokens = question_tokens
+        self.history_tokens = history_tokens
+
+    def _add_footprint(self, agent: str, kind: str, nbytes: int):
+        if self.footprint_callback is not None:
+            self.footprint_callback(agent, kind, nbytes)
+
+    def ensure_agent_paragraphs(self, agent: str):
+        """Загружает эмбеддинги параграфов агента (из снимка, хранилища или вычисляет), если их ещё нет в кэше."""
+        if agent in self.paragraphs and agent in self.paragraph_embeddings:
+            return
+        spec = self.registry[agent]
+        snapshot_dir = None
+        if self.snapshot_root and os.path.exists(spec.file_path):
+            snapshot_dir = snapshot_dir_for(self.snapshot_root, agent, spec.corpus_hash(), self.storage)
+
+        paragraphs, embeddings = [], None
+        if snapshot_dir and os.path.exists(os.path.join(snapshot_dir, "paragraphs.json")):
+            try:
+                paragraphs, embeddings = QuantizedEmbeddings.load(snapshot_dir)
+                logger.info(f"Загружен снимок эмбеддингов агента {agent} ({embeddings.storage}, shape: {embeddings.shape})")
+            except (OSError, ValueError) as e:
+                logger.error(f"Не удалось загрузить снимок эмбеддингов агента {agent}: {e}")
+                paragraphs, embeddings = [], None
+
+        if embeddings is None:
+            paragraphs, raw_embeddings = self._load_agent_paragraphs(agent, spec.file_path)
+            embeddings = raw_embeddings
+            if raw_embeddings.size:
+                embeddings = QuantizedEmbeddings.quantize(raw_embeddings, self.storage)
+                if snapshot_dir:
+                    keep_exact = raw_embeddings if self.rerank_k > 0 and self.storage != "float32" else None
+                    embeddings.save(snapshot_dir, paragraphs, keep_exact=keep_exact)
+                    if keep_exact is not None:
+                        # Точные векторы остаются на диске и читаются только при переранжировании
+                        embeddings.exact = np.load(os.path.join(snapshot_dir, "exact.npy"), mmap_mode="r")
+
+        self.paragraphs[agent] = paragraphs
+        self.paragraph_embeddings[agent] = embeddings
+        self._add_footprint(agent, "paragraph_embeddings", embeddings.nbytes)
+        if self.uses_lexical_index and paragraphs:
+            self._lexical_indexes[agent] = LexicalIndex.build(paragraphs)
+            self._add_footprint(agent, "lexical_index", self._lexical_indexes[agent].nbytes)
+        if self.context_sentences > 0 and paragraphs:
+            self._ensure_sentence_index(agent, paragraphs, snapshot_dir)
+        if self.grounding_verifier is not None and paragraphs:
+            self._ensure_grounding_embeddings(agent, paragraphs, snapshot_dir)
+
+    @property
+    def uses_lexical_index(self) -> bool:
+        return self.fusion != "dense" or self.lexical_prefilter_min > 0
+
+    def _hybrid_top_k(self, embs: QuantizedEmbeddings, lexical: Optional[LexicalIndex], query: str,
+                      query_emb: NDArray, k: int) -> Tuple[NDArray, NDArray]:
+        """
+        Индексы k лучших строк и их косинусные сходства за один вызов поиска.
+
+        На больших матрицах плотный скан ограничивается лексическими кандидатами, а при
+        включённом слиянии плотный и лексический top-k объединяются (lexical_index.fuse).
+        Сходства всегда плотные, чтобы порог similarity_threshold сохранял смысл.
+        """
+        depth = max(k, self.fusion_depth) if lexical is not None and self.fusion != "dense" else k
+        candidates = None
+        if lexical is not None and 0 < self.lexical_prefilter_min <= len(embs):
+            candidates, _ = lexical.top_k(query, self.lexical_candidates)
+            candidates = np.sort(candidates) if len(candidates) else None
+        if candidates is not None:
+            top, sims = embs[candidates].top_k(query_emb, k=depth, rerank=self.rerank_k)
+            top = candidates[top]
+        else:
+            top, sims = embs.top_k(query_emb, k=depth, rerank=self.rerank_k)
+        if lexical is None or self.fusion == "dense":
+            return top[:k], sims[:k]
+
+        lexical_top = lexical.top_k(query, depth)
+        fused = fuse((top, sims), lexical_top, mode=self.fusion, lexical_weight=self.lexical_weight)[:k]
+        if len(fused):
+            in_dense, in_lexical = fused[0] in top, fused[0] in lexical_top[0]
+            ai_hybrid_retrieval_total.labels(source="both" if in_dense and in_lexical else ("dense" if in_dense else "lexical")).inc()
+        return fused, embs[fused].scores(query_emb)
+
+    def _ensure_grounding_embeddings(self, agent: str, paragraphs: List[str], snapshot_dir: Optional[str]):
+        """Эмбеддинги "paraphrase" параграфов для проверки ответа: из снимка или кодируются один раз."""
+        grounding_dir = os.path.join(snapshot_dir, "grounding") if snapshot_dir else None
+        embeddings = None
+        if grounding_dir and os.path.exists(os.path.join(grounding_dir, "paragraphs.json")):
+            try:
+                cached_paragraphs, embeddings = QuantizedEmbeddings.load(grounding_dir)
+                if cached_paragraphs != paragraphs:
+                    embeddings = None
+            except (OSError, ValueError) as e:
+                logger.error(f"Не удалось загрузить эмбеддинги проверки ответа агента {agent}: {e}")
+                embeddings = None
+
+        if embeddings is None:
+            embeddings = QuantizedEmbeddings.quantize(self.grounding_verifier.encode_paragraphs(paragraphs), self.storage)
+            if grounding_dir:
+                embeddings.save(grounding_dir, paragraphs)
+            logger.info(f"Вычислены эмбеддинги проверки ответа агента {agent}, shape: {embeddings.shape}")
+
+        self._grounding_embeddings[agent] = embeddings
+        self._add_footprint(agent, "grounding_embeddings", embeddings.nbytes)
+
+    def _ensure_sentence_index(self, agent: str, paragraphs: List[str], snapshot_dir: Optional[str]):
+        """Предложения параграфов и их эмбеддинги: из снимка или кодируются один раз."""
+        sentences, offsets = split_paragraphs(paragraphs)
+        sentence_dir = os.path.join(snapshot_dir, "sentences") if snapshot_dir else None
+        embeddings = None
+        if sentence_dir and os.path.exists(os.path.join(sentence_dir, "paragraphs.json")):
+            try:
+                cached_sentences, embeddings = QuantizedEmbeddings.load(sentence_dir)
+                if cached_sentences != sentences:
+                    embeddings = None
+            except (OSError, ValueError) as e:
+                logger.error(f"Не удалось загрузить эмбеддинги предложений агента {agent}: {e}")
+                embeddings = None
+
+        if embeddings is None:
+            raw_embeddings = self._encode_paragraphs(agent, sentences)
+            if not raw_embeddings.size:
+                return
+            embeddings = QuantizedEmbeddings.quantize(raw_embeddings, self.storage)
+            if sentence_dir:
+                embeddings.save(sentence_dir, sentences)
+            logger.info(f"Вычислены эмбеддинги предложений агента {agent}, shape: {embeddings.shape}")
+
+        self._sentence_indexes[agent] = SentenceIndex(sentences, offsets, embeddings)
+        self._add_footprint(agent, "sentence_embeddings", self._sentence_indexes[agent].nbytes)
+
+    def encode_query(self, query: str, prompt_name: str = "search_query") -> NDArray:
+        """
+        Нормализованный эмбеддинг запроса. Эмбеддинги последнего запроса хранятся по prompt_name,
+        поэтому особые случаи, маршрутизация и поиск кодируют запрос одним prompt_name один раз.
+        """
+        if self._query_cache is None or self._query_cache[0] != query:
+            self._query_cache = (query, {})
+        embeddings = self._query_cache[1]
+        if prompt_name not in embeddings:
+            embeddings[prompt_name] = self.embeddings_model.encode(
+                query,
+                prompt_name=prompt_name,
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            )
+        return embeddings[prompt_name]
+
+    def _encode_query(self, query: str) -> NDArray:
+        """Эмбеддинг запроса для поиска; повторные поиски по тому же запросу не кодируют его заново."""
+        return self.encode_query(query, "search_query")
+
+    def _context_for(self, agent: str, index: int, query_emb: Optional[NDArray]) -> str:
+        """Контекст по найденному параграфу: ближайшие к запросу предложения или параграф целиком."""
+        paragraph = self.paragraphs[agent][index]
+        sentence_index = self._sentence_indexes.get(agent)
+        if self.context_sentences <= 0 or sentence_index is None or query_emb is None:
+            return paragraph
+        return sentence_index.context(paragraph, index, np.asarray(query_emb).reshape(-1), self.context_sentences)
+
+    def grounding_embedding(self, context: str) -> Optional[NDArray]:
+        """Кэшированный эмбеддинг "paraphrase" контекста, если контекст — последний выбранный параграф целиком."""
+        if self._last_hit is None:
+            return None
+        agent, index = self._last_hit
+        embeddings = self._grounding_embeddings.get(agent)
+        paragraphs = self.paragraphs.get(agent)
+        if embeddings is None or not paragraphs or index >= len(embeddings) or paragraphs[index] != context:
+            return None
+        return embeddings.dequantize(np.array([index]))[0]
+
+    def release_agent(self, agent: str):
+        """Удаляет параграфы и эмбеддинги агента из кэша (вызывается при выгрузке агента)."""
+        if self._global_matrix is not None and agent in self._global_agents:
+            # Эмбеддинги агента — срез глобального индекса и остаются в памяти вместе с ним
+            return
+        self.paragraphs.pop(agent, None)
+        self.paragraph_embeddings.pop(agent, None)
+        self._grounding_embeddings.pop(agent, None)
+        self._lexical_indexes.pop(agent, None)
+        self._sentence_indexes.pop(agent, None)
+
+    def _load_agent_paragraphs(self, agent: str, file_path: str) -> Tuple[List[str], NDArray]:
+        """Загружает эмбеддинги параграфов агента из хранилища или вычисляет и сохраняет их."""
+        empty = np.array([], dtype=np.float32)
+        if not os.path.exists(file_path):
+            logger.error(f"Файл {file_path} не найден.")
+            return [], empty
+
+        # Чтение файла
+        with open(file_path, "r", encoding="utf-8") as f:
+            text = f.read()
+        paragraphs = split_into_paragraphs(text)
+        logger.info(f"Разбито на {len(paragraphs)} абзацев из файла {file_path}")
+
+        if self.collection is None:
+            embeddings = self._encode_paragraphs(agent, paragraphs)
+            return (paragraphs if embeddings.size else []), embeddings
+
+        try:
+            # Проверка, есть ли записи в хранилище
+            results = self.collection.get(where={"agent": agent}, include=["documents", "embeddings", "metadatas"])
+            existing_ids = results["ids"]
+            logger.info(f"Найдено {len(existing_ids)} записей в хранилище для агента {agent}")
+
+            if not existing_ids:
+                paragraph_embeddings = self._encode_paragraphs(agent, paragraphs)
+                if not paragraph_embeddings.size:
+                    return [], empty
+
+                # Сохранение в хранилище
+                ids = [f"{agent}_{i}" for i in range(len(paragraphs))]
+                self.collection.add(
+                    documents=paragraphs,
+                    embeddings=paragraph_embeddings,
+                    metadatas=[{"agent": agent} for _ in paragraphs],
+                    ids=ids
+                )
+                logger.info(f"Сохранены {len(paragraphs)} эмбеддингов для агента {agent} в хранилище, shape: {paragraph_embeddings.shape}")
+                return paragraphs, paragraph_embeddings
+
+            # Загрузка из хранилища
+            paragraphs = results["documents"]
+            embeddings = results["embeddings"]
+
+            if not paragraphs or embeddings is None or len(embeddings) == 0:
+                logger.error(f"Пустые данные из хранилища для агента {agent}: documents={len(paragraphs)}, embeddings={0 if embeddings is None else len(embeddings)}")
+                return [], empty
+
+            # Преобразование эмбеддингов
+            try:
+                embeddings = np.array(embeddings, dtype=np.float32)
+                if embeddings.ndim != 2 or embeddings.shape[0] != len(paragraphs):
+                    logger.error(f"Некорректная форма эмбеддингов для агента {agent}: shape={embeddings.shape}, expected {len(paragraphs)} rows")
+                    return [], empty
+
+                if np.any(np.isnan(embeddings)):
+                    logger.error(f"Обнаружены NaN в эмбеддингах из хранилища для агента {agent}")
+                    return [], empty
+
+                logger.info(f"Загружено {len(paragraphs)} абзацев для агента {agent}, embeddings shape: {embeddings.shape}")
+                return paragraphs, embeddings
+            except (ValueError, TypeError) as e:
+                logger.error(f"Ошибка преобразования эмбеддингов из хранилища для агента {agent}: {e}")
+                return [], empty
+
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке/сохранении эмбеддингов для агента {agent}: {e}")
+            return [], empty
+
+    def _encode_paragraphs(self, agent: str, paragraphs: List[str]) -> NDArray:
+        """Вычисляет нормализованные эмбеддинги параграфов; пустой массив при ошибке."""
+        empty = np.array([], dtype=np.float32)
+        if not paragraphs:
+            logger.warning(f"Нет параграфов для агента {agent}")
+            return empty
+
+        # Вычисление эмбеддингов
+        paragraph_embeddings = self.embeddings_model.encode(
+            paragraphs,
+            prompt_name="search_document",
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+
+        # Проверка формы и типа эмбеддингов
+        if not isinstance(paragraph_embeddings, np.ndarray) or paragraph_embeddings.ndim != 2:
+            logger.error(f"Некорректная форма эмбеддингов для агента {agent}: {type(paragraph_embeddings)}")
+            return empty
+
+        # Проверка на NaN
+        if np.any(np.isnan(paragraph_embeddings)):
+            logger.error(f"Обнаружены NaN в эмбеддингах для агента {agent}")
+            return empty
+        return paragraph_embeddings
+
+    def route_query(self, query: str) -> Tuple[Optional[str], float]:
+        """Выбирает агента обученным маршрутизатором, а без него — по эмбеддингам реестра."""
+        agent_names = self.registry.agent_names
+        if not agent_names:
+            logger.error("Реестр агентов пуст")
+            return None, 0.0
+
+        routing_model = self.routing_model
+        if routing_model is not None and set(routing_model.agent_names) == set(agent_names):
+            return routing_model.route(self.encode_query(query, routing_model.prompt_name))
+
+        query_emb = self.encode_query(query, "paraphrase")
+        # Эмбеддинги агентов предвычислены реестром и нормализованы
+        sims = self.registry.routing_matrix @ query_emb
+        max_idx = int(sims.argmax())
+        max_sim = float(sims[max_idx])
+
+        if max_sim < self.similarity_threshold:
+            return None, max_sim
+        return agent_names[max_idx], max_sim
+
+    def select_agent_name(self, query: str) -> Tuple[Optional[str], float]:
+        selected_agent, max_sim = self.route_query(query)
+        if selected_agent is None:
+            return None, max_sim
+
+        # Записываем метрику схожести с агентом
+        ai_agent_selection_similarity.labels(agent=selected_agent).observe(float(max_sim))
+
+        logger.info(f"Выбран агент: {selected_agent} (similarity: {max_sim:.2f})")
+        return selected_agent, max_sim
+
+    def search_agent(self, agent: str, query: str, top_k: int = 5) -> List[Tuple[int, float]]:
+        """Top-k параграфов базы знаний одного агента: [(индекс параграфа, сходство)]."""
+        if agent in self.registry:
+            self.ensure_agent_paragraphs(agent)
+        embs = self.paragraph_embeddings.get(agent)
+        if not isinstance(embs, QuantizedEmbeddings) or embs.ndim != 2 or embs.size == 0:
+            return []
+
+        query_emb = self._encode_query(query)
+        if np.any(np.isnan(query_emb)):
+            logger.error("Обнаружены NaN в эмбеддингах запроса")
+            return []
+
+        top, sims = self._hybrid_top_k(embs, self._lexical_indexes.get(agent), query, query_emb, top_k)
+        return [(int(i), float(sim)) for i, sim in zip(top, sims)]
+
+    def build_global_index(self):
+        """Объединяет эмбеддинги параграфов всех агентов в одну матрицу с колонкой agent_id."""
+        blocks, agent_ids, local_ids, agents = [], [], [], []
+        for agent in self.registry.agent_names:
+            self.ensure_agent_paragraphs(agent)
+            embs = self.paragraph_embeddings.get(agent)
+            if not isinstance(embs, QuantizedEmbeddings) or embs.ndim != 2 or embs.size == 0:
+                continue
+            agent_ids.append(np.full(len(embs), len(agents), dtype=np.int32))
+            local_ids.append(np.arange(len(embs), dtype=np.int32))
+            blocks.append(embs)
+            agents.append(agent)
+
+        if not blocks:
+            logger.error("Нет эмбеддингов параграфов для глобального индекса")
+            return
+
+        self._global_matrix = QuantizedEmbeddings.concatenate(blocks)
+        self._global_agent_ids = np.concatenate(agent_ids)
+        self._global_local_ids = np.concatenate(local_ids)
+        self._global_agents = agents
+        if self.uses_lexical_index:
+            self._global_lexical = LexicalIndex.build([p for agent in agents for p in self.paragraphs[agent]])
+
+        # Кэши агентов становятся срезами общей матрицы, чтобы не хранить эмбеддинги дважды
+        offset = 0
+        for agent, block in zip(agents, blocks):
+            self.paragraph_embeddings[agent] = self._global_matrix[offset:offset + len(block)]
+            offset += len(block)
+        logger.info(f"Глобальный индекс: {self._global_matrix.shape[0]} параграфов, {len(agents)} агентов")
+
+    def invalidate_global_index(self):
+        self._global_matrix = None
+        self._global_agent_ids = None
+        self._global_local_ids = None
+        self._global_agents = []
+        self._global_lexical = None
+
+    def search_all_agents(self, query: str, top_k: int = 5) -> List[Tuple[str, int, float]]:
+        """Один поиск top-k по параграфам всех агентов: [(агент, индекс параграфа, сходство)]."""
+        if self._global_matrix is None:
+            self.build_global_index()
+        if self._global_matrix is None:
+            return []
+
+        query_emb = self._encode_query(query)
+        if np.any(np.isnan(query_emb)):
+            logger.error("Обнаружены NaN в эмбеддингах запроса")
+            return []
+
+        top, sims = self._hybrid_top_k(self._global_matrix, self._global_lexical, query, query_emb, top_k)
+        return [
+            (self._global_agents[self._global_agent_ids[i]], int(self._global_local_ids[i]), float(sim))
+            for i, sim in zip(top, sims)
+        ]
+
+    def best_global_hit(self, query: str) -> Optional[Tuple[str, int, float]]:
+        """Лучший параграф среди всех агентов, если его сходство не ниже порога."""
+        hits = self.search_all_agents(query, top_k=self.global_top_k)
+        position = first_above(np.array([sim for _, _, sim in hits]), self.similarity_threshold)
+        if position is None:
+            logger.info(f"Глобальный поиск: совпадений выше порога {self.similarity_threshold} нет")
+            return None
+        logger.info("Глобальный поиск: " + ", ".join(f"{agent}#{index}={sim:.2f}" for agent, index, sim in hits))
+        return hits[position]
+
+    def document_for(self, agent: str, index: int, query: Optional[str] = None) -> Document:
+        query_emb = self._encode_query(query) if query and self.context_sentences > 0 else None
+        best_sentence = self._context_for(agent, index, query_emb)
+        if self.tokenizer:
+            self._last_context_tokens = len(self.tokenizer.encode(best_sentence))
+        self._last_hit = (agent, index)
+        return Document(page_content=best_sentence)
+
+    def load_paragraphs(self, agent: str) -> Tuple[List[str], List[NDArray]]:
+        if agent in self.registry:
+            self.ensure_agent_paragraphs(agent)
+        if agent not in self.paragraphs or agent not in self.paragraph_embeddings:
+            logger.error(f"Эмбеддинги для агента {agent} не найдены в кэше.")
+            return [], []
+        logger.info(f"Используется кэш: загружено {len(self.paragraphs[agent])} абзацев для агента {agent}")
+        return self.paragraphs[agent], self.paragraph_embeddings[agent]
+
+    def _get_relevant_documents(self, query: str) -> List[Document]:
+        """
+        Получает релевантные документы на основе запроса, используя косинусное сходство.
+        
+        Args:
+            query (str): Входной запрос пользователя.
+            
+        Returns:
+            List[Document]: Список релевантных документов или сообщение об ошибке.
+        """
+        self._last_hit = None
+        if not query or not isinstance(query, str):
+            logger.error("Запрос пуст или не является строкой")
+            return [Document(page_content="Не понял вопрос, уточните, пожалуйста!")]
+
+        if not self.current_agent or self.current_agent not in self.paragraph_embeddings:
+            logger.error(f"Текущий агент {self.current_agent} не найден или отсутствуют эмбеддинги")
+            return [Document(page_content="Не понял вопрос, уточните, пожалуйста!")]
+
+        try:
+            # Кодирование запроса
+            query_emb = self._encode_query(query)
+            if np.any(np.isnan(query_emb)):
+                logger.error("Обнаружены NaN в эмбеддингах запроса")
+                return [Document(page_content="Не понял вопрос, уточните, пожалуйста!")]
+
+            query_emb = query_emb.reshape(1, -1) if query_emb.ndim == 1 else query_emb
+            logger.info(f"Query embedding shape: {query_emb.shape}")
+
+            # Получение эмбеддингов параграфов
+            paragraph_embs = self.paragraph_embeddings[self.current_agent]
+            if not isinstance(paragraph_embs, QuantizedEmbeddings) or paragraph_embs.ndim != 2 or paragraph_embs.size == 0:
+                logger.error(f"Эмбеддинги для агента {self.current_agent} некорректны, type: {type(paragraph_embs)}, shape: {getattr(paragraph_embs, 'shape', 'None')}")
+                if self.collection is None:
+                    return [Document(page_content="Не понял вопрос, уточните, пожалуйста!")]
+                # Попробуем загрузить из хранилища напрямую; результаты query — списки по запросам
+                results = self.collection.query(
+                    query_embeddings=query_emb[:1],
+                    where={"agent": self.current_agent},
+                    n_results=10,
+                    include=["documents", "metadatas", "embeddings"]
+                )
+                documents = results["documents"][0] if results["documents"] else []
+                embeddings = results["embeddings"][0] if results["embeddings"] is not None and len(results["embeddings"]) else []
+                if not documents or len(embeddings) == 0:
+                    logger.error(f"Пустые данные из хранилища для агента {self.current_agent}: documents={len(documents)}, embeddings={len(embeddings)}")
+                    return [Document(page_content="Не понял вопрос, уточните, пожалуйста!")]
+
+                self.paragraphs[self.current_agent] = documents
+                self._grounding_embeddings.pop(self.current_agent, None)
+                self._lexical_indexes.pop(self.current_agent, None)
+                self._sentence_indexes.pop(self.current_agent, None)
+                self.paragraph_embeddings[self.current_agent] = QuantizedEmbeddings.quantize(
+                    np.array(embeddings, dtype=np.float32), self.storage
+                )
+                paragraph_embs = self.paragraph_embeddings[self.current_agent]
+                logger.info(f"Загружено {len(documents)} документов из хранилища для агента {self.current_agent}")
+
+            if paragraph_embs.has_nan():
+                logger.error(f"Обнаружены NaN в эмбеддингах параграфов для агента {self.current_agent}")
+                return [Document(page_content="Не понял вопрос, уточните, пожалуйста!")]
+
+            logger.info(f"Paragraph embeddings shape: {paragraph_embs.shape}")
+
+            # Вычисление косинусного сходства (эмбеддинги нормализованы) по компактному представлению,
+            # при гибридном поиске — вместе с лексическими кандидатами BM25; порог проверяется
+            # по всей глубине слияния, а не только у его победителя
+            top, sims = self._hybrid_top_k(
+                paragraph_embs, self._lexical_indexes.get(self.current_agent), query, query_emb[0],
+                k=1 if self.fusion == "dense" else self.fusion_depth
+            )
+            position = first_above(sims, self.similarity_threshold)
+            if position is None:
+                logger.info(f"Максимальное сходство {float(np.max(sims, initial=0.0)):.2f} ниже порога {self.similarity_threshold}")
+                return [Document(page_content="Не понял вопрос, уточните, пожалуйста!")]
+            max_similarity = sims[position]
+            max_index = top[position]
+
+            best_sentence = self._context_for(self.current_agent, int(max_index), query_emb[0])
+            if self.tokenizer:
+                self._last_context_tokens = len(self.tokenizer.encode(best_sentence))
+            self._last_hit = (self.current_agent, int(max_index))
+            logger.info(f"Выбран параграф с индексом {max_index}, сходство: {max_similarity:.2f}")
+            return [Document(page_content=best_sentence)]
+
+        except Exception as e:
+            logger.error(f"Ошибка в _get_relevant_documents: {e}")
+            return [Document(page_content="Не понял вопрос, уточните, пожалуйста!")]
+
+    async def _aget_relevant_documents(self, query: str) -> List[Document]:
+        return self._get_relevant_documents(query)
+
+    @property
+    def last_context_tokens(self) -> int:
+        return self._last_context_tokens
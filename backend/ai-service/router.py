@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Обучаемый маршрутизатор запросов по агентам поверх эмбеддингов FRIDA
+
+Линейная голова (центроиды классов или логистическая регрессия) обучается офлайн
+на абзацах баз знаний агентов и размеченном трафике ai_requests, сохраняется в
+router.npz рядом с адаптерами и применяется к эмбеддингу запроса одной операцией
+logits = W @ q + b.
+
+Использование:
+    python router.py train [--head logreg|centroid] [--traffic requests.jsonl]
+    python router.py eval [--questions labelled.jsonl]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from agent_registry import AgentRegistry
+
+logger = logging.getLogger(__name__)
+
+ROUTER_FILE_NAME = "router.npz"
+DEFAULT_PROMPT_NAME = "categorize_topic"
+DEFAULT_MIN_CONFIDENCE = {"centroid": 0.25, "logreg": 0.35}
+
+
+class RoutingModel:
+    """Линейная голова маршрутизации: агенты × размерность эмбеддинга"""
+
+    def __init__(self, agent_names: List[str], weights: NDArray, bias: NDArray,
+                 head: str, prompt_name: str, min_confidence: float):
+        self.agent_names = agent_names
+        self.weights = weights.astype(np.float32)
+        self.bias = bias.astype(np.float32)
+        self.head = head
+        self.prompt_name = prompt_name
+        self.min_confidence = min_confidence
+        self.path: Optional[str] = None
+        self.mtime: Optional[float] = None
+
+    def confidences(self, query_embs: NDArray) -> NDArray:
+        """Уверенность по агентам для батча нормализованных эмбеддингов запросов"""
+        logits = query_embs @ self.weights.T + self.bias
+        if self.head == "centroid":
+            return logits
+        logits = logits - logits.max(axis=-1, keepdims=True)
+        probs = np.exp(logits)
+        return probs / probs.sum(axis=-1, keepdims=True)
+
+    def route(self, query_emb: NDArray) -> Tuple[Optional[str], float]:
+        scores = self.confidences(query_emb.reshape(1, -1))[0]
+        best = int(scores.argmax())
+        if scores[best] < self.min_confidence:
+            return None, float(scores[best])
+        return self.agent_names[best], float(scores[best])
+
+    def save(self, path: str):
+        np.savez(
+            path,
+            agent_names=np.array(self.agent_names),
+            weights=self.weights,
+            bias=self.bias,
+            head=np.array(self.head),
+            prompt_name=np.array(self.prompt_name),
+            min_confidence=np.array(self.min_confidence),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "RoutingModel":
+        with np.load(path, allow_pickle=False) as data:
+            router = cls(
+                agent_names=[str(name) for name in data["agent_names"]],
+                weights=data["weights"],
+                bias=data["bias"],
+                head=str(data["head"]),
+                prompt_name=str(data["prompt_name"]),
+                min_confidence=float(os.getenv("ROUTER_MIN_CONFIDENCE", data["min_confidence"])),
+            )
+        router.path = path
+        router.mtime = os.path.getmtime(path)
+        return router
+
+    def is_stale(self) -> bool:
+        return self.path is not None and os.path.exists(self.path) and os.path.getmtime(self.path) != self.mtime
+
+
+def load_router(agents_dir: str) -> Optional[RoutingModel]:
+    """Загружает router.npz из каталога агентов, если он есть"""
+    path = os.path.join(agents_dir, ROUTER_FILE_NAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        return RoutingModel.load(path)
+    except (OSError, KeyError, ValueError) as e:
+        logger.error(f"Не удалось загрузить маршрутизатор {path}: {e}")
+        return None
+
+
+def load_embeddings_model():
+    from sentence_transformers import SentenceTransformer
+    import torch
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    return SentenceTransformer(os.path.join(base_dir, "frida_embedding_model"), device=device)
+
+
+def encode(emb_model, texts: List[str], prompt_name: str) -> NDArray:
+    return np.asarray(emb_model.encode(
+        texts,
+        prompt_name=prompt_name,
+        batch_size=64,
+        convert_to_numpy=True,
+        normalize_embeddings=True
+    ), dtype=np.float32)
+
+
+def read_labelled_jsonl(path: str) -> List[Dict]:
+    """Читает JSONL с полями message и (необязательно) agent — формат сообщений ai_requests"""
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if record.get("message"):
+                records.append(record)
+    return records
+
+
+def pseudo_label(emb_model, registry: AgentRegistry, messages: List[str], threshold: float) -> List[Optional[str]]:
+    """Размечает неразмеченный трафик агентом ближайшего абзаца базы знаний"""
+    doc_embs, doc_agents = [], []
+    for name in registry.agent_names:
+        paragraphs = registry[name].load_paragraphs()
+        if paragraphs:
+            doc_embs.append(encode(emb_model, paragraphs, "search_document"))
+            doc_agents.extend([name] * len(paragraphs))
+    if not doc_embs:
+        return [None] * len(messages)
+    sims = encode(emb_model, messages, "search_query") @ np.concatenate(doc_embs).T
+    best = sims.argmax(axis=1)
+    return [doc_agents[i] if sims[row, i] >= threshold else None for row, i in enumerate(best)]
+
+
+def build_dataset(emb_model, registry: AgentRegistry, traffic_path: Optional[str], holdout: float, seed: int = 0):
+    """Собирает обучающую и отложенную выборки: абзацы баз знаний, примеры вопросов и трафик"""
+    rng = np.random.default_rng(seed)
+    train_texts, train_labels, eval_texts, eval_labels = [], [], [], []
+
+    for name in registry.agent_names:
+        spec = registry[name]
+        paragraphs = spec.load_paragraphs() if os.path.exists(spec.file_path) else []
+        order = rng.permutation(len(paragraphs))
+        n_eval = int(len(paragraphs) * holdout)
+        for rank, i in enumerate(order):
+            (eval_texts if rank < n_eval else train_texts).append(paragraphs[i])
+            (eval_labels if rank < n_eval else train_labels).append(name)
+        # Примеры вопросов из манифеста ближе всего к реальным запросам — только в обучение
+        train_texts.extend(spec.sample_questions)
+        train_labels.extend([name] * len(spec.sample_questions))
+
+    if traffic_path:
+        records = read_labelled_jsonl(traffic_path)
+        unlabelled = [r["message"] for r in records if not r.get("agent")]
+        pseudo = iter(pseudo_label(emb_model, registry, unlabelled, threshold=0.5) if unlabelled else [])
+        used = 0
+        for record in records:
+            agent = record.get("agent") or next(pseudo)
+            if agent in registry:
+                train_texts.append(record["message"])
+                train_labels.append(agent)
+                used += 1
+        logger.info(f"Из трафика использовано {used} из {len(records)} запросов ({len(unlabelled)} размечены автоматически)")
+
+    return train_texts, train_labels, eval_texts, eval_labels
+
+
+def fit(head: str, agent_names: List[str], embs: NDArray, labels: List[str], prompt_name: str) -> RoutingModel:
+    y = np.array([agent_names.index(label) for label in labels])
+    empty = [name for i, name in enumerate(agent_names) if not np.any(y == i)]
+    if empty:
+        raise ValueError(f"Нет обучающих примеров для агентов: {', '.join(empty)} "
+                         f"(пустая база знаний и нет sample_questions в agents.json)")
+    if head == "centroid":
+        weights = np.stack([embs[y == i].mean(axis=0) for i in range(len(agent_names))])
+        weights /= np.maximum(np.linalg.norm(weights, axis=1, keepdims=True), 1e-12)
+        bias = np.zeros(len(agent_names), dtype=np.float32)
+    else:
+        from sklearn.linear_model import LogisticRegression
+
+        clf = LogisticRegression(C=10.0, max_iter=2000, class_weight="balanced")
+        clf.fit(embs, y)
+        weights, bias = clf.coef_, clf.intercept_
+        if len(agent_names) == 2:
+            # Для двух классов sklearn даёт одну строку логита класса 1; строка нулей для класса 0
+            # делает softmax по двум логитам равным сигмоиде исходного
+            weights = np.vstack([np.zeros_like(weights), weights])
+            bias = np.concatenate([np.zeros_like(bias), bias])
+    return RoutingModel(agent_names, weights, bias, head, prompt_name, DEFAULT_MIN_CONFIDENCE[head])
+
+
+def evaluate(router: RoutingModel, embs: NDArray, labels: List[str]) -> Dict:
+    """Точность маршрутизации и задержка одной операции скоринга"""
+    if len(labels) == 0:
+        return {"count": 0}
+    predictions = router.confidences(embs).argmax(axis=1)
+    correct = np.array([router.agent_names[p] == label for p, label in zip(predictions, labels)])
+
+    latencies = []
+    for emb in embs:
+        start = time.perf_counter()
+        router.route(emb)
+        latencies.append(time.perf_counter() - start)
+    latencies_ms = np.array(latencies) * 1000
+
+    per_agent = {}
+    for name in router.agent_names:
+        mask = np.array([label == name for label in labels])
+        if mask.any():
+            per_agent[name] = round(float(correct[mask].mean()), 4)
+
+    return {
+        "count": len(labels),
+        "accuracy": round(float(correct.mean()), 4),
+        "per_agent_accuracy": per_agent,
+        "score_latency_ms_p50": round(float(np.percentile(latencies_ms, 50)), 4),
+        "score_latency_ms_p99": round(float(np.percentile(latencies_ms, 99)), 4),
+    }
+
+
+def main():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Обучение и оценка маршрутизатора агентов")
+    parser.add_argument("command", choices=["train", "eval"])
+    parser.add_argument("--agents-dir", default=os.getenv("AGENTS_DIR", base_dir))
+    parser.add_argument("--head", choices=["logreg", "centroid"], default="logreg")
+    parser.add_argument("--prompt-name", default=DEFAULT_PROMPT_NAME)
+    parser.add_argument("--traffic", help="JSONL с запросами ai_requests (поле agent необязательно)")
+    parser.add_argument("--questions", help="JSONL с размеченными вопросами {message, agent} для оценки")
+    parser.add_argument("--holdout", type=float, default=0.2, help="Доля абзацев, отложенных для оценки")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    emb_model = load_embeddings_model()
+    registry = AgentRegistry(args.agents_dir)
+    registry.refresh()
+    router_path = os.path.join(args.agents_dir, ROUTER_FILE_NAME)
+
+    if args.command == "train":
+        train_texts, train_labels, eval_texts, eval_labels = build_dataset(emb_model, registry, args.traffic, args.holdout)
+        train_embs = encode(emb_model, train_texts, args.prompt_name)
+        eval_embs = encode(emb_model, eval_texts, args.prompt_name)
+        router = fit(args.head, registry.agent_names, train_embs, train_labels, args.prompt_name)
+        router.save(router_path)
+        logger.info(f"Маршрутизатор ({args.head}, {len(train_labels)} примеров) сохранён в {router_path}")
+        report = {"heldout_paragraphs": evaluate(router, eval_embs, eval_labels)}
+    else:
+        router = load_router(args.agents_dir)
+        if router is None:
+            logger.error(f"Маршрутизатор {router_path} не найден, сначала выполните train")
+            sys.exit(1)
+        _, _, eval_texts, eval_labels = build_dataset(emb_model, registry, None, args.holdout)
+        eval_embs = encode(emb_model, eval_texts, router.prompt_name)
+        report = {"heldout_paragraphs": evaluate(router, eval_embs, eval_labels)}
+        if args.questions:
+            records = [r for r in read_labelled_jsonl(args.questions) if r.get("agent") in registry]
+            start = time.perf_counter()
+            question_embs = encode(emb_model, [r["message"] for r in records], router.prompt_name)
+            encode_ms = (time.perf_counter() - start) * 1000 / max(len(records), 1)
+            report["questions"] = evaluate(router, question_embs, [r["agent"] for r in records])
+            report["questions"]["encode_latency_ms_mean"] = round(encode_ms, 3)
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Докачка файлов моделей без сети (зеркало во временном каталоге): python -m pytest test_download_models.py
+"""
+
+import sys
+import types
+import hashlib
+
+import pytest
+
+pytest.importorskip("huggingface_hub")
+
+import download_models
+
+PAYLOAD = bytes(range(256)) * 64
+REL_PATH = "model.safetensors"
+ENTRY = {"size": len(PAYLOAD), "sha256": hashlib.sha256(PAYLOAD).hexdigest()}
+
+
+@pytest.fixture
+def dirs(tmp_path, monkeypatch):
+    mirror = tmp_path / "mirror"
+    local = tmp_path / "local"
+    (mirror / "quantized_model").mkdir(parents=True)
+    (local / "quantized_model").mkdir(parents=True)
+    (mirror / "quantized_model" / REL_PATH).write_bytes(PAYLOAD)
+    monkeypatch.setattr(download_models, "MODEL_MIRROR_DIR", str(mirror))
+    monkeypatch.setattr(download_models, "VERIFY_HASHES", True)
+    monkeypatch.setattr(download_models.time, "sleep", lambda seconds: None)
+    monkeypatch.chdir(local)
+    return local / "quantized_model"
+
+
+def fetch():
+    return download_models.FileFetcher("repo", "quantized_model").fetch(REL_PATH, ENTRY)
+
+
+def forbid_hub(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("запрос к хабу не ожидался")
+    monkeypatch.setattr(download_models.FileFetcher, "_from_hub", fail)
+
+
+def test_truncated_part_is_resumed_from_mirror(dirs, monkeypatch):
+    forbid_hub(monkeypatch)
+    (dirs / (REL_PATH + ".part")).write_bytes(PAYLOAD[:1000])
+
+    result = fetch()
+
+    assert (dirs / REL_PATH).read_bytes() == PAYLOAD
+    assert not (dirs / (REL_PATH + ".part")).exists()
+    assert result == {"bytes": len(PAYLOAD) - 1000, "resumed_bytes": 1000, "source": "mirror"}
+
+
+def test_complete_part_is_renamed_without_request(dirs, monkeypatch):
+    forbid_hub(monkeypatch)
+    monkeypatch.setattr(download_models.FileFetcher, "_from_mirror", lambda *args: pytest.fail("копирование не ожидалось"))
+    (dirs / (REL_PATH + ".part")).write_bytes(PAYLOAD)
+
+    result = fetch()
+
+    assert (dirs / REL_PATH).read_bytes() == PAYLOAD
+    assert result["source"] == "part" and result["bytes"] == 0
+
+
+def test_corrupt_complete_part_is_downloaded_again(dirs, monkeypatch):
+    forbid_hub(monkeypatch)
+    (dirs / (REL_PATH + ".part")).write_bytes(b"\0" * len(PAYLOAD))
+
+    result = fetch()
+
+    assert (dirs / REL_PATH).read_bytes() == PAYLOAD
+    assert result["source"] == "mirror" and result["bytes"] == len(PAYLOAD)
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=b""):
+        self.status_code = status_code
+        self.body = body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise IOError(f"HTTP {self.status_code}")
+
+    def iter_content(self, chunk_size):
+        yield self.body
+
+
+def test_range_not_satisfiable_restarts_from_zero(dirs, monkeypatch):
+    monkeypatch.setattr(download_models, "MODEL_MIRROR_DIR", "")
+    requests_headers = []
+
+    def get(url, headers, **kwargs):
+        requests_headers.append(dict(headers))
+        return FakeResponse(416) if "Range" in headers else FakeResponse(200, PAYLOAD)
+
+    monkeypatch.setitem(sys.modules, "requests", types.SimpleNamespace(get=get))
+    monkeypatch.setattr(download_models, "build_hf_headers", lambda: {})
+    monkeypatch.setattr(download_models, "hf_hub_url", lambda repo_id, filename: f"https://hub/{repo_id}/{filename}")
+    (dirs / (REL_PATH + ".part")).write_bytes(PAYLOAD[:1000])
+
+    fetch()
+
+    assert (dirs / REL_PATH).read_bytes() == PAYLOAD
+    assert [h.get("Range") for h in requests_headers] == ["bytes=1000-", None]
@@ -0,0 +1,41 @@
+"""
+Слияние плотного и лексического поиска и порог сходства: python -m pytest test_lexical_index.py
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("razdel")
+
+from lexical_index import first_above, fuse
+
+THRESHOLD = 0.25
+
+
+def fused_with_sims(dense_ids, dense_sims, lexical_ids, lexical_scores, all_sims, lexical_weight=0.9):
+    fused = fuse((np.array(dense_ids), np.array(dense_sims)), (np.array(lexical_ids), np.array(lexical_scores)),
+                 mode="rrf", lexical_weight=lexical_weight)
+    return fused, all_sims[fused]
+
+
+def test_lexical_only_winner_below_threshold_falls_back_to_dense_top():
+    # Параграф 5 найден только BM25 и выигрывает слияние, но его косинус ниже порога
+    all_sims = np.array([0.8, 0.1, 0.05, 0.3, 0.0, 0.1], dtype=np.float32)
+    fused, sims = fused_with_sims([0, 3], [0.8, 0.3], [5], [7.5], all_sims)
+    assert fused[0] == 5
+
+    position = first_above(sims, THRESHOLD)
+    assert position is not None
+    assert fused[position] == 0
+    assert sims[position] == pytest.approx(0.8)
+
+
+def test_fused_winner_above_threshold_is_kept():
+    all_sims = np.array([0.8, 0.1, 0.05, 0.3, 0.0, 0.6], dtype=np.float32)
+    fused, sims = fused_with_sims([0, 5], [0.8, 0.6], [5], [7.5], all_sims)
+    assert fused[first_above(sims, THRESHOLD)] == 5
+
+
+def test_no_candidate_above_threshold():
+    assert first_above(np.array([0.2, 0.1], dtype=np.float32), THRESHOLD) is None
+    assert first_above(np.array([], dtype=np.float32), THRESHOLD) is None
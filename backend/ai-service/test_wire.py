@@ -0,0 +1,78 @@
+"""
+Дельта истории в запросах версии 2: python -m pytest test_wire.py
+"""
+
+from wire import HistoryCache, decode_request, encode_request, history_hash
+
+
+def turn(i):
+    return {"username": "Пользователь" if i % 2 == 0 else "AI-помощник", "message": f"Реплика {i}", "isBot": i % 2 == 1}
+
+
+HISTORY = [turn(i) for i in range(6)]
+
+
+def send_delta(cache, history, delta_from, base_hash):
+    body, content_type = encode_request("chat", "Вопрос", history, delta_from=delta_from, base_hash=base_hash)
+    return decode_request(body, content_type, cache)
+
+
+def test_delta_round_trip_restores_full_history():
+    cache = HistoryCache()
+    body, content_type = encode_request("chat", "Вопрос", HISTORY[:4])
+    first = decode_request(body, content_type, cache)
+    assert first["_historyHash"] == history_hash(HISTORY[:4])
+
+    second = send_delta(cache, HISTORY, 4, first["_historyHash"])
+
+    assert not second["_resync"]
+    assert second["messageHistory"] == HISTORY
+    assert second["_historyHash"] == history_hash(HISTORY)
+
+
+def test_redelivered_delta_request_uses_same_base():
+    cache = HistoryCache()
+    cache.put("chat", HISTORY[:4], history_hash(HISTORY[:4]))
+    first = send_delta(cache, HISTORY, 4, history_hash(HISTORY[:4]))
+
+    # Ответ не дошёл (nack, таймаут) — тот же запрос приходит ещё раз
+    again = send_delta(cache, HISTORY, 4, history_hash(HISTORY[:4]))
+
+    assert not again["_resync"]
+    assert again["messageHistory"] == first["messageHistory"] == HISTORY
+    assert again["_historyHash"] == first["_historyHash"]
+
+    # Следующий запрос строится на хэше из ответа
+    extended = HISTORY + [turn(6), turn(7)]
+    following = send_delta(cache, extended, 6, first["_historyHash"])
+    assert not following["_resync"]
+    assert following["messageHistory"] == extended
+
+
+def test_unknown_base_requests_resync_and_full_history_recovers():
+    cache = HistoryCache()
+    lost = send_delta(cache, HISTORY, 4, history_hash(HISTORY[:4]))
+
+    assert lost["_resync"]
+    assert lost["messageHistory"] == HISTORY[4:]
+    assert lost["_historyHash"] == ""
+
+    body, content_type = encode_request("chat", "Вопрос", HISTORY)
+    full = decode_request(body, content_type, cache)
+    assert not full["_resync"]
+
+    extended = HISTORY + [turn(6)]
+    following = send_delta(cache, extended, 6, full["_historyHash"])
+    assert not following["_resync"]
+    assert following["messageHistory"] == extended
+
+
+def test_only_two_versions_are_kept():
+    cache = HistoryCache()
+    hashes = [history_hash(HISTORY[:n]) for n in (2, 4, 6)]
+    for n, digest in zip((2, 4, 6), hashes):
+        cache.put("chat", HISTORY[:n], digest)
+
+    assert cache.get("chat", hashes[0]) is None
+    assert cache.get("chat", hashes[1]) == HISTORY[:4]
+    assert cache.get("chat", hashes[2]) == HISTORY
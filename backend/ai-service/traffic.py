@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Запись реального трафика ai_requests и воспроизведение с ускорением
+
+Запись: при заданном TRAFFIC_CAPTURE консьюмер (model.py) дописывает каждый входящий
+запрос со временем получения консьюмером ("t", по нему идёт воспроизведение) и, если
+отправитель его указал, временем отправки ("sent_at") в сжатый файл JSONL (gzip). Запросы обезличиваются:
+chatId заменяется солёным хэшем (один чат остаётся одним чатом в пределах записи),
+имена пользователей — на "Пользователь", e-mail и телефоны в текстах — на <email>/<phone>.
+История хранится полной (дельты версии 2 уже развёрнуты).
+
+Воспроизведение подаёт запросы с исходными интервалами, делёнными на --speed (1, 5, 10…):
+    python traffic.py replay capture.jsonl.gz --speed 5            # в процессе: callback из model.py
+    python traffic.py replay capture.jsonl.gz --speed 5 --broker localhost
+В режиме inproc загружается консьюмер (model.py) и сообщения передаются его callback
+через каналы в памяти, одним потребителем по порядку, как из очереди с prefetch 1.
+Отчёт: пропускная способность, перцентили возраста в очереди (от запланированного
+поступления до начала обработки) и времени обработки, распределение статусов
+(success, escalated, greeting, no_context, …).
+В режиме broker запросы публикуются в локальный RabbitMQ, ответы читаются из QUEUE_OUT;
+возраст в очереди там не виден, поэтому считается полная задержка до ответа, а статус
+определяется по ответу. Не используйте его с брокером, к которому подключён chat-service.
+"""
+
+import os
+import re
+import gzip
+import json
+import time
+import hashlib
+import argparse
+import logging
+import threading
+from collections import Counter
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+from wire import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_FORMAT_VERSION = 1
+BOT_USERNAME = "AI-помощник"
+ANONYMOUS_USERNAME = "Пользователь"
+EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+PHONE_RE = re.compile(r"(?<![\d.])\+?\d[\d\s()-]{8,}\d(?![\d.])")
+NO_CONTEXT_ANSWER = "Не понял вопрос, уточните, пожалуйста!"
+ERROR_ANSWER = "Произошла ошибка при обработке запроса."
+
+
+def anonymize_text(text: str) -> str:
+    return PHONE_RE.sub("<phone>", EMAIL_RE.sub("<email>", text))
+
+
+def anonymize_request(data: Dict, salt: bytes) -> Dict:
+    """Копия запроса без служебных полей, с хэшем вместо chatId и без имён и контактов"""
+    request = {key: value for key, value in data.items() if not key.startswith("_")}
+    for key in ("historyDelta", "historyBase", "v"):
+        request.pop(key, None)
+    if request.get("chatId") is not None:
+        request["chatId"] = "chat-" + hashlib.sha256(salt + str(request["chatId"]).encode("utf-8")).hexdigest()[:16]
+    if "username" in request:
+        request["username"] = ANONYMOUS_USERNAME
+    request["message"] = anonymize_text(request.get("message", ""))
+    history = []
+    for turn in request.get("messageHistory", []):
+        turn = dict(turn)
+        if "username" in turn and turn["username"] != BOT_USERNAME:
+            turn["username"] = ANONYMOUS_USERNAME
+        for field in ("message", "answer"):
+            if isinstance(turn.get(field), str):
+                turn[field] = anonymize_text(turn[field])
+        history.append(turn)
+    request["messageHistory"] = history
+    return request
+
+
+class TrafficRecorder:
+    """Дописывает обезличенные запросы в gzip JSONL; после max_records запись прекращается"""
+
+    def __init__(self, path: str, max_records: int = 100000, flush_every: int = 50, salt: Optional[bytes] = None):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_records = max_records
+        self.flush_every = flush_every
+        self.salt = salt or os.urandom(16)
+        self.records = 0
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, "ab")
+        self._write({"capture": CAPTURE_FORMAT_VERSION, "started_at": time.time()})
+        logger.info(f"Запись трафика ai_requests в {path} (не больше {max_records} запросов)")
+
+    def _write(self, obj: Dict):
+        self._file.write(dumps(obj) + b"\n")
+
+    def record(self, data: Dict, sent_at: Optional[float] = None):
+        """Записывает запрос со временем получения; sent_at — время отправки из свойств сообщения"""
+        entry = {"t": time.time(), "request": anonymize_request(data, self.salt)}
+        if sent_at:
+            entry["sent_at"] = sent_at
+        with self._lock:
+            if self._file is None:
+                return
+            self._write(entry)
+            self.records += 1
+            if self.records % self.flush_every == 0:
+                self._file.flush()
+            if self.records >= self.max_records:
+                logger.info(f"Записано {self.records} запросов, запись трафика остановлена")
+                self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_capture(path: str) -> List[Dict]:
+    """Записи файла (заголовки сессий записи пропускаются) в порядке поступления"""
+    records = []
+    with gzip.open(path, "rb") as f:
+        try:
+            for line in f:
+                if line.strip():
+                    entry = loads(line)
+                    if "request" in entry:
+                        records.append(entry)
+        except EOFError:
+            logger.warning(f"Файл {path} оборван (консьюмер остановлен без закрытия записи), читаем что есть")
+    records.sort(key=lambda entry: entry["t"])
+    return records
+
+
+def schedule(records: List[Dict], speed: float) -> Iterator[tuple]:
+    """(смещение от начала воспроизведения в секундах, запрос) с интервалами, делёнными на speed"""
+    if not records:
+        return
+    first = records[0]["t"]
+    for entry in records:
+        yield (entry["t"] - first) / speed, entry["request"]
+
+
+# --- Воспроизведение в процессе ---
+class MemoryChannel:
+    """Канал RabbitMQ в памяти для callback консьюмера: ответы и подтверждения сохраняются"""
+
+    def __init__(self):
+        self.published: List[tuple] = []
+        self.acked = 0
+        self.rejected = 0
+
+    def basic_publish(self, exchange: str, routing_key: str, body: bytes, properties: Any = None):
+        self.published.append((time.time(), body, getattr(properties, "content_type", None)))
+
+    def basic_ack(self, delivery_tag: int, multiple: bool = False):
+        self.acked += 1
+
+    def basic_nack(self, delivery_tag: int, requeue: bool = True):
+        self.rejected += 1
+
+
+class MemoryConnection:
+    def add_callback_threadsafe(self, callback):
+        callback()
+
+
+def _status_counts() -> Counter:
+    from metrics import ai_requests_total
+
+    counts: Counter = Counter()
+    for metric in ai_requests_total.collect():
+        for sample in metric.samples:
+            if sample.name.endswith("_total"):
+                counts[sample.labels["status"]] += sample.value
+    return counts
+
+
+def replay_inproc(records: List[Dict], speed: float, warmup: bool) -> Dict:
+    import model
+    from publisher import ResponseOutput
+
+    if warmup:
+        model.run_warmup(
+            model.select_warmup_agents(model.WARMUP_AGENTS, model.agent_registry.agent_names, model.preload_agents),
+            model.warm_up_agent, model.WARMUP_ROUNDS
+        )
+    channel = MemoryChannel()
+    model.response_output = ResponseOutput(MemoryConnection(), channel, model.QUEUE_OUT or "ai_response")
+
+    queue_ages, service_times, statuses = [], [], Counter()
+    start = time.perf_counter()
+    for tag, (offset, request) in enumerate(schedule(records, speed), start=1):
+        delay = start + offset - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        began = time.perf_counter()
+        queue_ages.append(began - (start + offset))
+        before = _status_counts()
+        model.callback(
+            channel,
+            SimpleNamespace(delivery_tag=tag),
+            SimpleNamespace(content_type="application/json", message_id=f"replay-{tag}", timestamp=None),
+            dumps(request)
+        )
+        service_times.append(time.perf_counter() - began)
+        changed = _status_counts() - before
+        statuses[next(iter(changed)) if changed else "rejected"] += 1
+    elapsed = time.perf_counter() - start
+    return _report(len(records), speed, elapsed, statuses, {"queue_age": queue_ages, "service": service_times})
+
+
+# --- Воспроизведение через локальный брокер ---
+def _response_status(response: Dict) -> str:
+    if response.get("isManager"):
+        return "escalated"
+    if response.get("answer") == NO_CONTEXT_ANSWER:
+        return "no_context"
+    if response.get("answer") == ERROR_ANSWER:
+        return "error"
+    return "answered"  # success или greeting: по ответу не различить
+
+
+def replay_broker(records: List[Dict], speed: float, host: str, queue_in: str, queue_out: str, timeout: float) -> Dict:
+    import pika
+
+    sent: Dict[str, List[float]] = {}  # chatId -> времена отправки ещё не отвеченных запросов
+    lock = threading.Lock()
+
+    def publish():
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+        channel = connection.channel()
+        channel.queue_declare(queue=queue_in, durable=True)
+        start = time.perf_counter()
+        for offset, request in schedule(records, speed):
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            with lock:
+                sent.setdefault(request.get("chatId"), []).append(time.perf_counter())
+            channel.basic_publish(exchange="", routing_key=queue_in, body=dumps(request),
+                                  properties=pika.BasicProperties(delivery_mode=2, content_type="application/json"))
+        connection.close()
+
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+    channel = connection.channel()
+    channel.queue_declare(queue=queue_out, durable=True)
+    publisher = threading.Thread(target=publish, name="replay-publisher", daemon=True)
+    start = time.perf_counter()
+    publisher.start()
+
+    latencies, statuses = [], Counter()
+    for _, properties, body in channel.consume(queue_out, inactivity_timeout=timeout):
+        if body is None:
+            logger.warning(f"Нет ответов {timeout} с, воспроизведение остановлено")
+            break
+        response = loads(body, "msgpack" if properties.content_type in ("application/msgpack", "application/x-msgpack") else "json")
+        with lock:
+            pending = sent.get(response.get("chatId"))
+            sent_at = pending.pop(0) if pending else None
+        if sent_at is not None:
+            latencies.append(time.perf_counter() - sent_at)
+        statuses[_response_status(response)] += 1
+        if sum(statuses.values()) >= len(records):
+            break
+    channel.cancel()
+    elapsed = time.perf_counter() - start
+    connection.close()
+    return _report(len(records), speed, elapsed, statuses, {"latency": latencies})
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ms = np.array(values) * 1000
+    report = {f"p{p}_ms": round(float(np.percentile(ms, p)), 1) for p in (50, 90, 99)}
+    report["max_ms"] = round(float(ms.max()), 1)
+    return report
+
+
+def _report(total: int, speed: float, elapsed: float, statuses: Counter, timings: Dict[str, List[float]]) -> Dict:
+    completed = sum(statuses.values())
+    return {
+        "requests": total,
+        "completed": completed,
+        "speed": speed,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(completed / max(elapsed, 1e-9), 2),
+        **{name: _percentiles(values) for name, values in timings.items()},
+        "statuses": {status: {"count": count, "share": round(count / max(completed, 1), 3)}
+                     for status, count in statuses.most_common()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного трафика ai_requests")
+    parser.add_argument("command", choices=["replay", "stats"])
+    parser.add_argument("capture", help="Файл записи (TRAFFIC_CAPTURE)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Ускорение относительно записи: 1, 5, 10…")
+    parser.add_argument("--limit", type=int, default=0, help="Воспроизвести только первые N запросов")
+    parser.add_argument("--broker", help="Хост локального RabbitMQ; без него — воспроизведение в процессе")
+    parser.add_argument("--queue-in", default=os.getenv("QUEUE_IN") or "ai_requests")
+    parser.add_argument("--queue-out", default=os.getenv("QUEUE_OUT") or "ai_response")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Сколько ждать ответа в режиме broker")
+    parser.add_argument("--no-warmup", action="store_true", help="Не прогревать консьюмер перед воспроизведением")
+    parser.add_argument("--output", help="Куда записать JSON-отчёт (по умолчанию — только stdout)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    records = read_capture(args.capture)
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        parser.error(f"в {args.capture} нет запросов")
+
+    if args.command == "stats":
+        span = records[-1]["t"] - records[0]["t"]
+        report = {
+            "requests": len(records),
+            "chats": len({entry["request"].get("chatId") for entry in records}),
+            "span_s": round(span, 1),
+            "rate_rps": round(len(records) / max(span, 1e-9), 3),
+            "history_turns_mean": round(float(np.mean([len(e["request"].get("messageHistory", [])) for e in records])), 1),
+        }
+    elif args.broker:
+        report = replay_broker(records, args.speed, args.broker, args.queue_in, args.queue_out, args.timeout)
+    else:
+        report = replay_inproc(records, args.speed, warmup=not args.no_warmup)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
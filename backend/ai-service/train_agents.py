@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Обучение LoRA-адаптеров всех агентов за один запуск
+
+Агенты — файлы <агент>.txt с записью в agents.json или каталогом <агент>/ (адаптера
+<агент>/best_model может ещё не быть). Базовая модель загружается один раз, адаптеры
+обучаются по очереди. Агент пропускается,
+если хэш его базы знаний и параметры обучения не изменились с прошлого обучения
+(training_manifest.json в каталоге агентов). Токенизированные датасеты берутся из
+кэша lora_data, поэтому повторный запуск после правки одного файла обучает только его.
+
+Использование:
+    python train_agents.py [--agent Сеть] [--force] [--dry-run]
+    python train_agents.py --mark-current   # принять уже обученные адаптеры как актуальные
+После обучения стек адаптеров для быстрого старта: python export_models.py build --targets adapters
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import logging
+from typing import Dict
+
+from agent_registry import AgentRegistry
+
+logger = logging.getLogger(__name__)
+
+TRAINING_MANIFEST_NAME = "training_manifest.json"
+
+
+def read_training_manifest(agents_dir: str) -> Dict:
+    path = os.path.join(agents_dir, TRAINING_MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {"agents": {}}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_training_manifest(agents_dir: str, manifest: Dict):
+    path = os.path.join(agents_dir, TRAINING_MANIFEST_NAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def is_up_to_date(spec, record: Dict, config_hash: str) -> bool:
+    return (
+        bool(record)
+        and record.get("corpus_hash") == spec.corpus_hash()
+        and record.get("config_hash") == config_hash
+        and os.path.exists(os.path.join(spec.adapter_path, "adapter_config.json"))
+    )
+
+
+def main():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Обучение адаптеров всех агентов")
+    parser.add_argument("--agents-dir", default=os.getenv("AGENTS_DIR", base_dir))
+    parser.add_argument("--agent", action="append", help="Обучить только указанных агентов (можно несколько раз)")
+    parser.add_argument("--force", action="store_true", help="Переобучить даже без изменений")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать, какие агенты будут обучены")
+    parser.add_argument("--mark-current", action="store_true",
+                        help="Записать в манифест текущие адаптеры как актуальные, не обучая их")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from lora import training_config_hash
+
+    registry = AgentRegistry(args.agents_dir)
+    specs = registry.discover(require_adapter=False)
+    if args.agent:
+        unknown = set(args.agent) - set(specs)
+        if unknown:
+            parser.error(f"неизвестные агенты: {', '.join(sorted(unknown))}")
+        specs = {name: specs[name] for name in args.agent}
+    specs = {name: spec for name, spec in specs.items() if os.path.exists(spec.file_path)}
+
+    manifest = read_training_manifest(args.agents_dir)
+    config_hash = training_config_hash()
+    pending = [
+        name for name in sorted(specs)
+        if args.force or not is_up_to_date(specs[name], manifest["agents"].get(name, {}), config_hash)
+    ]
+    for name in sorted(set(specs) - set(pending)):
+        logger.info(f"Агент {name}: база знаний не изменилась, обучение пропущено")
+    logger.info(f"К обучению: {', '.join(pending) or 'нет'}")
+    if args.mark_current:
+        for name in pending:
+            spec = specs[name]
+            if os.path.exists(os.path.join(spec.adapter_path, "adapter_config.json")):
+                manifest["agents"][name] = {
+                    "corpus_hash": spec.corpus_hash(),
+                    "config_hash": config_hash,
+                    "adapter_path": os.path.relpath(spec.adapter_path, args.agents_dir),
+                    "trained_at": None,
+                }
+        write_training_manifest(args.agents_dir, manifest)
+        return
+    if args.dry_run or not pending:
+        return
+
+    from lora import load_base_model, train_adapter
+
+    start = time.time()
+    base_model, tokenizer = load_base_model()
+    logger.info(f"Базовая модель загружена за {time.time() - start:.1f} с")
+
+    for name in pending:
+        spec = specs[name]
+        corpus_hash = spec.corpus_hash()
+        with open(spec.file_path, "r", encoding="utf-8") as f:
+            text = f.read()
+        checkpoint_dir = os.path.join(base_dir, "lora_finetuned", name)
+        logger.info(f"Обучение агента {name}")
+        base_model, summary = train_adapter(base_model, tokenizer, text, spec.adapter_path, checkpoint_dir=checkpoint_dir)
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+        manifest["agents"][name] = {
+            "corpus_hash": corpus_hash,
+            "config_hash": config_hash,
+            "adapter_path": os.path.relpath(spec.adapter_path, args.agents_dir),
+            "trained_at": time.time(),
+            **summary,
+        }
+        # Манифест пишется после каждого агента: прерванный запуск продолжится с оставшихся
+        write_training_manifest(args.agents_dir, manifest)
+        logger.info(f"Агент {name} обучен за {summary['train_seconds']} с ({summary['tokens_per_second']} токенов/с)")
+
+    logger.info(f"Обучено агентов: {len(pending)} за {time.time() - start:.1f} с")
+
+
+if __name__ == "__main__":
+    main()
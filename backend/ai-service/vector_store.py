@@ -0,0 +1,204 @@
+"""
+Хранилище эмбеддингов параграфов: ChromaDB по HTTP, встроенная ChromaDB или локальный NumPy/SQLite
+
+Бэкенд выбирается переменной VECTOR_STORE:
+- http — прежний режим: отдельный сервис ChromaDB (CHROMADB_HOST, CHROMADB_PORT), каждое
+  обращение — сетевой запрос с эмбеддингами в JSON;
+- chroma — встроенная ChromaDB (PersistentClient) в каталоге VECTOR_STORE_PATH, без сети;
+- native — файл SQLite в VECTOR_STORE_PATH: эмбеддинги хранятся двоичными строками float32
+  и читаются одним запросом в матрицу NumPy, без преобразования в списки чисел.
+
+Все бэкенды дают подмножество API коллекции ChromaDB, которым пользуется retriever:
+get/add/query/delete с фильтром where={"agent": ...}. add принимает массив NumPy и
+отправляет записи пачками по VECTOR_STORE_BATCH_SIZE, чтобы большие базы знаний
+не упирались в ограничения размера запроса.
+"""
+
+import os
+import json
+import sqlite3
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from numpy.typing import NDArray
+
+try:
+    import chromadb
+    from chromadb.config import Settings
+except ImportError:
+    chromadb = None
+
+logger = logging.getLogger(__name__)
+
+VECTOR_STORE_BACKENDS = ("http", "chroma", "native")
+DEFAULT_BATCH_SIZE = 512
+
+
+def _as_matrix(embeddings: Any) -> NDArray:
+    return np.ascontiguousarray(np.asarray(embeddings, dtype=np.float32))
+
+
+class ChromaVectorStore:
+    """Коллекция ChromaDB (HTTP или встроенная) с пакетной записью"""
+
+    def __init__(self, collection, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.collection = collection
+        self.batch_size = batch_size
+
+    def get(self, where: Dict, include: Sequence[str] = ("documents", "embeddings", "metadatas")) -> Dict:
+        return self.collection.get(where=where, include=list(include))
+
+    def add(self, documents: List[str], embeddings: Any, metadatas: List[Dict], ids: List[str]):
+        embeddings = _as_matrix(embeddings)
+        for start in range(0, len(ids), self.batch_size):
+            stop = start + self.batch_size
+            self.collection.add(
+                documents=documents[start:stop],
+                embeddings=embeddings[start:stop].tolist(),
+                metadatas=metadatas[start:stop],
+                ids=ids[start:stop]
+            )
+
+    def query(self, query_embeddings: Any, where: Dict, n_results: int = 10,
+              include: Sequence[str] = ("documents", "metadatas", "distances")) -> Dict:
+        return self.collection.query(
+            query_embeddings=_as_matrix(query_embeddings).tolist(),
+            where=where,
+            n_results=n_results,
+            include=list(include)
+        )
+
+    def delete(self, where: Dict):
+        self.collection.delete(where=where)
+
+
+class NativeVectorStore:
+    """
+    Эмбеддинги в SQLite: одна строка на параграф, вектор — BLOB float32. Записи агента
+    читаются одним запросом и собираются в матрицу через np.frombuffer.
+    """
+
+    def __init__(self, path: str, collection_name: str, batch_size: int = DEFAULT_BATCH_SIZE):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.table = collection_name
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} ("
+            "id TEXT PRIMARY KEY, agent TEXT, position INTEGER, document TEXT, metadata TEXT, "
+            "dim INTEGER, embedding BLOB)"
+        )
+        self._db.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_agent ON {self.table} (agent, position)")
+        self._db.commit()
+
+    @staticmethod
+    def _agent(where: Dict) -> str:
+        if set(where) != {"agent"}:
+            raise ValueError(f"Локальное хранилище поддерживает только фильтр по агенту, получено: {where}")
+        return where["agent"]
+
+    def _rows(self, agent: str) -> List[tuple]:
+        with self._lock:
+            return self._db.execute(
+                f"SELECT id, document, metadata, dim, embedding FROM {self.table} WHERE agent = ? ORDER BY position",
+                (agent,)
+            ).fetchall()
+
+    @staticmethod
+    def _matrix(rows: List[tuple]) -> NDArray:
+        if not rows:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.frombuffer(b"".join(row[4] for row in rows), dtype=np.float32).reshape(len(rows), rows[0][3])
+
+    def get(self, where: Dict, include: Sequence[str] = ("documents", "embeddings", "metadatas")) -> Dict:
+        rows = self._rows(self._agent(where))
+        return {
+            "ids": [row[0] for row in rows],
+            "documents": [row[1] for row in rows] if "documents" in include else None,
+            "metadatas": [json.loads(row[2]) for row in rows] if "metadatas" in include else None,
+            "embeddings": self._matrix(rows) if "embeddings" in include else None,
+        }
+
+    def add(self, documents: List[str], embeddings: Any, metadatas: List[Dict], ids: List[str]):
+        embeddings = _as_matrix(embeddings)
+        with self._lock:
+            # Новые записи агента дописываются после уже сохранённых
+            positions: Dict[str, int] = {}
+            for start in range(0, len(ids), self.batch_size):
+                stop = start + self.batch_size
+                batch = []
+                for doc_id, document, metadata, embedding in zip(ids[start:stop], documents[start:stop],
+                                                                 metadatas[start:stop], embeddings[start:stop]):
+                    agent = metadata.get("agent", "")
+                    if agent not in positions:
+                        positions[agent] = self._db.execute(
+                            f"SELECT COUNT(*) FROM {self.table} WHERE agent = ?", (agent,)
+                        ).fetchone()[0]
+                    batch.append((doc_id, agent, positions[agent], document, json.dumps(metadata, ensure_ascii=False),
+                                  embedding.shape[0], embedding.tobytes()))
+                    positions[agent] += 1
+                self._db.executemany(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+            self._db.commit()
+
+    def query(self, query_embeddings: Any, where: Dict, n_results: int = 10,
+              include: Sequence[str] = ("documents", "metadatas", "distances")) -> Dict:
+        """Ближайшие записи по квадрату евклидова расстояния (как у ChromaDB); списки — по запросам"""
+        rows = self._rows(self._agent(where))
+        matrix = self._matrix(rows)
+        queries = _as_matrix(query_embeddings)
+        queries = queries.reshape(1, -1) if queries.ndim == 1 else queries
+        result: Dict[str, Optional[List]] = {"ids": [], "documents": [], "metadatas": [], "embeddings": [], "distances": []}
+        for query in queries:
+            distances = ((matrix - query) ** 2).sum(axis=1) if rows else np.zeros(0, dtype=np.float32)
+            best = np.argsort(distances, kind="stable")[:n_results]
+            result["ids"].append([rows[i][0] for i in best])
+            result["documents"].append([rows[i][1] for i in best])
+            result["metadatas"].append([json.loads(rows[i][2]) for i in best])
+            result["embeddings"].append(matrix[best])
+            result["distances"].append(distances[best].tolist())
+        for key in ("documents", "metadatas", "embeddings", "distances"):
+            if key not in include:
+                result[key] = None
+        return result
+
+    def delete(self, where: Dict):
+        with self._lock:
+            self._db.execute(f"DELETE FROM {self.table} WHERE agent = ?", (self._agent(where),))
+            self._db.commit()
+
+
+def _chroma_collection(client, collection_name: str):
+    try:
+        collection = client.get_collection(collection_name)
+        logger.info(f"Коллекция {collection_name} найдена в ChromaDB.")
+    except Exception as e:
+        logger.info(f"Создаём новую коллекцию {collection_name} в ChromaDB: {e}")
+        collection = client.create_collection(collection_name)
+    return collection
+
+
+def open_vector_store(backend: str, collection_name: str, path: str = "", host: str = "localhost",
+                      port: int = 8000, batch_size: int = DEFAULT_BATCH_SIZE):
+    """Открывает хранилище эмбеддингов выбранного бэкенда"""
+    if backend not in VECTOR_STORE_BACKENDS:
+        raise ValueError(f"Неизвестный бэкенд хранилища эмбеддингов: {backend}")
+    if backend == "native":
+        db_path = os.path.join(path, f"{collection_name}.sqlite3")
+        logger.info(f"Хранилище эмбеддингов: SQLite {db_path}")
+        return NativeVectorStore(db_path, collection_name, batch_size)
+
+    if chromadb is None:
+        raise RuntimeError(f"Для бэкенда {backend} установите chromadb или используйте VECTOR_STORE=native")
+    settings = Settings(allow_reset=True, anonymized_telemetry=False)
+    if backend == "chroma":
+        logger.info(f"Хранилище эмбеддингов: встроенная ChromaDB в {path}")
+        client = chromadb.PersistentClient(path=path, settings=settings)
+    else:
+        logger.info(f"Хранилище эмбеддингов: ChromaDB {host}:{port}")
+        client = chromadb.HttpClient(host=host, port=port, settings=settings)
+    return ChromaVectorStore(_chroma_collection(client, collection_name), batch_size)
@@ -0,0 +1,114 @@
+"""
+Прогрев консьюмера перед приёмом сообщений
+
+Первые запросы к каждому агенту после запуска платят за выбор ядер CUDA, ленивые
+выделения памяти, загрузку адаптера и эмбеддингов параграфов, поэтому каждая раскатка
+даёт всплеск задержки. Перед basic_consume сервис прогоняет для выбранных агентов
+типичные вопросы (sample_questions из agents.json) через те же этапы, что и запрос:
+эмбеддинг и маршрутизация (encode), поиск контекста (retrieve) и генерация (generate).
+Каждый вопрос проходит WARMUP_ROUNDS раз: первый круг показывает цену холодного старта,
+последний — установившуюся задержку.
+
+Готовность публикуется сервером метрик: /ready отвечает 503, пока идёт прогрев,
+и 200 после него; метрика ai_ready — 0/1.
+
+Опционально (WARMUP_COMPILE=1, только GPU) forward базовой модели компилируется
+torch.compile в режиме reduce-overhead со статическим KV-кэшем: формы шага
+декодирования фиксированы, и он захватывается в CUDA-граф во время прогрева.
+"""
+
+import time
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+from metrics import ai_warmup_seconds
+
+logger = logging.getLogger(__name__)
+
+WARMUP_STAGES = ("encode", "retrieve", "generate")
+DEFAULT_WARMUP_QUESTION = "Не работает, что делать?"
+
+
+def select_warmup_agents(setting: str, agent_names: List[str], preload: List[str]) -> List[str]:
+    """WARMUP_AGENTS: preload (агенты из AGENT_PRELOAD), all, none или список через запятую"""
+    setting = setting.strip()
+    if setting == "none" or not setting:
+        return []
+    if setting == "all":
+        return list(agent_names)
+    requested = preload if setting == "preload" else [a.strip() for a in setting.split(",") if a.strip()]
+    missing = [a for a in requested if a not in agent_names]
+    if missing:
+        logger.warning(f"Агенты для прогрева не найдены: {', '.join(missing)}")
+    return [a for a in requested if a in agent_names]
+
+
+def warmup_questions(spec, limit: int) -> List[str]:
+    questions = list(spec.sample_questions[:limit])
+    return questions or [f"{spec.name}: {DEFAULT_WARMUP_QUESTION}"]
+
+
+class WarmupReport:
+    """Время этапов прогрева по агентам: первый круг и последний (установившийся)"""
+
+    def __init__(self):
+        self.rounds: Dict[str, Dict[str, List[float]]] = defaultdict(lambda: defaultdict(list))
+        self._round_times: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self.started_at = time.time()
+        self.duration = 0.0
+
+    @contextmanager
+    def stage(self, agent: str, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._round_times[agent][stage] += time.perf_counter() - start
+
+    def end_round(self, agent: str):
+        for stage, seconds in self._round_times.pop(agent, {}).items():
+            self.rounds[agent][stage].append(seconds)
+
+    def summary(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        return {
+            agent: {stage: {"first": round(times[0], 3), "last": round(times[-1], 3)} for stage, times in stages.items()}
+            for agent, stages in self.rounds.items()
+        }
+
+
+def run_warmup(agents: List[str], warm_agent: Callable[[str, WarmupReport], None], rounds: int = 2) -> WarmupReport:
+    """
+    Прогревает агентов: warm_agent(agent, report) выполняет один круг этапов, оборачивая
+    их в report.stage(agent, stage). Ошибка прогрева агента не останавливает запуск.
+    """
+    report = WarmupReport()
+    for agent in agents:
+        for _ in range(max(rounds, 1)):
+            try:
+                warm_agent(agent, report)
+            except Exception as e:
+                logger.error(f"Ошибка прогрева агента {agent}: {e}", exc_info=True)
+                break
+            finally:
+                report.end_round(agent)
+        for stage, times in report.rounds[agent].items():
+            ai_warmup_seconds.labels(agent=agent, stage=stage, round="first").set(times[0])
+            ai_warmup_seconds.labels(agent=agent, stage=stage, round="last").set(times[-1])
+    report.duration = time.time() - report.started_at
+    logger.info(f"Прогрев завершён за {report.duration:.1f} с", extra={"warmup": report.summary()})
+    return report
+
+
+def compile_for_decoding(model, mode: str = "reduce-overhead"):
+    """
+    Компилирует forward модели для генерации со статическим KV-кэшем; в режиме
+    reduce-overhead шаг декодирования (фиксированные формы) выполняется CUDA-графом.
+    """
+    import torch
+
+    model.generation_config.cache_implementation = "static"
+    model.forward = torch.compile(model.forward, mode=mode)
+    logger.info(f"forward модели скомпилирован torch.compile (mode={mode}), статический KV-кэш")
+    return model
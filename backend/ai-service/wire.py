@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Формат сообщений очередей ai_requests / ai_response
+
+Версия 1 (без поля "v") — прежний JSON: {chatId, message, messageHistory, username?, aiId?}.
+Версия 2 добавляет:
+- кодек по content_type: application/json (orjson, если установлен, иначе json)
+  или application/msgpack (пакет msgpack);
+- режим дельты истории: вместо messageHistory приходят только новые реплики
+  historyDelta и хэш historyBase истории, к которой они дописываются. Сервис хранит
+  историю чатов (LRU) и восстанавливает полную; historyHash в ответе — хэш истории
+  после дописывания, его отправитель передаёт как historyBase в следующем запросе.
+  Если базы нет (перезапуск, другая реплика), запрос обрабатывается с тем, что есть,
+  а в ответе выставляется historyResync — следующий запрос должен нести полную историю.
+  Для каждого чата хранится и предыдущая версия истории, поэтому повторно доставленный
+  запрос (nack, таймаут, потеря ответа) с той же historyBase восстанавливается так же.
+Ответ кодируется тем же кодеком, что и запрос; запросы версии 1 обрабатываются как раньше.
+
+Хэш истории цепочечный: h_i = sha256(h_{i-1} + реплика_i), поэтому дописывание
+дельты не требует перехэширования всей истории.
+
+Бенчмарк размера и времени декодирования:
+    python wire.py bench [--turns 10,50,200] [--delta 2]
+"""
+
+import json
+import time
+import hashlib
+import argparse
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+SCHEMA_VERSION = 2
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPES = ("application/msgpack", "application/x-msgpack")
+WIRE_FORMATS = ("json", "msgpack")
+
+
+def content_type_for(fmt: str) -> str:
+    return MSGPACK_CONTENT_TYPES[0] if fmt == "msgpack" else JSON_CONTENT_TYPE
+
+
+def format_for(content_type: Optional[str]) -> str:
+    return "msgpack" if content_type in MSGPACK_CONTENT_TYPES else "json"
+
+
+def dumps(obj: Any, fmt: str = "json") -> bytes:
+    if fmt == "msgpack":
+        if msgpack is None:
+            raise RuntimeError("Для формата msgpack установите пакет msgpack")
+        return msgpack.packb(obj, use_bin_type=True)
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def loads(body: bytes, fmt: str = "json") -> Any:
+    if fmt == "msgpack":
+        if msgpack is None:
+            raise RuntimeError("Для формата msgpack установите пакет msgpack")
+        return msgpack.unpackb(body, raw=False)
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def _canonical(turn: Dict) -> bytes:
+    """Компактный JSON в UTF-8 с отсортированными ключами (orjson и json дают одни и те же байты)"""
+    if orjson is not None:
+        return orjson.dumps(turn, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(turn, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def history_hash(turns: List[Dict], base: str = "") -> str:
+    """Цепочечный хэш истории; base — хэш уже учтённой части"""
+    digest = base
+    for turn in turns:
+        digest = hashlib.sha256(digest.encode("ascii") + _canonical(turn)).hexdigest()
+    return digest
+
+
+class HistoryCache:
+    """
+    Истории чатов для восстановления по дельте (LRU по chatId). На чат хранятся две версии:
+    текущая и предыдущая — ответ на запрос мог не дойти до отправителя, и тогда он повторит
+    запрос с прежней базой.
+    """
+
+    VERSIONS = 2
+
+    def __init__(self, max_chats: int = 10000, max_turns: int = 200):
+        self.max_chats = max_chats
+        self.max_turns = max_turns
+        self._chats: "OrderedDict[str, List[Tuple[List[Dict], str]]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+    def get(self, chat_id: str, digest: str) -> Optional[List[Dict]]:
+        """История чата с хэшем digest, если она ещё в кэше"""
+        versions = self._chats.get(chat_id)
+        if versions is None:
+            return None
+        self._chats.move_to_end(chat_id)
+        return next((turns for turns, version in versions if version == digest), None)
+
+    def put(self, chat_id: str, turns: List[Dict], digest: str):
+        # Хэш считается по всей истории отправителя, в памяти держится только хвост
+        # (версии делят сами реплики, копируются только списки)
+        previous = [v for v in self._chats.get(chat_id, []) if v[1] != digest]
+        self._chats[chat_id] = [(turns[-self.max_turns:], digest)] + previous[:self.VERSIONS - 1]
+        self._chats.move_to_end(chat_id)
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+
+
+def decode_request(body: bytes, content_type: Optional[str] = None, cache: Optional[HistoryCache] = None) -> Dict:
+    """
+    Разбирает запрос любой версии и формата. В результате всегда есть messageHistory;
+    служебные поля: _format, _version, _historyHash, _delta, _resync.
+    """
+    fmt = format_for(content_type)
+    data = loads(body, fmt)
+    data["_format"] = fmt
+    data["_version"] = int(data.get("v", 1))
+    data["_delta"] = "historyDelta" in data
+    data["_resync"] = False
+    if data["_version"] < 2:
+        data.setdefault("messageHistory", [])
+        return data
+
+    chat_id = data.get("chatId")
+    if data["_delta"]:
+        delta = data.pop("historyDelta") or []
+        base = data.pop("historyBase", "")
+        cached = cache.get(chat_id, base) if cache is not None and chat_id and base else None
+        if base and cached is None:
+            logger.warning(f"Нет базы истории {base[:12]} для чата {chat_id}, требуется полная история")
+            data["_resync"] = True
+            history, digest = delta, ""
+        else:
+            history, digest = (cached or []) + delta, base
+        data["messageHistory"] = history
+        data["_historyHash"] = history_hash(delta, digest) if not data["_resync"] else ""
+    else:
+        data.setdefault("messageHistory", [])
+        data["_historyHash"] = history_hash(data["messageHistory"])
+    if cache is not None and chat_id and data["_historyHash"]:
+        cache.put(chat_id, data["messageHistory"], data["_historyHash"])
+    return data
+
+
+def encode_response(response: Dict, request: Dict) -> Tuple[bytes, str]:
+    """Кодирует ответ в формате запроса; для версии 2 добавляет хэш истории"""
+    if request.get("_version", 1) >= SCHEMA_VERSION:
+        response = dict(response, v=SCHEMA_VERSION, historyHash=request.get("_historyHash", ""))
+        if request.get("_resync"):
+            response["historyResync"] = True
+    fmt = request.get("_format", "json")
+    return dumps(response, fmt), content_type_for(fmt)
+
+
+def encode_request(chat_id: str, message: str, history: List[Dict], fmt: str = "json",
+                   delta_from: Optional[int] = None, base_hash: str = "", **fields) -> Tuple[bytes, str]:
+    """
+    Запрос версии 2: полная история или (delta_from задан) только реплики history[delta_from:]
+    поверх истории с хэшем base_hash. Используется тестовым стендом и бенчмарком.
+    """
+    request = {"v": SCHEMA_VERSION, "chatId": chat_id, "message": message, **fields}
+    if delta_from is None:
+        request["messageHistory"] = history
+    else:
+        request["historyDelta"] = history[delta_from:]
+        request["historyBase"] = base_hash
+    return dumps(request, fmt), content_type_for(fmt)
+
+
+# --- Бенчмарк ---
+def _synthetic_history(n_turns: int) -> List[Dict]:
+    turns = []
+    for i in range(n_turns):
+        user = i % 2 == 0
+        turns.append({
+            "username": "Пользователь" if user else "AI-помощник",
+            "message": ("Не работает интернет после обновления роутера, что делать? " if user else
+                        "Перезагрузите роутер: выключите его на 30 секунд, затем проверьте индикаторы и кабель провайдера. ") * 2,
+            "timestamp": 1700000000000 + i * 1000,
+            "isBot": not user,
+        })
+    return turns
+
+
+def _decode_ms(body: bytes, content_type: str, repeats: int, cache_factory=None) -> float:
+    # Кэш меняется при декодировании, поэтому на каждый повтор готовится свой (вне замера)
+    caches = [cache_factory() if cache_factory else None for _ in range(repeats)]
+    start = time.perf_counter()
+    for cache in caches:
+        decode_request(body, content_type, cache)
+    return (time.perf_counter() - start) * 1000 / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк формата сообщений ai_requests")
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--turns", default="10,50,200", help="Длины истории через запятую")
+    parser.add_argument("--delta", type=int, default=2, help="Новых реплик в дельте")
+    parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    formats = ["json"] + (["msgpack"] if msgpack is not None else [])
+    report = {"json_codec": "orjson" if orjson is not None else "json", "results": []}
+    for n_turns in [int(t) for t in args.turns.split(",")]:
+        history = _synthetic_history(n_turns)
+        split = max(n_turns - args.delta, 0)
+        base_hash = history_hash(history[:split])
+        legacy = json.dumps({"chatId": "bench", "message": "Вопрос", "messageHistory": history}, ensure_ascii=False).encode("utf-8")
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            json.loads(legacy)
+        report["results"].append({"turns": n_turns, "format": "v1-json", "bytes": len(legacy),
+                                  "decode_ms": round((time.perf_counter() - start) * 1000 / args.repeats, 4)})
+
+        for fmt in formats:
+            body, content_type = encode_request("bench", "Вопрос", history, fmt)
+            report["results"].append({"turns": n_turns, "format": f"v2-{fmt}", "bytes": len(body),
+                                      "decode_ms": round(_decode_ms(body, content_type, args.repeats), 4)})
+
+            def primed_cache() -> HistoryCache:
+                cache = HistoryCache()
+                cache.put("bench", history[:split], base_hash)
+                return cache
+
+            body, content_type = encode_request("bench", "Вопрос", history, fmt, delta_from=split, base_hash=base_hash)
+            report["results"].append({"turns": n_turns, "format": f"v2-{fmt}-delta", "bytes": len(body),
+                                      "decode_ms": round(_decode_ms(body, content_type, args.repeats, primed_cache), 4)})
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,12 @@
+import os
+import sys
 import pika
-import json
 import time
 
+# Формат сообщений (версия 2, msgpack, дельта истории) — общий с AI service
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ai-service'))
+from wire import WIRE_FORMATS, decode_request, dumps, content_type_for, encode_request, history_hash
+
 print("🧪 Manual AI Response Tester")
 print("=" * 50)
 print("Этот скрипт эмулирует AI service")
@@ -21,21 +26,34 @@ def connect_rabbitmq():
         print("Убедитесь, что RabbitMQ запущен: docker-compose ps")
         exit(1)
 
-def send_ai_response(channel, chat_id, answer, bot_username, is_manager=False):
-    """Отправка ответа в очередь ai_response"""
+# Тестовые чаты, отправленные из стенда: chatId -> (история, хэш истории)
+test_chats = {}
+
+def ask_format():
+    fmt = input(f"Формат ({'/'.join(WIRE_FORMATS)}) [json]: ").strip().lower() or 'json'
+    if fmt not in WIRE_FORMATS:
+        print("❌ Неизвестный формат, используется json")
+        fmt = 'json'
+    return fmt
+
+def send_ai_response(channel, chat_id, answer, bot_username, is_manager=False, fmt='json'):
+    """Отправка ответа в очередь ai_response (json — прежний формат, msgpack — версия 2)"""
     response = {
         'chatId': chat_id,
         'answer': answer,
         'botUsername': bot_username,
         'isManager': is_manager
     }
+    if fmt == 'msgpack':
+        response['v'] = 2
 
     channel.basic_publish(
         exchange='',
         routing_key='ai_response',
-        body=json.dumps(response),
+        body=dumps(response, fmt),
         properties=pika.BasicProperties(
             delivery_mode=2,  # Персистентное сообщение
+            content_type=content_type_for(fmt)
         )
     )
 
@@ -44,13 +62,37 @@ def send_ai_response(channel, chat_id, answer, bot_username, is_manager=False):
     print(f"   Answer: {answer}")
     print(f"   Bot Username: {bot_username}")
     print(f"   isManager: {is_manager}")
+    print(f"   Format: {fmt}")
+
+def send_test_request(channel, chat_id, message, fmt='json', delta=False):
+    """
+    Отправка запроса в ai_requests в формате версии 2 (вместо chat service).
+    В режиме дельты отправляется только новая реплика и хэш уже отправленной истории.
+    """
+    history, base_hash = test_chats.get(chat_id, ([], ""))
+    turn = {'username': 'Тестер', 'message': message, 'timestamp': int(time.time() * 1000), 'isBot': False}
+    history = history + [turn]
+    body, content_type = encode_request(
+        chat_id, message, history, fmt,
+        delta_from=len(history) - 1 if delta else None,
+        base_hash=base_hash,
+        username='Тестер'
+    )
+    channel.basic_publish(
+        exchange='',
+        routing_key='ai_requests',
+        body=body,
+        properties=pika.BasicProperties(delivery_mode=2, content_type=content_type)
+    )
+    test_chats[chat_id] = (history, history_hash([turn], base_hash))
+    print(f"\n✅ Запрос отправлен в 'ai_requests': {len(body)} байт, {fmt}, {'дельта' if delta else 'полная история'}")
 
 def listen_requests(channel):
     """Слушаем очередь ai_requests и выводим их"""
 
     def callback(ch, method, properties, body):
         try:
-            request = json.loads(body)
+            request = decode_request(body, properties.content_type)
             print("\n" + "=" * 50)
             print("📨 ПОЛУЧЕН ЗАПРОС ОТ CHAT SERVICE:")
             print("=" * 50)
@@ -58,6 +100,7 @@ def listen_requests(channel):
             print(f"Message: {request.get('message')}")
             print(f"AI Model: {request.get('aiId', 'N/A')}")
             print(f"History Length: {len(request.get('messageHistory', []))}")
+            print(f"Format: {request['_format']} v{request['_version']} ({len(body)} байт)")
             print("=" * 50)
 
             # Подтверждаем получение
@@ -101,7 +144,18 @@ def manual_mode(channel):
     is_manager_input = input("Требуется менеджер? (y/n) [n]: ").strip().lower()
     is_manager = is_manager_input == 'y'
 
-    send_ai_response(channel, chat_id, answer, bot_username, is_manager)
+    send_ai_response(channel, chat_id, answer, bot_username, is_manager, ask_format())
+
+def request_mode(channel):
+    """Режим отправки тестового запроса в ai_requests"""
+    chat_id = input("Chat ID [test-chat]: ").strip() or 'test-chat'
+    message = input("Сообщение: ").strip()
+    if not message:
+        print("❌ Отменено")
+        return
+    fmt = ask_format()
+    delta = chat_id in test_chats and input("Отправить только новую реплику (дельта)? (y/n) [y]: ").strip().lower() != 'n'
+    send_test_request(channel, chat_id, message, fmt, delta)
 
 if __name__ == '__main__':
     connection = connect_rabbitmq()
@@ -116,8 +170,9 @@ if __name__ == '__main__':
     print("1. Слушать ai_requests (показывать входящие запросы)")
     print("2. Отправить ответ вручную (эмулировать AI ответ)")
     print("3. Оба режима (слушать + возможность ответить)")
+    print("4. Отправить тестовый запрос в ai_requests (json/msgpack, полная история или дельта)")
 
-    mode = input("\nВыберите режим (1/2/3): ").strip()
+    mode = input("\nВыберите режим (1/2/3/4): ").strip()
 
     if mode == '1':
         # Только слушаем
@@ -135,6 +190,14 @@ if __name__ == '__main__':
             if again != 'y':
                 break
 
+    elif mode == '4':
+        # Отправка запросов вместо chat service
+        while True:
+            request_mode(channel)
+            again = input("\nОтправить еще один запрос? (y/n): ").strip().lower()
+            if again != 'y':
+                break
+
     elif mode == '3':
         # Гибридный режим
         import threading